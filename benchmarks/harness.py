@@ -0,0 +1,92 @@
+"""Run a broker for the benchmarks, in this process or as a subprocess."""
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+from src.async_broker import AsyncBroker
+from src.broker import Broker
+
+ENGINES = {"selectors": Broker, "asyncio": AsyncBroker}
+ROOT = Path(__file__).resolve().parent.parent  # where broker.py lives
+START_TIMEOUT = 10.0  # seconds to wait for the broker to accept connections
+
+
+def free_port(host: str = "localhost") -> int:
+    """A port nobody listens on right now."""
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def wait_listening(host: str, port: int, timeout: float = START_TIMEOUT):
+    """Block until host:port accepts connections."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+class BrokerHarness:
+    """Broker under test, started with start() and stopped with stop().
+
+    In process the broker runs in a thread of the benchmark (cheap to start,
+    but shares the GIL with the load generators); as a subprocess it runs
+    `broker.py` like in production."""
+
+    def __init__(self, engine: str = "selectors", external: bool = False,
+                 host: str = "localhost", port: int = None):
+        """Initialize harness, port None picks a free one."""
+        self.engine = engine
+        self.external = external  # run broker.py in a subprocess
+        self.host = host
+        self.port = port or free_port(host)
+        self.broker = None
+        self._thread = None
+        self._process = None
+
+    def start(self) -> "BrokerHarness":
+        """Start the broker and wait until it accepts connections."""
+        if self.external:
+            self._process = subprocess.Popen(
+                [sys.executable, "broker.py", "--engine", self.engine,
+                 "--host", self.host, "--port", str(self.port)],
+                cwd=ROOT, stdout=subprocess.DEVNULL,
+            )
+        else:
+            self.broker = ENGINES[self.engine](self.host, self.port)
+            self._thread = threading.Thread(target=self.broker.run, daemon=True)
+            self._thread.start()
+        wait_listening(self.host, self.port)
+        return self
+
+    def stop(self):
+        """Stop the broker."""
+        if self._process is not None:
+            self._process.terminate()
+            self._process.wait(timeout=START_TIMEOUT)
+            self._process = None
+            return
+        self.broker.canceled = True
+        try:
+            # the selectors loop may wait for events with no timeout
+            socket.create_connection((self.host, self.port), timeout=1).close()
+        except OSError:
+            pass
+        self._thread.join(timeout=START_TIMEOUT)
+        if isinstance(self.broker, Broker):
+            self.broker.sel.close()
+            self.broker.sock.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
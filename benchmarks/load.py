@@ -0,0 +1,166 @@
+"""Broker throughput and end-to-end latency under load.
+
+N producers publish as fast as they can to leaf topics `depth` levels deep
+and M consumers subscribe to the common root, so every consumer receives
+every message. Each value carries its send time; the consumers record the
+latency when they pull it. Every combination of format, payload size and
+topic depth is measured and the results are written as JSON, which a later
+run can be compared against with --baseline.
+
+Run with `python -m benchmarks.load`."""
+import argparse
+import itertools
+import json
+import platform
+import sys
+import threading
+import time
+
+from benchmarks.harness import BrokerHarness
+from src.middleware import BinaryQueue, JSONQueue, MiddlewareType, PickleQueue, XMLQueue
+
+QUEUES = {"json": JSONQueue, "xml": XMLQueue, "pickle": PickleQueue, "binary": BinaryQueue}
+PERCENTILES = {"p50": 50.0, "p99": 99.0, "p99.9": 99.9}
+PULL_TIMEOUT = 10.0  # seconds without a message before a consumer gives up
+
+
+def percentile(ordered, percent):
+    """Nearest-rank percentile of an ordered list."""
+    if not ordered:
+        return None
+    rank = max(1, -(-len(ordered) * percent // 100))  # ceil
+    return ordered[int(rank) - 1]
+
+
+def produce(queue, messages, padding):
+    """Push messages values stamped with their send time."""
+    for _ in range(messages):
+        # a string survives every format (XML sends values as text)
+        queue.push(f"{time.perf_counter_ns()}:{padding}")
+
+
+def consume(queue, expected, latencies, done):
+    """Pull expected values, appending their latency in ns."""
+    for _ in range(expected):
+        received = queue.pull(timeout=PULL_TIMEOUT)
+        if received is None:
+            break
+        now = time.perf_counter_ns()
+        latencies.append(now - int(str(received[1]).split(":", 1)[0]))
+    done.append(time.perf_counter_ns())
+
+
+def run_case(harness, fmt, payload, depth, producers, consumers, messages, case):
+    """Measure one combination, returns its result record."""
+    queue_type = QUEUES[fmt]
+    root = f"/bench{case}"
+    leaf = "/".join(["level"] * (depth - 1))
+    topics = [f"{root}/p{i}/{leaf}".rstrip("/") for i in range(producers)]
+    address = {"host": harness.host, "port": harness.port}
+
+    receivers = [queue_type(root, **address) for _ in range(consumers)]
+    senders = [queue_type(topic, _type=MiddlewareType.PRODUCER, **address) for topic in topics]
+    time.sleep(0.2)  # let the subscriptions reach the broker
+
+    expected = producers * messages
+    latencies = [[] for _ in receivers]
+    done = []
+    threads = [
+        threading.Thread(target=consume, args=(queue, expected, latencies[i], done))
+        for i, queue in enumerate(receivers)
+    ]
+    padding = "x" * payload
+    threads += [threading.Thread(target=produce, args=(queue, messages, padding)) for queue in senders]
+    start = time.perf_counter_ns()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = (max(done) - start) / 1e9
+
+    for queue in senders + receivers:
+        queue.close()
+    ordered = sorted(itertools.chain.from_iterable(latencies))
+    record = {
+        "format": fmt, "payload": payload, "depth": depth,
+        "producers": producers, "consumers": consumers, "messages": messages,
+        "delivered": len(ordered), "lost": expected * consumers - len(ordered),
+        "seconds": elapsed, "msgs_per_s": len(ordered) / elapsed if elapsed else 0.0,
+    }
+    for name, percent in PERCENTILES.items():
+        value = percentile(ordered, percent)
+        record[f"{name}_ms"] = None if value is None else value / 1e6
+    return record
+
+
+def key(record):
+    """What identifies a result between runs."""
+    return tuple(record[field] for field in ("format", "payload", "depth", "producers", "consumers"))
+
+
+def regressions(results, baseline, tolerance):
+    """Messages describing the results worse than baseline by more than tolerance."""
+    previous = {key(record): record for record in baseline["results"]}
+    found = []
+    for record in results:
+        old = previous.get(key(record))
+        if old is None:
+            continue
+        if record["msgs_per_s"] < old["msgs_per_s"] * (1 - tolerance):
+            found.append(f"{key(record)}: {old['msgs_per_s']:.0f} -> {record['msgs_per_s']:.0f} msgs/s")
+        if old["p99_ms"] and record["p99_ms"] and record["p99_ms"] > old["p99_ms"] * (1 + tolerance):
+            found.append(f"{key(record)}: p99 {old['p99_ms']:.2f} -> {record['p99_ms']:.2f} ms")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engine", choices=["selectors", "asyncio"], default="selectors")
+    parser.add_argument("--subprocess", action="store_true", help="run broker.py in a subprocess")
+    parser.add_argument("--formats", nargs="+", choices=list(QUEUES), default=["json", "xml", "pickle"])
+    parser.add_argument("--payloads", nargs="+", type=int, default=[16, 256, 4096], help="value bytes")
+    parser.add_argument("--depths", nargs="+", type=int, default=[1, 3, 6], help="topic levels")
+    parser.add_argument("--producers", type=int, default=2)
+    parser.add_argument("--consumers", type=int, default=2)
+    parser.add_argument("--messages", type=int, default=2000, help="values per producer")
+    parser.add_argument("--output", default="load-results.json")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown (fraction)")
+    args = parser.parse_args()
+
+    print(f"{'format':<8}{'payload':>8}{'depth':>6}{'msgs/s':>10}{'p50 ms':>9}{'p99 ms':>9}"
+          f"{'p99.9 ms':>10}{'lost':>6}")
+    results = []
+    with BrokerHarness(args.engine, args.subprocess) as harness:
+        cases = itertools.product(args.formats, args.payloads, args.depths)
+        for case, (fmt, payload, depth) in enumerate(cases):
+            record = run_case(harness, fmt, payload, depth, args.producers, args.consumers,
+                              args.messages, case)
+            results.append(record)
+            print(f"{fmt:<8}{payload:>8}{depth:>6}{record['msgs_per_s']:>10.0f}"
+                  f"{record['p50_ms'] or 0:>9.2f}{record['p99_ms'] or 0:>9.2f}"
+                  f"{record['p99.9_ms'] or 0:>10.2f}{record['lost']:>6}")
+
+    report = {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "engine": args.engine,
+        "subprocess": args.subprocess,
+        "results": results,
+    }
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+    print(f"results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as previous:
+            found = regressions(results, json.load(previous), args.tolerance)
+        for message in found:
+            print("regression", message)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
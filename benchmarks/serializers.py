@@ -0,0 +1,72 @@
+"""Compare the encode/decode cost of the wire formats.
+
+Run with `python -m benchmarks.serializers`."""
+import argparse
+import json
+import pickle
+import timeit
+import xml.etree.ElementTree as xml
+
+from src import binary
+from src.protocol import BINARY, JSON, PICKLE, XML, PubSub
+
+FORMATS = {"json": JSON, "xml": XML, "pickle": PICKLE, "binary": BINARY}
+
+# the bare deserializer of each format, without building the Message object
+PARSERS = {
+    JSON: json.loads,
+    XML: xml.fromstring,
+    PICKLE: pickle.loads,
+    BINARY: binary.unpack,
+}
+
+# payloads like the ones generated by producer.py
+PAYLOADS = {
+    "temp": ("/temp", 21),
+    "pressure": ("/weather/pressure", 10500),
+    "msg": ("/msg", "Valeu a pena? Tudo vale a pena"),
+}
+
+
+def best(func, number):
+    """Seconds per call, best of a few runs (the slower ones measure the machine)."""
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+
+def bench(_format, topic, value, number):
+    """Payload size, encode, decode and bare parse time of one publish."""
+    msg = PubSub.publish(value, topic)
+    payload = PubSub.serialize(msg, _format)
+    assert PubSub.decode(_format, payload).message in (value, str(value))
+    parse = PARSERS[_format]
+    return (
+        len(payload),
+        best(lambda: PubSub.serialize(msg, _format), number),
+        best(lambda: PubSub.decode(_format, payload), number),
+        best(lambda: parse(payload), number),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=20_000)
+    args = parser.parse_args()
+
+    print(
+        f"{'payload':<10}{'format':<8}{'bytes':>6}{'encode us':>11}"
+        f"{'decode us':>11}{'parse us':>10}{'parse vs json':>15}"
+    )
+    for name, (topic, value) in PAYLOADS.items():
+        results = {
+            fmt: bench(code, topic, value, args.number) for fmt, code in FORMATS.items()
+        }
+        json_parse = results["json"][3]
+        for fmt, (size, encode, decode, parse) in results.items():
+            print(
+                f"{name:<10}{fmt:<8}{size:>6}{encode * 1e6:>11.2f}{decode * 1e6:>11.2f}"
+                f"{parse * 1e6:>10.2f}{json_parse / parse:>14.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
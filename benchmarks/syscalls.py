@@ -0,0 +1,78 @@
+"""Count the writes the broker makes to fan out a burst of publishes.
+
+Every publish_batch frame fans out one frame per record to each subscriber,
+all within one event loop iteration. With vectored writes the outbox hands
+them to the kernel in one sendmsg per connection, without them it makes one
+send per frame.
+
+Run with `python -m benchmarks.syscalls`."""
+import argparse
+import socket
+import threading
+import time
+
+from src.broker import Broker
+from src.outbox import Outbox
+from src.protocol import PICKLE, FrameReader, PubSub
+
+
+def receive(sock, count):
+    """Read count messages from sock."""
+    reader = FrameReader(sock)
+    received = 0
+    while received < count:
+        received += len(reader.read())
+
+
+def bench(vectored, subscribers, rounds, batch):
+    """Frames fanned out, write calls and seconds of one run."""
+    Outbox.vectored = vectored
+    broker = Broker(port=0)
+    port = broker.sock.getsockname()[1]
+    loop = threading.Thread(target=broker.run, daemon=True)
+    loop.start()
+
+    consumers = [socket.create_connection(("localhost", port)) for _ in range(subscribers)]
+    for sock in consumers:
+        PubSub.send_msg(sock, PubSub.subscribe("/bench", PICKLE), PICKLE)
+    publisher = socket.create_connection(("localhost", port))
+    time.sleep(0.2)
+
+    expected = rounds * batch
+    readers = [threading.Thread(target=receive, args=(sock, expected)) for sock in consumers]
+    for reader in readers:
+        reader.start()
+    records = [("/bench/sensor", i) for i in range(batch)]
+    start = time.perf_counter()
+    for _ in range(rounds):
+        PubSub.send_msg(publisher, PubSub.publish_batch(records), PICKLE)
+    for reader in readers:
+        reader.join()
+    elapsed = time.perf_counter() - start
+
+    writes = sum(broker.outboxes[conn].writes for conn in broker.subscriptions["/bench"])
+    broker.canceled = True
+    for sock in consumers + [publisher]:
+        sock.close()  # wakes the loop up to see canceled
+    loop.join(timeout=5)
+    broker.sel.close()
+    broker.sock.close()
+    Outbox.vectored = True
+    return expected * subscribers, writes, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subscribers", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=50, help="records per publish_batch frame")
+    args = parser.parse_args()
+
+    print(f"{'writes':<10}{'frames':>9}{'syscalls':>10}{'frames/call':>13}{'seconds':>9}")
+    for name, vectored in [("send", False), ("sendmsg", True)]:
+        frames, writes, elapsed = bench(vectored, args.subscribers, args.rounds, args.batch)
+        print(f"{name:<10}{frames:>9}{writes:>10}{frames / writes:>13.1f}{elapsed:>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
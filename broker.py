@@ -1,7 +1,147 @@
 """Call broker."""
+import argparse
 
+from src.async_broker import AsyncBroker
 from src.broker import Broker
+from src.groups import GroupStrategy
+from src.log import add_arguments, configure_from
+from src.metrics import serve_http
+from src.profiling import DEFAULT_INTERVAL, Profiler
+from src.retention import Retention
+from src.storage import TopicLog
+from src.workers import run_workers
+
+DEFAULT_LOG_MAX_BYTES = 1024 ** 3
+DEFAULT_LOG_MAX_AGE = 7 * 24 * 3600.0
+
+ENGINES = {
+    "selectors": Broker,
+    "asyncio": AsyncBroker,
+}
+
+
+def prefix_ttl(option):
+    """Parse a --retain-ttl PREFIX=SECONDS option."""
+    prefix, _, seconds = option.rpartition("=")
+    try:
+        ttl = float(seconds)
+    except ValueError:
+        ttl = None
+    if not prefix or ttl is None or ttl <= 0:
+        raise argparse.ArgumentTypeError(f"expected PREFIX=SECONDS, got {option}")
+    return prefix, ttl
+
 
 if __name__ == "__main__":
-    broker = Broker()
-    broker.run()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", help="address to listen on", default="localhost")
+    parser.add_argument("--port", help="port to listen on", type=int, default=5000)
+    parser.add_argument(
+        "--engine",
+        help="event loop implementation",
+        choices=list(ENGINES.keys()),
+        default=list(ENGINES.keys())[0],
+    )
+    parser.add_argument(
+        "--workers",
+        help="number of broker processes sharing the port (selectors engine)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--log-dir",
+        help="directory of the durable publish log (disabled by default)",
+        default=None,
+    )
+    parser.add_argument(
+        "--log-max-bytes",
+        help="compact the durable log once it is larger than this",
+        type=int,
+        default=DEFAULT_LOG_MAX_BYTES,
+    )
+    parser.add_argument(
+        "--log-max-age",
+        help="compact the segments of the durable log older than this many seconds",
+        type=float,
+        default=DEFAULT_LOG_MAX_AGE,
+    )
+    parser.add_argument(
+        "--group-strategy",
+        help="how consumer groups pick the member getting a message",
+        choices=[strategy.name.lower() for strategy in GroupStrategy],
+        default="round_robin",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        help="serve Prometheus metrics over HTTP at /metrics on this port "
+             "(worker i of --workers uses port + i)",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--profile",
+        help="sample the broker stacks and time its stages, written to this directory "
+             "(default .) on SIGUSR1 and at exit",
+        nargs="?",
+        const=".",
+        default=None,
+    )
+    parser.add_argument(
+        "--profile-interval",
+        help="seconds between stack samples of --profile",
+        type=float,
+        default=DEFAULT_INTERVAL,
+    )
+    parser.add_argument(
+        "--retain-ttl",
+        help="keep the retained values of a topic prefix for SECONDS (repeatable)",
+        metavar="PREFIX=SECONDS",
+        type=prefix_ttl,
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--retain-max-entries",
+        help="retained values kept, the least recently used are evicted",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--retain-max-bytes",
+        help="approximate bytes of retained values kept, the least recently used are evicted",
+        type=int,
+        default=None,
+    )
+    add_arguments(parser)
+    args = parser.parse_args()
+    configure_from(args)
+    profile = None
+    if args.profile is not None:
+        profile = {"directory": args.profile, "interval": args.profile_interval}
+    group_strategy = GroupStrategy[args.group_strategy.upper()]
+    retention = Retention(dict(args.retain_ttl), args.retain_max_entries, args.retain_max_bytes)
+    log_options = {"max_bytes": args.log_max_bytes, "max_age": args.log_max_age}
+
+    if args.workers > 1:
+        if args.engine != "selectors":
+            parser.error("--workers is only supported by the selectors engine")
+        run_workers(
+            args.workers,
+            args.host,
+            args.port,
+            log_dir=args.log_dir,
+            log_options=log_options,
+            metrics_port=args.metrics_port,
+            profile=profile,
+            group_strategy=group_strategy,
+            retention=retention,
+        )
+    else:
+        log = TopicLog(args.log_dir, **log_options) if args.log_dir else None
+        broker = ENGINES[args.engine](args.host, args.port, log=log, group_strategy=group_strategy,
+                                      retention=retention)
+        if args.metrics_port is not None:
+            serve_http(broker.metrics, args.host, args.metrics_port)
+        if profile is not None:
+            Profiler(broker, **profile).start()
+        broker.run()
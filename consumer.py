@@ -2,6 +2,7 @@
 import argparse
 
 from src.clients import Consumer
+from src.log import add_arguments, configure_from
 from producer import q_generator, q_protocol
 
 if __name__ == "__main__":
@@ -19,8 +20,15 @@ if __name__ == "__main__":
         choices=list(q_protocol.keys()),
         default=list(q_protocol.keys())[0],
     )
+    parser.add_argument(
+        "--conflate",
+        help="only receive the newest value of each topic when falling behind",
+        action="store_true",
+    )
+    add_arguments(parser)
     args = parser.parse_args()
+    configure_from(args)
 
-    c = Consumer(args.topic, q_protocol[args.queue_type])
+    c = Consumer(args.topic, q_protocol[args.queue_type], conflate=args.conflate)
 
     c.run(int(args.length))
@@ -6,6 +6,7 @@ import random
 
 import src.middleware
 from src.clients import Producer
+from src.log import add_arguments, configure_from
 
 
 def _temp():
@@ -65,6 +66,7 @@ q_protocol = {
     "json": src.middleware.JSONQueue,
     "xml": src.middleware.XMLQueue,
     "pickle": src.middleware.PickleQueue,
+    "binary": src.middleware.BinaryQueue,
 }
 
 q_generator = {
@@ -103,7 +105,9 @@ if __name__ == "__main__":
         choices=list(q_protocol.keys()),
         default=list(q_protocol.keys())[0],
     )
+    add_arguments(parser)
     args = parser.parse_args()
+    configure_from(args)
 
     p = Producer(
         q_subtopics[args.topic], q_generator[args.topic], q_protocol[args.queue_type]
@@ -0,0 +1,232 @@
+"""asyncio engine for the PubSub Message Broker."""
+import asyncio
+import time
+
+from .broker import DEFAULT_HISTORY, PUBLISH_COMMANDS, REDELIVERY_INTERVAL, BrokerCore
+from .flow import DEFAULT_ACK_TIMEOUT
+from .groups import GroupStrategy
+from .outbox import DEFAULT_LIMIT, OverflowPolicy, Outbox, OutboxOverflow
+from .protocol import FRAME_V1, FrameReader, PubSubBadFormat
+from .retention import Retention
+from .storage import TopicLog
+
+try:
+    import uvloop
+except ImportError:  # optional, the default asyncio loop is used without it
+    uvloop = None
+
+
+WRITE_HIGH_WATER = 256 * 1024  # transport buffer size that pauses writing
+CANCEL_POLL = 0.2  # seconds between checks of AsyncBroker.canceled
+
+
+class BrokerProtocol(asyncio.Protocol):
+    """One client connection of the AsyncBroker."""
+
+    def __init__(self, broker: "AsyncBroker"):
+        """Initialize connection state."""
+        self.broker = broker
+        self.transport = None
+        self.reader = FrameReader(None, lazy=True, observe=broker.frame_received)
+        self.outbox = Outbox(self, broker.outbox_limit, broker.overflow_policy)
+        self.batch = []  # frames written during this loop iteration, see flush()
+        self.batched = 0  # bytes in batch
+        self.writable = True  # False while the transport buffer is over its high-water mark
+
+    def connection_made(self, transport):
+        started = time.perf_counter()
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self.broker.write_high_water)
+        self.broker.connections.add(self)
+        if self.broker.stage_seconds is not None:
+            self.broker.stage_seconds.observe(time.perf_counter() - started, ("accept",))
+
+    def data_received(self, data):
+        started = time.perf_counter()
+        try:
+            messages = self.reader.feed(data)
+        except PubSubBadFormat:
+            # the stream can not be resynchronized after a bad frame
+            self.transport.abort()
+            return
+        published = False
+        for message in messages:
+            try:
+                self.broker.dispatch(self, message)
+            except PubSubBadFormat:
+                # a routed publish whose body does not decode, drop its sender
+                self.transport.abort()
+                return
+            published = published or message.command in PUBLISH_COMMANDS
+        if published and self.broker.congested and self not in self.broker.congested:
+            # congested connections keep being read, their acks relieve them
+            self.broker.pause(self)
+        self.broker.loop_seconds.observe(time.perf_counter() - started)
+
+    def connection_lost(self, exc):
+        self.broker.disconnect(self)
+
+    def pause_writing(self):
+        self.writable = False
+
+    def resume_writing(self):
+        self.writable = True
+        self.drain()
+
+    def write(self, frame: bytes, key=None):
+        """Write frame, queueing it in the outbox while the transport is paused.
+
+        Only queued frames can be replaced by a newer frame with the same key."""
+        if self.writable and not self.outbox:
+            if not self.batch:
+                asyncio.get_running_loop().call_soon(self.flush)
+            self.batch.append(frame)
+            self.batched += len(frame)
+        else:
+            self.outbox.push(frame, key)
+
+    def flush(self):
+        """Hand the frames written during the last loop iteration to the transport at once."""
+        batch, self.batch, self.batched = self.batch, [], 0
+        if not self.transport.is_closing():
+            started = time.perf_counter()
+            self.transport.writelines(batch)
+            if self.broker.stage_seconds is not None:
+                self.broker.stage_seconds.observe(time.perf_counter() - started, ("send",))
+
+    def drain(self):
+        """Move queued frames to the transport until it asks to pause again."""
+        while self.outbox and self.writable:
+            self.transport.write(self.outbox.popleft())
+        if not self.outbox.full:
+            self.broker.decongest(self)
+            if self.writable and self.broker.drained is not None:
+                self.broker.drained.set()  # wakes up the replays waiting for room
+
+
+class AsyncBroker(BrokerCore):
+    """PubSub Message Broker running on asyncio (uvloop when installed)."""
+
+    def __init__(self, host: str = "localhost", port: int = 5000,
+                 outbox_limit: int = DEFAULT_LIMIT,
+                 overflow_policy: OverflowPolicy = OverflowPolicy.BLOCK,
+                 write_high_water: int = WRITE_HIGH_WATER, log: TopicLog = None,
+                 history_size: int = DEFAULT_HISTORY,
+                 group_strategy: GroupStrategy = GroupStrategy.ROUND_ROBIN,
+                 ack_timeout: float = DEFAULT_ACK_TIMEOUT, retention: Retention = None):
+        """Initialize broker."""
+        super().__init__(log, history_size, group_strategy, ack_timeout, retention)
+        print("Broker initialized")
+        self.canceled = False
+        self._host = host
+        self._port = port
+        self.outbox_limit = outbox_limit
+        self.overflow_policy = overflow_policy
+        self.write_high_water = write_high_water
+        self.connections = set()
+        self.paused = set()  # publishers not read until congestion clears
+        self.drained = None  # asyncio.Event set when a connection has room again, see serve()
+
+    def version_of(self, conn) -> int:
+        """Frame version spoken by conn, detected from its first frame."""
+        return conn.reader.version or FRAME_V1
+
+    def deliver(self, conn, frame: bytes, key=None):
+        """Write an already encoded frame to conn."""
+        try:
+            conn.write(frame, key)
+        except OutboxOverflow:
+            # connection_lost runs later, after the current fan-out
+            conn.transport.abort()
+            return
+        self.frame_sent(frame)
+        if conn.outbox.full and conn.outbox.policy == OverflowPolicy.BLOCK:
+            self.congested.add(conn)
+
+    def backlogged(self, conn) -> bool:
+        """True while conn is paused by its transport or its outbox is full."""
+        return not conn.writable or conn.outbox.full
+
+    def outstanding(self, conn) -> int:
+        """Bytes buffered by the transport and the outbox of conn."""
+        return conn.transport.get_write_buffer_size() + conn.batched + conn.outbox.nbytes
+
+    def queue_depths(self):
+        """Number of frames waiting to be written, per connection."""
+        # copied first, the metrics endpoint reads it from its own thread
+        return {conn: conn.outbox.depth for conn in list(self.connections)}
+
+    def peer_name(self, conn) -> str:
+        """host:port of the client on conn."""
+        peer = conn.transport.get_extra_info("peername")
+        return f"{peer[0]}:{peer[1]}" if peer else f"connection {id(conn)}"
+
+    def pause(self, publisher: BrokerProtocol):
+        """Stop reading from publisher until congestion clears."""
+        if publisher not in self.paused:
+            self.paused.add(publisher)
+            publisher.transport.pause_reading()
+
+    def decongest(self, conn: BrokerProtocol):
+        """Resume the publishers once no connection is congested."""
+        if conn not in self.congested:
+            return
+        if conn in self.connections and (conn.outbox.full or self.holding(conn)):
+            return
+        self.congested.discard(conn)
+        if not self.congested:
+            paused, self.paused = self.paused, set()
+            for publisher in paused:
+                if not publisher.transport.is_closing():
+                    publisher.transport.resume_reading()
+
+    def drop(self, conn: BrokerProtocol):
+        """Close conn, connection_lost drops its subscriptions."""
+        conn.transport.abort()
+
+    def disconnect(self, conn: BrokerProtocol):
+        """Drop every subscription held by conn."""
+        self.forget(conn)
+        self.connections.discard(conn)
+        self.paused.discard(conn)
+        self.decongest(conn)
+
+    async def serve(self):
+        """Accept connections until canceled."""
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(
+            lambda: BrokerProtocol(self), self._host, self._port,
+            reuse_address=True, backlog=1024,
+        )
+        self.drained = asyncio.Event()  # created in the running loop
+        async with server:
+            while not self.canceled:
+                interval = REDELIVERY_INTERVAL if self.reliable else CANCEL_POLL
+                if self.replaying():
+                    # one replay batch per turn, between the connection callbacks
+                    self.catch_up()
+                    await asyncio.sleep(0)
+                elif self.replays:
+                    # every replay waits for its connection to drain
+                    self.drained.clear()
+                    try:
+                        await asyncio.wait_for(self.drained.wait(), interval)
+                    except asyncio.TimeoutError:
+                        pass
+                else:
+                    await asyncio.sleep(interval)
+                if self.reliable:
+                    self.redeliver()
+                if self.topics.expiring:
+                    self.expire_retained()
+                if self.log is not None:
+                    self.log.sync()
+                    self.log.age_out()
+        if self.log is not None:
+            self.log.close()
+
+    def run(self):
+        """Run until canceled."""
+        if uvloop is not None:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        asyncio.run(self.serve())
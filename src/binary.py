@@ -0,0 +1,174 @@
+"""Compact binary serialization for protocol messages.
+
+A message is encoded as
+
+    command (1 byte) + topic size (2 bytes) + topic (utf-8) + value
+
+and values are tagged with one byte followed by their fixed or length
+prefixed representation (all integers big endian)."""
+import struct
+from typing import Any, Tuple
+
+
+COMMANDS = ["subscribe", "publish", "req_list", "list_topics", "cancel", "publish_batch",
+            "credit", "ack", "stats"]
+COMMAND_CODES = {command: code for code, command in enumerate(COMMANDS)}
+
+HEAD = struct.Struct("!BH")
+NO_TOPIC = 0xFFFF  # topic size used for messages without topic
+
+# value tags
+NONE = ord("N")
+TRUE = ord("T")
+FALSE = ord("F")
+INT8 = ord("b")
+INT32 = ord("i")
+INT64 = ord("q")
+BIGINT = ord("n")  # decimal string, for ints that do not fit in 64 bits
+FLOAT = ord("d")
+STR = ord("s")
+BYTES = ord("y")
+LIST = ord("l")
+MAP = ord("m")
+
+_INT8 = struct.Struct("!Bb")
+_INT32 = struct.Struct("!Bi")
+_INT64 = struct.Struct("!Bq")
+_FLOAT = struct.Struct("!Bd")
+_SIZED = struct.Struct("!BI")  # tag + size of str, bytes, list and map values
+_FIXED = {INT8: _INT8, INT32: _INT32, INT64: _INT64, FLOAT: _FLOAT}
+_CONSTANTS = {NONE: None, TRUE: True, FALSE: False}
+_unpack_head = HEAD.unpack_from
+
+
+class BinaryDecodeError(ValueError):
+    """Raised on malformed binary payloads."""
+
+
+class BinaryEncodeError(TypeError):
+    """Raised for values the binary format can not represent."""
+
+
+# what malformed payloads raise while decoding, reported as BinaryDecodeError:
+# bad BIGINT digits (ValueError), unhashable MAP keys (TypeError), nesting
+# deeper than the interpreter allows (RecursionError)
+_DECODE_ERRORS = (struct.error, IndexError, UnicodeDecodeError, ValueError, TypeError, RecursionError)
+
+
+def pack(command: str, topic: str = None, value: Any = None) -> bytes:
+    """Encode a message."""
+    out = bytearray()
+    if topic is None:
+        out += HEAD.pack(COMMAND_CODES[command], NO_TOPIC)
+    else:
+        encoded = topic.encode("utf-8")
+        out += HEAD.pack(COMMAND_CODES[command], len(encoded))
+        out += encoded
+    _pack_value(out, value)
+    return bytes(out)
+
+
+def unpack(payload) -> Tuple[str, str, Any]:
+    """Decode a message into (command, topic, value)."""
+    payload = bytes(payload)
+    try:
+        code, size = _unpack_head(payload, 0)
+        offset = HEAD.size
+        if size == NO_TOPIC:
+            topic = None
+        else:
+            topic = payload[offset:offset + size].decode("utf-8")
+            offset += size
+        value, offset = _unpack_value(payload, offset)
+        return COMMANDS[code], topic, value
+    except _DECODE_ERRORS as err:
+        raise BinaryDecodeError(str(err)) from err
+
+
+def dumps(value: Any) -> bytes:
+    """Encode a single value."""
+    out = bytearray()
+    _pack_value(out, value)
+    return bytes(out)
+
+
+def loads(payload) -> Any:
+    """Decode a single value."""
+    try:
+        return _unpack_value(bytes(payload), 0)[0]
+    except _DECODE_ERRORS as err:
+        raise BinaryDecodeError(str(err)) from err
+
+
+def _pack_value(out: bytearray, value: Any):
+    # bool is checked before int, it is a subclass of it
+    if value is None:
+        out.append(NONE)
+    elif value is True:
+        out.append(TRUE)
+    elif value is False:
+        out.append(FALSE)
+    elif isinstance(value, int):
+        if -0x80 <= value < 0x80:
+            out += _INT8.pack(INT8, value)
+        elif -0x80000000 <= value < 0x80000000:
+            out += _INT32.pack(INT32, value)
+        elif -0x8000000000000000 <= value < 0x8000000000000000:
+            out += _INT64.pack(INT64, value)
+        else:
+            encoded = str(value).encode("ascii")
+            out += _SIZED.pack(BIGINT, len(encoded))
+            out += encoded
+    elif isinstance(value, float):
+        out += _FLOAT.pack(FLOAT, value)
+    elif isinstance(value, str):
+        encoded = value.encode("utf-8")
+        out += _SIZED.pack(STR, len(encoded))
+        out += encoded
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        out += _SIZED.pack(BYTES, len(value))
+        out += value
+    elif isinstance(value, (list, tuple)):
+        out += _SIZED.pack(LIST, len(value))
+        for item in value:
+            _pack_value(out, item)
+    elif isinstance(value, dict):
+        out += _SIZED.pack(MAP, len(value))
+        for key, item in value.items():
+            _pack_value(out, key)
+            _pack_value(out, item)
+    else:
+        raise BinaryEncodeError(f"can not encode {type(value).__name__} values")
+
+
+def _unpack_value(payload: bytes, offset: int) -> Tuple[Any, int]:
+    tag = payload[offset]
+    fixed = _FIXED.get(tag)
+    if fixed is not None:
+        return fixed.unpack_from(payload, offset)[1], offset + fixed.size
+    if tag in _CONSTANTS:
+        return _CONSTANTS[tag], offset + 1
+
+    _, size = _SIZED.unpack_from(payload, offset)
+    offset += _SIZED.size
+    if tag in (STR, BYTES, BIGINT) and offset + size > len(payload):
+        raise BinaryDecodeError("truncated value")
+    if tag == STR:
+        return payload[offset:offset + size].decode("utf-8"), offset + size
+    if tag == BYTES:
+        return payload[offset:offset + size], offset + size
+    if tag == BIGINT:
+        return int(payload[offset:offset + size]), offset + size
+    if tag == LIST:
+        items = []
+        for _ in range(size):
+            item, offset = _unpack_value(payload, offset)
+            items.append(item)
+        return items, offset
+    if tag == MAP:
+        items = {}
+        for _ in range(size):
+            key, offset = _unpack_value(payload, offset)
+            items[key], offset = _unpack_value(payload, offset)
+        return items, offset
+    raise BinaryDecodeError(f"unknown value tag {tag!r}")
@@ -2,11 +2,22 @@
 import logging
 import enum
 import socket
-from typing import Dict, List, Any, Tuple
+from typing import Dict, Iterable, List, Any, Tuple
 import selectors
-from .protocol import PubSub
+import time
+from collections import deque
+from itertools import islice
+from .outbox import DEFAULT_LIMIT, OverflowPolicy, Outbox, OutboxOverflow
+from .protocol import (FORMAT_NAMES, FRAME_V1, FRAME_V2, JSON, PICKLE, FrameReader, FrameTooLarge,
+                       PubSub, PubSubBadFormat, frame_format, unwrap)
+from .flow import DEFAULT_ACK_TIMEOUT, Flow
+from .groups import ConsumerGroup, GroupStrategy
+from .metrics import COUNT_BUCKETS, Metrics
+from .retention import EXPIRY_INTERVAL, Retention, RetainedValues
+from .storage import AGE_CHECK_INTERVAL, TopicLog
+from .topics import TopicTrie, compile_filter, is_pattern
 
-logging.basicConfig(filename="broker.log", level=logging.DEBUG)
+logger = logging.getLogger(__name__)
 
 class Serializer(enum.Enum):
     """Possible message serializers."""
@@ -14,91 +25,274 @@ class Serializer(enum.Enum):
     JSON = 0
     XML = 1
     PICKLE = 2
+    BINARY = 3
 
 
-class Broker:
-    """Implementation of a PubSub Message Broker."""
+PUBLISH_COMMANDS = ("publish", "publish_batch")  # what makes a connection a publisher
+DEFAULT_HISTORY = 10000  # publishes kept in memory for replay subscriptions
+REPLAY_BATCH = 100  # records per replay frame
+REPLAY_SCAN = 1000  # backlog records examined per replay, per loop iteration
+REDELIVERY_INTERVAL = 0.1  # seconds between checks for unacked messages
 
-    def __init__(self):
-        """Initialize broker."""
-        print("Broker initialized")
-        self.canceled = False
-        self._host = "localhost"
-        self._port = 5000
-        self.topics = {}
-        self.subscriptions = {}
 
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.bind((self._host, self._port))
-        self.sock.listen(100)
+class SubscriptionRefused(Exception):
+    """Raised for a subscription the broker can not serve, its connection is closed."""
 
-        self.sel = selectors.DefaultSelector()
-        self.sel.register(self.sock, selectors.EVENT_READ, self.accept)
 
-    def accept(self, sock, mask):
-        conn, addr = sock.accept() # Should be ready
-        conn.setblocking(False)
-        self.sel.register(conn, selectors.EVENT_READ, self.read)
-        #Regista ações no respetivo ficheiro
-        # logging.debug(f"Accepted connection from {addr}")
+class Replay:
+    """Position of a subscriber catching up on the backlog of its topic."""
 
-    def read(self, conn, mask):
+    def __init__(self, topic: str, _format, offset: int, since: float = None):
+        """Initialize cursor."""
+        self.topic = topic
+        self.format = _format
+        self.offset = offset  # next backlog offset to examine
+        self.since = since  # skip records older than this timestamp
+        self.matcher = compile_filter(topic)
+
+    def matches(self, topic: str, timestamp: float) -> bool:
+        """True if the record belongs to the replayed topics and time range."""
+        if self.since is not None and timestamp < self.since:
+            return False
+        return self.matcher(topic)
+
+
+class BrokerCore:
+    """Routing core of the broker: retained values, subscriptions and fan-out.
+
+    Transports subclass it and implement deliver() and version_of() for their
+    connection objects."""
+
+    overflow_policy = OverflowPolicy.BLOCK  # for held messages too, set by the engines
+
+    def __init__(self, log: TopicLog = None, history_size: int = DEFAULT_HISTORY,
+                 group_strategy: GroupStrategy = GroupStrategy.ROUND_ROBIN,
+                 ack_timeout: float = DEFAULT_ACK_TIMEOUT, retention: Retention = None):
+        """Initialize routing state.
+
+        With a log every publish is made durable and the retained values are
+        restored from it. The last history_size publishes are also kept in
+        memory, replay subscriptions read older ones from the log.
+        group_strategy picks the member of a consumer group getting a message
+        and at least once subscriptions get messages again when they are not
+        acked within ack_timeout seconds. retention limits the retained values
+        kept (unlimited by default)."""
+        self.log = log
+        self.topics = RetainedValues(retention, self.evicted)
+        self.next_offset = 0 if log is None else log.next_offset
+        self.history = deque(maxlen=history_size)  # (offset, timestamp, topic, value)
+        self.replays = {}  # (connection, topic) -> Replay still catching up
+        self.subscriptions = {}  # topic -> {connection: format}
+        self.index = TopicTrie()  # topic -> subscribers, shared with self.subscriptions
+        self.patterns = set()  # subscribed topics that are wildcard filters
+        self.conn_topics = {}  # connection -> topics it is subscribed to
+        self.group_strategy = group_strategy
+        self.groups = {}  # topic -> {group name: ConsumerGroup}
+        self.member_groups = {}  # (connection, topic) -> ConsumerGroup it belongs to
+        self.ack_timeout = ack_timeout
+        self.flows = {}  # (connection, topic) -> Flow of subscriptions with credit or acks
+        self.reliable = set()  # (connection, topic) of the at least once flows, see redeliver()
+        self.conflated = set()  # (connection, topic) of subscriptions that want the latest value only
+        self.congested = set()  # connections over their outbox or held messages limit (BLOCK)
+        self._next_redelivery = 0.0
+        self._next_expiry = 0.0
+        self.encode_hits = 0  # fan-out frames reused from the per-publish cache
+        self.encode_misses = 0  # fan-out frames that had to be serialized
+        self.metrics = Metrics()
+        self.stage_seconds = None  # per-stage timings, see enable_stage_timing()
+        self._register_metrics()
+        if log is not None:
+            self.restore_retained()
+
+    def _register_metrics(self):
+        """Create the metrics updated by the broker and the ones read from its state."""
+        metrics = self.metrics
+        self.published = metrics.counter("published_total", "Values published, per topic", ["topic"])
+        self.delivered = metrics.counter(
+            "delivered_total", "Values sent (or held for credit) to subscribers, per subscribed topic",
+            ["topic"])
+        self.fanout = metrics.histogram("fanout_subscribers", "Subscribers reached by one publish",
+                                        COUNT_BUCKETS)
+        self.received_bytes = metrics.counter("received_bytes_total", "Bytes of frames received",
+                                              ["format"])
+        self.sent_bytes = metrics.counter("sent_bytes_total", "Bytes of frames queued for clients",
+                                          ["format"])
+        self.decode_seconds = metrics.histogram("decode_seconds", "Time to decode a received frame",
+                                                labels=["format"])
+        self.encode_seconds = metrics.histogram("encode_seconds", "Time to encode a frame",
+                                                labels=["format"])
+        self.loop_seconds = metrics.histogram("loop_seconds", "Time to handle one event loop wakeup")
+        metrics.gauge("outbox_bytes", "Bytes waiting to be written, per connection",
+                      lambda: {(self.peer_name(conn),): self.outstanding(conn)
+                               for conn in self.queue_depths()}, ["connection"])
+        metrics.gauge("outbox_frames", "Frames waiting to be written, per connection",
+                      lambda: {(self.peer_name(conn),): depth
+                               for conn, depth in self.queue_depths().items()}, ["connection"])
+        metrics.gauge("encode_cache_hits_total", "Fan-out frames reused from the per-publish cache",
+                      lambda: {(): self.encode_hits}, kind="counter")
+        metrics.gauge("encode_cache_misses_total", "Fan-out frames that had to be serialized",
+                      lambda: {(): self.encode_misses}, kind="counter")
+        metrics.gauge("topics", "Topics with a retained value", lambda: {(): len(self.topics)})
+        metrics.gauge("retained_bytes", "Approximate bytes of the retained values",
+                      lambda: {(): self.topics.nbytes})
+        metrics.gauge("retained_evicted_total", "Retained values dropped, per reason (ttl, entries, bytes)",
+                      lambda: {(reason,): count for reason, count in dict(self.topics.evicted).items()},
+                      ["reason"], kind="counter")
+        metrics.gauge("subscriptions", "Subscriptions, per subscribed topic",
+                      lambda: {(topic,): len(subscribers)
+                               for topic, subscribers in list(self.subscriptions.items())}, ["topic"])
+        metrics.gauge("replays", "Replay subscriptions still catching up", lambda: {(): len(self.replays)})
+        metrics.gauge("group_members", "Members of each consumer group",
+                      lambda: {(topic, name): len(group)
+                               for topic, groups in list(self.groups.items())
+                               for name, group in list(groups.items())}, ["topic", "group"])
+
+        def flows():
+            return list(self.flows.values())
+
+        metrics.gauge("flow_inflight", "Messages waiting for an ack, over the current subscriptions",
+                      lambda: {(): sum(len(flow.inflight) + len(flow.sent_offsets) for flow in flows())})
+        metrics.gauge("flow_pending", "Messages held for credit, over the current subscriptions",
+                      lambda: {(): sum(len(flow.pending) for flow in flows())})
+        metrics.gauge("flow_dropped", "Held messages dropped, over the current subscriptions",
+                      lambda: {(): sum(flow.dropped for flow in flows())})
+        metrics.gauge("flow_redelivered", "Messages sent again, over the current subscriptions",
+                      lambda: {(): sum(flow.redelivered for flow in flows())})
+        metrics.gauge("flow_conflated", "Held messages replaced, over the current subscriptions",
+                      lambda: {(): sum(flow.conflated for flow in flows())})
+
+    def enable_stage_timing(self):
+        """Time each stage of the hot path into the stage_seconds histogram.
+
+        The stages are accept, read (receive and decode), decode, route
+        (fan-out, including its encoding), encode and send (see
+        src/profiling.py); the asyncio engine receives in the event loop
+        itself and has no read stage. Off by default, each hook is then a
+        None check."""
+        if self.stage_seconds is None:
+            self.stage_seconds = self.metrics.histogram(
+                "stage_seconds", "Time spent in each stage of the hot path", labels=["stage"])
+
+    def frame_received(self, _format: int, size: int, seconds: float):
+        """Account for a frame decoded by a connection reader (FrameReader observe hook)."""
+        name = (FORMAT_NAMES.get(_format, "unknown"),)
+        self.received_bytes.inc(name, size)
+        self.decode_seconds.observe(seconds, name)
+        if self.stage_seconds is not None:
+            self.stage_seconds.observe(seconds, ("decode",))
+
+    def frame_sent(self, frame: bytes):
+        """Account for a frame queued for a connection."""
+        self.sent_bytes.inc((FORMAT_NAMES.get(frame_format(frame), "unknown"),), len(frame))
+
+    def peer_name(self, conn) -> str:
+        """Label of conn in the metrics."""
+        return str(conn)
+
+    def queue_depths(self) -> dict:
+        """Number of frames waiting to be written, per connection."""
+        return {}
+
+    def stats(self) -> dict:
+        """Snapshot of the metrics, see Metrics.snapshot."""
+        return self.metrics.snapshot()
+
+    def deliver(self, conn, frame: bytes, key=None):
+        """Queue an already encoded frame for conn.
+
+        A frame with a key replaces the queued frame with the same key that
+        was not written yet (see Outbox.push)."""
+        raise NotImplementedError
+
+    def version_of(self, conn) -> int:
+        """Frame version spoken by conn."""
+        raise NotImplementedError
 
+    def outstanding(self, conn) -> int:
+        """Bytes queued for conn that it did not take yet (see GroupStrategy)."""
+        return 0
+
+    def forget(self, conn):
+        """Drop every subscription held by conn."""
+        for topic in list(self.conn_topics.get(conn, ())):
+            self.unsubscribe(topic, conn)
+
+    def send(self, conn, msg, _format):
+        """Queue msg for conn, encoded with _format."""
+        frame = self.encode(msg, _format, self.version_of(conn))
+        if frame is not None:
+            self.deliver(conn, frame)
+
+    def encode(self, msg, _format, version):
+        """Encode msg, None if it can not be sent with that frame version."""
+        started = time.perf_counter()
         try:
-            data = PubSub.recv_msg(conn)
-            if data:
-                command = data.command
+            frame = PubSub.encode(msg, _format, version)
+        except FrameTooLarge as err:
+            logger.warning("Dropping %s to %s: %s", msg.command, getattr(msg, "topic", None), err)
+            return None
+        except PubSubBadFormat:
+            # a routed body is only decoded when another format needs it
+            logger.warning("Dropping %s to %s: value does not decode", msg.command,
+                           getattr(msg, "topic", None))
+            return None
+        except (TypeError, ValueError) as err:
+            # a value the format can not represent, e.g. a date for BINARY or JSON
+            logger.warning("Dropping %s to %s: %s", msg.command, getattr(msg, "topic", None), err)
+            return None
+        elapsed = time.perf_counter() - started
+        self.encode_seconds.observe(elapsed, (FORMAT_NAMES.get(_format, "unknown"),))
+        if self.stage_seconds is not None:
+            self.stage_seconds.observe(elapsed, ("encode",))
+        return frame
 
-                if command == "subscribe":
-                    self.subscribe(data.topic, conn, int(data.format))
+    def encode_hit_ratio(self) -> float:
+        """Fraction of fan-out frames served without serializing again."""
+        total = self.encode_hits + self.encode_misses
+        return self.encode_hits / total if total else 0.0
 
-                elif command == "publish":
-                    self.put_topic(data.topic, data.message)
+    def dispatch(self, conn, data):
+        """Handle one message received from conn."""
+        command = data.command
 
-                elif command == "cancel":
-                    self.unsubscribe(data.topic, conn)
+        if command == "subscribe":
+            self.subscribe(data.topic, conn, int(data.format), getattr(data, "offset", None),
+                           getattr(data, "since", None), getattr(data, "group", None),
+                           getattr(data, "credit", None), getattr(data, "ack", False),
+                           getattr(data, "conflate", False))
 
-                elif command == "list_topics":
-                    self.list_topics(conn)
+        elif command == "publish":
+            self.put_topic(data.topic, data.message)
 
-            else:
-                # print("Connection closed")
-                for topic in self.subscriptions:
-                    for subscriber in self.subscriptions[topic]:
-                        if subscriber[0] == conn:
-                            self.subscriptions[topic].remove(subscriber)
-                            break
-                self.sel.unregister(conn)
-                conn.close()
+        elif command == "publish_batch":
+            for topic, message in data.records:
+                self.put_topic(topic, message)
 
-        
-        except ConnectionResetError:
-            print("Connection closed")
-            for topic in self.subscriptions:
-                for subscriber in self.subscriptions[topic]:
-                    if subscriber[0] == conn:
-                        self.subscriptions[topic].remove(subscriber)
-                        break
-            self.sel.unregister(conn)
-            conn.close()
-            
-        
+        elif command == "cancel":
+            self.unsubscribe(data.topic, conn)
+
+        elif command == "credit":
+            self.grant(conn, data.topic, data.credit)
+
+        elif command == "ack":
+            self.ack(conn, data.topic, data.offset)
+
+        elif command == "stats":
+            # JSON, whatever the client speaks: every reader decodes it
+            self.send(conn, PubSub.stats(self.stats()), JSON)
+
+        elif command == "list_topics":
+            self.list_topics(conn)
 
     def list_topics(self) -> List[str]:
         """Returns a list of strings containing all topics containing values."""
-        topics_list = []
-        for topic in self.topics:
-            if self.topics[topic] is not None:
-                topics_list.append(topic)
-        return topics_list
+        return [topic for topic, _ in self.topics.items(time.monotonic())]
 
 
     def get_topic(self, topic):
         """Returns the currently stored value in topic."""
         print(self.topics)
-        if topic not in self.topics:
-            return None
-        return self.topics[topic]
+        return unwrap(self.topics.get(topic, time.monotonic()))
 
 
     def put_topic(self, topic, value):
@@ -110,62 +304,678 @@ class Broker:
         logging.debug("value: "+ str(value))
         """
         # print("topic: "+ topic + " value: "+ str(value))
-        self.topics[topic] = value
-        for curTopic in self.topics:
-            # logging.debug("curTopic: " + curTopic)
-            if topic.startswith(curTopic + "/") or topic == curTopic:
-                # logging.debug("curTopic is a prefix of topic")
-                if curTopic in self.subscriptions:
-                    # logging.debug("curTopic in subscriptions")
-                    for subscriber in self.subscriptions[curTopic]:
-                        # logging.debug("Subscriber found")
-                        PubSub.send_msg(subscriber[0], PubSub.publish(value, curTopic), subscriber[1])
-                # else:
-                    # logging.debug("curTopic not in subscriptions")
+        started = time.perf_counter() if self.stage_seconds is not None else None
+        timestamp = time.time()
+        if self.log is not None:
+            # decodes the value, a bad one raises before anything is kept
+            offset = self.log.append(topic, unwrap(value), timestamp)
+        else:
+            offset = self.next_offset
+        self.topics.put(topic, value, time.monotonic())
+        self.next_offset = offset + 1
+        self.history.append((offset, timestamp, topic, value))
+        self.published.inc((topic,))
+        reached = 0
+        # topic itself, every ancestor topic and every matching wildcard filter
+        for curTopic, subscribers in self.index.match(topic):
+            sent = 0
+            msg = self.publication(value, curTopic, topic, offset)
+            frames = {}  # (format, version) -> frame, encoded once for all subscribers
+            groups = self.groups.get(curTopic)
+            for subscriber in subscribers.items():
+                if self.replays and (subscriber[0], curTopic) in self.replays:
+                    continue  # still catching up, the replay reaches this record later
+                if groups and (subscriber[0], curTopic) in self.member_groups:
+                    continue  # its group delivers to one member below
+                frame = self.cached_frame(msg, (subscriber[1], self.version_of(subscriber[0])), frames)
+                if frame is None:
+                    continue
+                key = self.conflation_key(subscriber[0], curTopic, topic)
+                flow = self.flows.get((subscriber[0], curTopic)) if self.flows else None
+                if flow is None:
+                    self.deliver(subscriber[0], frame, key)
+                else:
+                    self.flow_deliver(subscriber[0], flow, offset, value, frame, key, msg.subscription and topic)
+                sent += 1
+            if groups:
+                for group in groups.values():
+                    self.group_deliver(group, msg, frames, value, topic)
+                sent += len(groups)
+            if sent:
+                self.delivered.inc((curTopic,), sent)
+                reached += sent
+        self.fanout.observe(reached)
+        if started is not None:
+            self.stage_seconds.observe(time.perf_counter() - started, ("route",))
         """
         logging.debug("put_topic END!!!")
         logging.debug("-----")
         """
 
 
+    def publication(self, value, subscribed: str, topic: str, offset: int = None):
+        """Publish message of value, published on topic, for the subscriptions to subscribed.
+
+        Wildcard subscriptions get topic along with the filter they
+        subscribed, clients route by the filter; the others get their
+        subscribed topic."""
+        if subscribed in self.patterns:
+            return PubSub.publish(value, topic, offset, subscribed)
+        return PubSub.publish(value, subscribed, offset)
+
+    def cached_frame(self, msg, key, frames):
+        """Frame of msg for key = (format, version), encoded once per publish."""
+        if key in frames:
+            self.encode_hits += 1
+            return frames[key]
+        self.encode_misses += 1
+        frame = frames[key] = self.encode(msg, *key)
+        return frame
+
+    def conflation_key(self, conn, subscribed: str, topic: str):
+        """Outbox key of a publish on topic sent to a subscription of conn.
+
+        None unless the subscription conflates; the key keeps the values of
+        different subtopics apart."""
+        if self.conflated and (conn, subscribed) in self.conflated:
+            return (subscribed, topic)
+        return None
+
+    def group_deliver(self, group: ConsumerGroup, msg, frames, value, published: str = None):
+        """Deliver msg to one member of group, preferring members with credit.
+
+        published is the topic the value was published on, for conflation."""
+        topic = msg.subscription or msg.topic
+        available = None
+        if self.flows:
+            def available(member):
+                flow = self.flows.get((member, topic))
+                return flow is None or (flow.open and not flow.pending)
+
+        def outstanding(member):
+            flow = self.flows.get((member, topic)) if self.flows else None
+            return self.outstanding(member) if flow is None else flow.outstanding
+
+        member = group.choose(outstanding, available)
+        frame = self.cached_frame(msg, (self.subscriptions[topic][member], self.version_of(member)), frames)
+        if frame is None:
+            return
+        key = self.conflation_key(member, topic, published or topic)
+        flow = self.flows.get((member, topic)) if self.flows else None
+        if flow is None:
+            self.deliver(member, frame, key)
+        else:
+            self.flow_deliver(member, flow, msg.offset, value, frame, key, msg.subscription and msg.topic)
+
+    def flow_deliver(self, conn, flow: Flow, offset: int, value, frame: bytes, key=None,
+                     published: str = None):
+        """Send frame if the subscription has credit, otherwise hold it.
+
+        published is the topic the value was published on, for wildcard
+        subscriptions."""
+        if flow.open and not flow.pending:
+            flow.sent(offset, value, time.monotonic() + self.ack_timeout, published)
+            self.deliver(conn, frame, key)
+        else:
+            try:
+                flow.hold(offset, value, key, published)
+            except OutboxOverflow:
+                self.drop(conn)
+                return
+            if flow.full and flow.policy == OverflowPolicy.BLOCK:
+                self.congested.add(conn)
+
+    def release(self, conn, flow: Flow):
+        """Send the held messages the subscription has credit for."""
+        version = self.version_of(conn)
+        while flow.pending and flow.open:
+            offset, value = flow.pending.popleft()
+            msg = self.publication(value, flow.topic, flow.topic_of(offset), offset)
+            frame = self.encode(msg, flow.format, version)
+            if frame is not None:
+                flow.sent(offset, value, time.monotonic() + self.ack_timeout, msg.subscription and msg.topic)
+                self.deliver(conn, frame)
+        if conn in self.congested:
+            self.decongest(conn)
+
+    def holding(self, conn) -> bool:
+        """True if a subscription of conn holds as many messages as it may."""
+        for topic in self.conn_topics.get(conn, ()):
+            flow = self.flows.get((conn, topic))
+            if flow is not None and flow.full:
+                return True
+        return False
+
+    def decongest(self, conn):
+        """conn may take messages again, resume the publishers if nobody is congested."""
+        self.congested.discard(conn)
+
+    def drop(self, conn):
+        """Close conn, over its limit with the DISCONNECT policy, once the current fan-out is done."""
+        raise NotImplementedError
+
+    def grant(self, conn, topic: str, credit: int):
+        """conn can take credit more messages of topic."""
+        flow = self.flows.get((conn, topic))
+        if flow is not None:
+            flow.grant(credit)
+            self.release(conn, flow)
+
+    def ack(self, conn, topic: str, offset: int):
+        """conn took every message of topic up to offset."""
+        flow = self.flows.get((conn, topic))
+        if flow is not None:
+            flow.ack(offset)
+            self.release(conn, flow)
+
+    def redeliver(self):
+        """Send again the at least once messages whose ack timed out."""
+        now = time.monotonic()
+        if now < self._next_redelivery:
+            return
+        self._next_redelivery = now + REDELIVERY_INTERVAL
+        for conn, topic in list(self.reliable):
+            flow = self.flows[(conn, topic)]
+            for offset, value in flow.expired(now):
+                flow.resent(offset, now + self.ack_timeout)
+                msg = self.publication(value, topic, flow.topic_of(offset), offset)
+                frame = self.encode(msg, flow.format, self.version_of(conn))
+                if frame is not None:
+                    self.deliver(conn, frame)
+
+    def restore_retained(self):
+        """Retain the last value of every topic in the log, aged since it was published.
+
+        Restored in offset order, the oldest first, so the values that were
+        already past their TTL are left out and LRU evicts the oldest."""
+        now, wall = time.monotonic(), time.time()
+        for timestamp, topic, value in self.log.last_records():
+            if not self.topics.put(topic, value, now, max(0.0, wall - timestamp)):
+                self.log.forget(topic)
+
+    def evicted(self, topic: str):
+        """Forget what was only kept for the evicted value of topic.
+
+        Its last record in the log and its per-topic series, which would
+        otherwise grow with every topic ever published (the delivered ones
+        while topic is still subscribed are kept)."""
+        if self.log is not None:
+            self.log.forget(topic)
+        self.published.remove((topic,))
+        if topic not in self.subscriptions:
+            self.delivered.remove((topic,))
+
+    def expire_retained(self):
+        """Drop the retained values past their TTL, at most every EXPIRY_INTERVAL."""
+        now = time.monotonic()
+        if now < self._next_expiry:
+            return
+        self._next_expiry = now + EXPIRY_INTERVAL
+        self.topics.expire(now)
+
     def list_subscriptions(self, topic: str) -> List[Tuple[socket.socket, Serializer]]:
         """Provide list of subscribers to a given topic."""
         print(self.subscriptions)
-        return self.subscriptions[topic]
+        return list(self.subscriptions.get(topic, {}).items())
 
-    def subscribe(self, topic: str, address: socket.socket, _format: Serializer = None):
-        """Subscribe to topic by client in address."""
+    def subscribe(self, topic: str, address: socket.socket, _format: Serializer = None,
+                  offset: int = None, since: float = None, group: str = None,
+                  credit: int = None, ack: bool = False, conflate: bool = False):
+        """Subscribe to topic by client in address.
+
+        Without offset and since the retained value is sent back. Otherwise
+        the backlog of the topic subtree from offset (or published since that
+        timestamp) is replayed by catch_up() before live delivery starts.
+
+        topic may be a filter with "+" and "#" wildcards; it receives the
+        retained values of every matching topic, and every value with the
+        topic it was published on (see publication()). Members of a group receive
+        each publish of the topic once per group.
+
+        With credit (or ack) live messages are flow controlled, see Flow;
+        the retained value and replayed records are not. With conflate a
+        live message still waiting in the outbox of address is replaced by
+        the next one published on the same topic (also while held for
+        credit); at least once subscriptions do not conflate."""
         # logging.debug("Subscribing %s to %s", address, topic)
-        if topic not in self.topics:
-            self.topics[topic] = None
-            self.subscriptions[topic] = [(address, _format)]
-        elif topic not in self.subscriptions:
-            # logging.debug("Subscribed %s to %s", address, topic)
-            self.subscriptions[topic] = [(address, _format)]
-        elif (address, _format) not in self.subscriptions[topic]:
-            # logging.debug("Subscribed %s to %s", address, topic)
-            self.subscriptions[topic].append((address, _format))
-        # else:
-            # logging.debug("Already subscribed %s to %s", address, topic)
+        pattern = is_pattern(topic)
+        if pattern:
+            self.patterns.add(topic)
+        subscribers = self.index.setdefault(topic, {})
+        self.subscriptions[topic] = subscribers
+        # a connection holds one subscription per topic, subscribing again
+        # only changes its format
+        subscribers[address] = _format
+        self.conn_topics.setdefault(address, set()).add(topic)
+        self.leave_group(topic, address)
+        if group is not None:
+            groups = self.groups.setdefault(topic, {})
+            if group not in groups:
+                groups[group] = ConsumerGroup(group, self.group_strategy)
+            groups[group].add(address)
+            self.member_groups[(address, topic)] = groups[group]
+        if credit is not None or ack:
+            self.flows[(address, topic)] = Flow(topic, _format, credit, ack,
+                                                policy=self.overflow_policy)
+        else:
+            self.flows.pop((address, topic), None)
+        if ack:
+            self.reliable.add((address, topic))
+        else:
+            self.reliable.discard((address, topic))
+        if address in self.congested:
+            self.decongest(address)  # the messages held by the replaced flow are gone
+        if conflate and not ack:
+            self.conflated.add((address, topic))
+        else:
+            self.conflated.discard((address, topic))
         # logging.debug(self.subscriptions)
-        if self.topics[topic] is not None:
-            PubSub.send_msg(address, PubSub.publish(self.topics[topic], topic), _format)
+        if offset is not None or since is not None:
+            if offset is None:
+                offset = self.offset_since(since)
+            self.replays[(address, topic)] = Replay(topic, _format, max(offset, 0), since)
+        elif pattern:
+            matches = compile_filter(topic)
+            for stored, value in self.topics.items(time.monotonic()):
+                if value is not None and matches(stored):
+                    self.send(address, PubSub.publish(value, stored, subscription=topic), _format)
+        else:
+            value = self.topics.get(topic, time.monotonic())
+            if value is not None:
+                self.send(address, PubSub.publish(value, topic), _format)
+
+    def offset_since(self, since: float) -> int:
+        """Offset to start a replay of the records published since a timestamp."""
+        if not self.history or self.history[0][1] > since:
+            return 0  # older than the history, the log (if any) is scanned from the start
+        for offset, timestamp, _, _ in self.history:
+            if timestamp >= since:
+                return offset
+        return self.next_offset
+
+    def backlog(self, start: int, limit: int) -> Iterable[Tuple[int, float, str, Any]]:
+        """Up to limit records from offset start on, from memory or the log.
+
+        Without a log, offsets that already left the history are skipped."""
+        if self.history and start >= self.history[0][0]:
+            return islice(self.history, start - self.history[0][0], start - self.history[0][0] + limit)
+        if self.log is not None:
+            return islice(self.log.records(start), limit)
+        return islice(self.history, limit)
+
+    def backlogged(self, conn) -> bool:
+        """True if conn has no room for replayed records right now."""
+        return False
+
+    def replaying(self) -> bool:
+        """True if some replay can send now, its connection is not backlogged."""
+        return any(not self.backlogged(conn) for conn, _ in self.replays)
+
+    def catch_up(self):
+        """Send the next batch of backlog to every replaying subscriber.
+
+        Called once per loop iteration: each replay examines at most
+        REPLAY_SCAN records and sends at most one frame, and replays to full
+        connections wait, so catching up never starves live traffic."""
+        for key, replay in list(self.replays.items()):
+            conn = key[0]
+            if self.backlogged(conn):
+                continue
+            records = []
+            scanned = False
+            for offset, timestamp, topic, value in self.backlog(replay.offset, REPLAY_SCAN):
+                scanned = True
+                replay.offset = offset + 1
+                if replay.matches(topic, timestamp):
+                    try:
+                        value = unwrap(value)
+                    except PubSubBadFormat:
+                        continue  # dropped for live subscribers of other formats too
+                    # records carry the topic live publishes carry
+                    records.append((topic if replay.topic in self.patterns else replay.topic, value))
+                    if len(records) == REPLAY_BATCH:
+                        break
+            if replay.offset >= self.next_offset or not scanned:
+                del self.replays[key]  # caught up, live delivery takes over
+            if records:
+                self.send(conn, PubSub.publish_batch(records, replay.topic), replay.format)
 
 
     def unsubscribe(self, topic, address):
         """Unsubscribe to topic by client in address."""
-        for sub in self.subscriptions[topic]:
-            if sub[0] == address:
-                self.subscriptions[topic].remove(sub)
-                # logging.debug("Unsubscribed %s from %s", address, topic)
+        subscribers = self.subscriptions.get(topic)
+        if subscribers is None or address not in subscribers:
+            # logging.debug("Not subscribed %s to %s", address, topic)
+            return
+        del subscribers[address]
+        self.replays.pop((address, topic), None)
+        flow = self.flows.pop((address, topic), None)
+        self.reliable.discard((address, topic))
+        self.conflated.discard((address, topic))
+        group = self.member_groups.get((address, topic))
+        self.leave_group(topic, address)
+        if flow is not None and group:
+            # the rest of the group takes over what address did not take
+            unacked = flow.unacked() if flow.at_least_once else list(flow.pending)
+            for offset, value in unacked:
+                published = flow.topic_of(offset)
+                self.group_deliver(group, self.publication(value, topic, published, offset), {}, value,
+                                   published)
+        if not subscribers:
+            del self.subscriptions[topic]
+            self.index.pop(topic)
+            self.patterns.discard(topic)
+            if topic not in self.topics:
+                self.delivered.remove((topic,))
+        topics = self.conn_topics[address]
+        topics.discard(topic)
+        if not topics:
+            del self.conn_topics[address]
+        if flow is not None and address in self.congested:
+            self.decongest(address)  # its held messages no longer count
+        # logging.debug("Unsubscribed %s from %s", address, topic)
+
+    def leave_group(self, topic, address):
+        """Remove address from its group on topic, the other members take over."""
+        group = self.member_groups.pop((address, topic), None)
+        if group is None:
+            return
+        group.remove(address)
+        if not group:
+            groups = self.groups[topic]
+            del groups[group.name]
+            if not groups:
+                del self.groups[topic]
+
+
+class Broker(BrokerCore):
+    """Implementation of a PubSub Message Broker."""
+
+    def __init__(self, host: str = "localhost", port: int = 5000,
+                 outbox_limit: int = DEFAULT_LIMIT,
+                 overflow_policy: OverflowPolicy = OverflowPolicy.BLOCK,
+                 reuse_port: bool = False, peers: Iterable[socket.socket] = (),
+                 log: TopicLog = None, history_size: int = DEFAULT_HISTORY,
+                 group_strategy: GroupStrategy = GroupStrategy.ROUND_ROBIN,
+                 ack_timeout: float = DEFAULT_ACK_TIMEOUT, retention: Retention = None):
+        """Initialize broker.
+
+        peers are channels to other brokers sharing the same topics (see
+        src/workers.py): publishes received from clients are forwarded to
+        them and publishes relayed by them are only routed locally."""
+        super().__init__(log, history_size, group_strategy, ack_timeout, retention)
+        print("Broker initialized")
+        self.canceled = False
+        self._host = host
+        self._port = port
+        self.readers = {}  # connection -> FrameReader
+        self.outboxes = {}  # connection -> Outbox
+        self.outbox_limit = outbox_limit
+        self.overflow_policy = overflow_policy
+        self.interest = {}  # connection -> selector events it is registered for
+        self.paused = set()  # publishers not read until congestion clears
+        self.closing = set()  # connections to drop once the current event is done
+        self.unflushed = set()  # connections given frames during this loop iteration
+        self.peers = set()
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # every worker listens on the same port, the kernel spreads the connections
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.bind((self._host, self._port))
+        self.sock.listen(100)
+
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(self.sock, selectors.EVENT_READ, self.accept)
+        for peer in peers:
+            self.add_connection(peer)
+            self.peers.add(peer)
+
+    def accept(self, sock, mask):
+        started = time.perf_counter()
+        conn, addr = sock.accept() # Should be ready
+        self.add_connection(conn)
+        if self.stage_seconds is not None:
+            self.stage_seconds.observe(time.perf_counter() - started, ("accept",))
+        #Regista ações no respetivo ficheiro
+        # logging.debug(f"Accepted connection from {addr}")
+
+    def add_connection(self, conn):
+        """Serve conn from the event loop."""
+        conn.setblocking(False)
+        if conn.family in (socket.AF_INET, socket.AF_INET6):
+            # frames are already coalesced by flush_writes(), Nagle would only delay them
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.readers[conn] = FrameReader(conn, lazy=True, observe=self.frame_received)
+        self.outboxes[conn] = Outbox(conn, self.outbox_limit, self.overflow_policy)
+        self.update_interest(conn)
+
+    def serve(self, conn, mask):
+        """Selector callback for client connections."""
+        if mask & selectors.EVENT_WRITE:
+            self.write(conn)
+        if mask & selectors.EVENT_READ and conn in self.readers:
+            self.read(conn, mask)
+
+    def read(self, conn, mask):
+        """Dispatch every message received by conn in this wakeup."""
+        reader = self.readers[conn]
+        started = time.perf_counter()
+        try:
+            messages = reader.read()
+        except ConnectionResetError:
+            print("Connection closed")
+            self.disconnect(conn)
+            return
+        except PubSubBadFormat:
+            # the stream can not be resynchronized after a bad frame
+            self.disconnect(conn)
+            return
+        if self.stage_seconds is not None:
+            self.stage_seconds.observe(time.perf_counter() - started, ("read",))
+
+        published = False
+        for data in messages:
+            try:
+                self.dispatch(conn, data)
+            except PubSubBadFormat:
+                # a routed publish whose body does not decode, drop its sender
+                self.disconnect(conn)
                 return
-        # logging.debug("Not subscribed %s to %s", address, topic)
+            except SubscriptionRefused as err:
+                logger.warning("Closing %s: %s", self.peer_name(conn), err)
+                self.disconnect(conn)
+                return
+            published = published or data.command in PUBLISH_COMMANDS
+
+        if reader.closed:
+            # print("Connection closed")
+            self.disconnect(conn)
+        elif published and self.congested and conn not in self.peers and conn not in self.congested:
+            # a BLOCK subscriber is full: stop reading this publisher. Peers
+            # are never paused, two workers waiting on each other would
+            # deadlock, and neither are congested connections, their acks
+            # and credit are what relieves them
+            self.paused.add(conn)
+            self.update_interest(conn)
+
+    def dispatch(self, conn, data):
+        """Handle one message, forwarding client publishes to the peers.
+
+        Workers refuse group subscriptions: each one only knows its own
+        members, so a group spread over workers would get every message
+        once per worker."""
+        if self.peers and data.command == "subscribe" and getattr(data, "group", None) is not None:
+            raise SubscriptionRefused(f"group {data.group} on {data.topic}: groups need a single worker")
+        super().dispatch(conn, data)
+        if self.peers and conn not in self.peers and data.command in PUBLISH_COMMANDS:
+            # the peers are trusted brokers, pickle keeps the value types
+            frame = self.encode(data, PICKLE, FRAME_V2)
+            if frame is not None:
+                for peer in self.peers:
+                    self.deliver(peer, frame)
+
+    def write(self, conn):
+        """Flush the outbox of conn."""
+        outbox = self.outboxes[conn]
+        started = time.perf_counter()
+        try:
+            outbox.flush()
+        except OSError:
+            self.disconnect(conn)
+            return
+        if self.stage_seconds is not None:
+            self.stage_seconds.observe(time.perf_counter() - started, ("send",))
+        if conn in self.congested:
+            self.decongest(conn)
+        self.update_interest(conn)
+
+    def decongest(self, conn):
+        """Resume the publishers once no connection is congested."""
+        outbox = self.outboxes.get(conn)
+        if conn not in self.congested or (outbox is not None and outbox.full) or self.holding(conn):
+            return
+        self.congested.discard(conn)
+        if not self.congested:
+            self.resume()
+
+    def drop(self, conn):
+        """Close conn after the current event."""
+        self.closing.add(conn)
+
+    def resume(self):
+        """Read again from the publishers paused by congestion."""
+        paused, self.paused = self.paused, set()
+        for conn in paused:
+            self.update_interest(conn)
+
+    def update_interest(self, conn):
+        """Register conn for the events it currently needs."""
+        events = 0
+        if conn not in self.paused:
+            events |= selectors.EVENT_READ
+        if self.outboxes[conn]:
+            events |= selectors.EVENT_WRITE
+        current = self.interest.get(conn, 0)
+        if events == current:
+            return
+        if not current:
+            self.sel.register(conn, events, self.serve)
+        elif not events:
+            self.sel.unregister(conn)
+        else:
+            self.sel.modify(conn, events, self.serve)
+        self.interest[conn] = events
+
+    def version_of(self, conn) -> int:
+        """Frame version spoken by conn, detected from its first frame."""
+        reader = self.readers.get(conn)
+        if reader is None or reader.version is None:
+            return FRAME_V1
+        return reader.version
+
+    def deliver(self, conn, frame: bytes, key=None):
+        """Queue an already encoded frame for conn."""
+        outbox = self.outboxes[conn]
+        try:
+            outbox.push(frame, key)
+        except OutboxOverflow:
+            self.closing.add(conn)
+            return
+        self.frame_sent(frame)
+        if outbox.full and outbox.policy == OverflowPolicy.BLOCK:
+            self.congested.add(conn)
+        if not self.interest.get(conn, 0) & selectors.EVENT_WRITE:
+            # written at the end of the loop iteration, with the other frames for conn
+            self.unflushed.add(conn)
+
+    def flush_writes(self):
+        """Write the frames queued during this loop iteration.
+
+        Each connection gets one gathered write for everything it was sent,
+        the ones that can not take it all wait for EVENT_WRITE."""
+        unflushed, self.unflushed = self.unflushed, set()
+        for conn in unflushed:
+            if conn in self.outboxes:
+                self.write(conn)
+
+    def backlogged(self, conn) -> bool:
+        """True if the outbox of conn is full."""
+        outbox = self.outboxes.get(conn)
+        return outbox is not None and outbox.full
+
+    def outstanding(self, conn) -> int:
+        """Bytes waiting in the outbox of conn."""
+        outbox = self.outboxes.get(conn)
+        return 0 if outbox is None else outbox.nbytes
+
+    def queue_depths(self) -> Dict[socket.socket, int]:
+        """Number of frames waiting to be written, per connection."""
+        # copied first, the metrics endpoint reads it from its own thread
+        return {conn: outbox.depth for conn, outbox in list(self.outboxes.items())}
+
+    def peer_name(self, conn) -> str:
+        """host:port of the client on conn."""
+        try:
+            host, port = conn.getpeername()[:2]
+            return f"{host}:{port}"
+        except (OSError, ValueError):  # closed, or a peer channel
+            return f"fd {conn.fileno()}"
+
+    def disconnect(self, conn):
+        """Drop every subscription held by conn and close it."""
+        self.forget(conn)
+        self.peers.discard(conn)
+        self.readers.pop(conn, None)
+        self.outboxes.pop(conn, None)
+        self.unflushed.discard(conn)
+        self.closing.discard(conn)
+        self.paused.discard(conn)
+        if self.interest.pop(conn, 0):
+            self.sel.unregister(conn)
+        conn.close()
+        if conn in self.congested:
+            self.congested.discard(conn)
+            if not self.congested:
+                self.resume()
 
     def run(self):
         """Run until canceled."""
 
         while not self.canceled:
-            events = self.sel.select(timeout=None)
+            timeout = None
+            if self.replaying():
+                timeout = 0  # poll, replays continue on every iteration
+                # replays to backlogged connections wait for EVENT_WRITE instead
+            elif self.reliable:
+                timeout = REDELIVERY_INTERVAL  # wake up to redeliver unacked messages
+            elif self.log is not None and self.log.dirty:
+                timeout = self.log.fsync_interval  # wake up for the pending fsync
+            elif self.topics.expiring:
+                timeout = EXPIRY_INTERVAL  # wake up to drop expired retained values
+            elif self.log is not None and self.log.max_age is not None:
+                timeout = AGE_CHECK_INTERVAL  # wake up to compact old segments
+            events = self.sel.select(timeout=timeout)
+            started = time.perf_counter()
             for key, mask in events:
                 callback = key.data
                 callback(key.fileobj, mask)
+                while self.closing:
+                    self.disconnect(self.closing.pop())
+            if self.replays:
+                self.catch_up()
+            if self.reliable:
+                self.redeliver()
+            if self.topics.expiring:
+                self.expire_retained()
+            while self.closing:
+                self.disconnect(self.closing.pop())
+            if self.unflushed:
+                self.flush_writes()
+            if self.log is not None:
+                self.log.sync()
+                self.log.age_out()
+            self.loop_seconds.observe(time.perf_counter() - started)
+        if self.log is not None:
+            self.log.close()
@@ -1,22 +1,34 @@
 """Prototype broker clients: consumer + producer."""
 from src.log import get_logger
-from src.middleware import PickleQueue, MiddlewareType
+from src.middleware import Connection, PickleQueue, MiddlewareType
 
 
 class Consumer:
     """Consumer implementation"""
 
-    def __init__(self, topic, queue_type=PickleQueue):
-        """Initialize Queue"""
+    def __init__(self, topic, queue_type=PickleQueue, offset=None, since=None, connection=None,
+                 group=None, conflate=False):
+        """Initialize Queue.
+
+        offset or since replay the backlog of the topic before live values,
+        connection is a middleware.Connection shared with other queues,
+        consumers of the same group split the values of the topic and with
+        conflate a slow consumer only gets the newest value of each topic."""
         self.topic = topic
-        self.queue = queue_type(f"{topic}", _type=MiddlewareType.CONSUMER)
+        self.queue = queue_type(f"{topic}", _type=MiddlewareType.CONSUMER, offset=offset,
+                                since=since, connection=connection, group=group,
+                                conflate=conflate)
         self.logger = get_logger(f"Consumer {topic}")
         self.received = []
 
     def run(self, events=10):
         """Consume at most <events> events."""
         for _ in range(events):
-            topic, data = self.queue.pull()
+            try:
+                topic, data = self.queue.pull()
+            except ConnectionError:
+                self.logger.info("Connection to the broker closed")
+                return
             self.logger.info("%s: %s", topic, data)
             self.received.append(data)
 
@@ -24,17 +36,24 @@ class Consumer:
 class Producer:
     """Producer implementation"""
 
-    def __init__(self, topic, value_generator, queue_type=PickleQueue):
-        """Initialize Queue."""
+    def __init__(self, topic, value_generator, queue_type=PickleQueue, max_batch=1, linger=0.0,
+                 multiplex=False):
+        """Initialize Queue.
+
+        max_batch and linger enable auto-batching of the published values,
+        with multiplex the queues of every subtopic share one connection."""
         self.logger = get_logger(f"Producer {topic}")
+        options = {"max_batch": max_batch, "linger": linger}
+        if multiplex:
+            options["connection"] = Connection()
 
         if isinstance(topic, list):
             self.queue = [
-                queue_type(subtopic, _type=MiddlewareType.PRODUCER)
+                queue_type(subtopic, _type=MiddlewareType.PRODUCER, **options)
                 for subtopic in topic
             ]
         else:
-            self.queue = [queue_type(topic, _type=MiddlewareType.PRODUCER)]
+            self.queue = [queue_type(topic, _type=MiddlewareType.PRODUCER, **options)]
         self.produced = []
         self.gen = value_generator
 
@@ -46,3 +65,5 @@ class Producer:
                 self.logger.info("%s: %s", queue.topic, value)
 
                 self.produced.append(value)
+        for queue in self.queue:
+            queue.flush()
@@ -0,0 +1,156 @@
+"""Credit based flow control and acknowledgements of subscriptions."""
+from collections import OrderedDict, deque
+from typing import Any, List, Optional, Tuple
+
+from .outbox import OverflowPolicy, OutboxOverflow
+
+
+DEFAULT_ACK_TIMEOUT = 30.0  # seconds before an unacked message is sent again
+DEFAULT_MAX_PENDING = 10000  # messages held per subscription while it has no credit
+
+
+class Flow:
+    """Flow control state of one (connection, topic) subscription.
+
+    Every message sent uses one credit and stays in flight until the consumer
+    acks its offset (acks are cumulative); acking gives the credit back, as
+    does granting credit explicitly, which forgets the messages in flight. With
+    at_least_once the values in flight are kept to be redelivered. Messages of
+    a wildcard subscription remember the topic they were published on.
+
+    Past max_pending held messages policy applies, as for a full Outbox:
+    BLOCK keeps holding (the broker pauses the publishers), DROP_OLDEST and
+    DROP_NEWEST drop a message and DISCONNECT raises OutboxOverflow."""
+
+    def __init__(self, topic: str, _format, credit: Optional[int], at_least_once: bool = False,
+                 max_pending: int = DEFAULT_MAX_PENDING,
+                 policy: OverflowPolicy = OverflowPolicy.BLOCK):
+        """Initialize flow, credit None is unlimited."""
+        self.topic = topic
+        self.format = _format
+        self.credit = credit
+        self.at_least_once = at_least_once
+        self.inflight = OrderedDict()  # offset -> [deadline, value], in send order (at least once)
+        self.sent_offsets = deque()  # offsets in flight, in send order (credit only)
+        self.pending = deque()  # (offset, value) waiting for credit
+        self.published = {}  # offset -> topic of pending and in flight messages, if not topic
+        self.max_pending = max_pending
+        self.policy = policy
+        self.dropped = 0  # pending messages lost to max_pending
+        self.conflated = 0  # pending messages replaced by a newer one with the same key
+        self._held = {}  # conflation key -> offset of its pending message
+        self.redelivered = 0
+
+    @property
+    def open(self) -> bool:
+        """True if a message may be sent now."""
+        return self.credit is None or self.credit > 0
+
+    @property
+    def full(self) -> bool:
+        """True once max_pending messages are held."""
+        return len(self.pending) >= self.max_pending
+
+    def topic_of(self, offset: int) -> str:
+        """Topic the message at offset was published on."""
+        return self.published.get(offset, self.topic)
+
+    @property
+    def outstanding(self) -> int:
+        """Messages sent and not acked yet, plus the ones held."""
+        return len(self.inflight) + len(self.sent_offsets) + len(self.pending)
+
+    def sent(self, offset: int, value: Any, deadline: float, published: str = None):
+        """Account for a message sent to the consumer."""
+        if self.credit is not None:
+            self.credit -= 1
+        if not self.at_least_once:
+            self.published.pop(offset, None)  # only redeliveries need it
+            self.sent_offsets.append(offset)
+            return
+        self.inflight[offset] = [deadline, value]
+        if published is not None:
+            self.published[offset] = published
+
+    def hold(self, offset: int, value: Any, key=None, published: str = None):
+        """Keep a message until credit is granted.
+
+        A message with a key replaces the pending message with the same key."""
+        if not self.pending:
+            self._held.clear()
+        if key is not None:
+            held = self._held.get(key)
+            if held is not None:
+                for index, (pending, _) in enumerate(self.pending):
+                    if pending == held:
+                        self.pending[index] = (offset, value)
+                        self._held[key] = offset
+                        self.published.pop(held, None)
+                        if published is not None:
+                            self.published[offset] = published
+                        self.conflated += 1
+                        return
+        if self.full:
+            if self.policy == OverflowPolicy.DISCONNECT:
+                raise OutboxOverflow(f"{len(self.pending)} messages held for {self.topic}")
+            if self.policy == OverflowPolicy.DROP_NEWEST:
+                self.dropped += 1
+                return
+            if self.policy == OverflowPolicy.DROP_OLDEST:
+                self.published.pop(self.pending.popleft()[0], None)
+                self.dropped += 1
+        if key is not None:
+            self._held[key] = offset
+        if published is not None:
+            self.published[offset] = published
+        self.pending.append((offset, value))
+
+    def grant(self, credit: int):
+        """Add credit, which replaces the credit acks of the messages in flight give back."""
+        if self.credit is not None:
+            self.credit += credit
+        self.sent_offsets.clear()
+
+    def ack(self, offset: int) -> int:
+        """Acknowledge every message up to offset, returns how many.
+
+        Messages are acked in send order: a redelivered message is only
+        acked once the ones sent before its redelivery are."""
+        acked = 0
+        if self.at_least_once:
+            inflight = self.inflight
+            while inflight:
+                sent = next(iter(inflight))
+                if sent > offset:
+                    break
+                del inflight[sent]
+                self.published.pop(sent, None)
+                acked += 1
+        else:
+            sent_offsets = self.sent_offsets
+            while sent_offsets and sent_offsets[0] <= offset:
+                sent_offsets.popleft()
+                acked += 1
+        if self.credit is not None:
+            self.credit += acked
+        return acked
+
+    def expired(self, now: float) -> List[Tuple[int, Any]]:
+        """(offset, value) of the at least once messages to send again."""
+        expired = []
+        for offset, (deadline, value) in self.inflight.items():
+            if deadline > now:
+                break
+            expired.append((offset, value))
+        return expired
+
+    def resent(self, offset: int, deadline: float):
+        """Account for a redelivered message."""
+        self.inflight[offset][0] = deadline
+        self.inflight.move_to_end(offset)
+        self.redelivered += 1
+
+    def unacked(self) -> List[Tuple[int, Any]]:
+        """(offset, value) of every message not acked yet, in offset order."""
+        inflight = sorted((offset, value) for offset, (_, value) in self.inflight.items())
+        return inflight + [(offset, None) for offset in self.sent_offsets] + list(self.pending)
@@ -0,0 +1,65 @@
+"""Consumer groups: subscribers sharing the messages of a topic."""
+import enum
+from typing import Callable, List, Optional
+
+
+class GroupStrategy(enum.Enum):
+    """How a group picks the member that gets the next message."""
+
+    ROUND_ROBIN = 0
+    # member with the fewest messages sent and not acked or held for credit (its
+    # Flow), or without a flow with the fewest bytes not yet written to it
+    LEAST_OUTSTANDING = 1
+
+
+class ConsumerGroup:
+    """Members of one group subscribed to one topic.
+
+    Every publish routed to the group goes to exactly one member."""
+
+    def __init__(self, name: str, strategy: GroupStrategy = GroupStrategy.ROUND_ROBIN):
+        """Initialize empty group."""
+        self.name = name
+        self.strategy = strategy
+        self.members: List = []
+        self._next = 0  # round-robin position
+
+    def __len__(self):
+        return len(self.members)
+
+    def add(self, conn):
+        """Add conn to the group."""
+        if conn not in self.members:
+            self.members.append(conn)
+
+    def remove(self, conn):
+        """Remove conn, the others take over its share."""
+        index = self.members.index(conn)
+        del self.members[index]
+        if index < self._next:
+            self._next -= 1
+        if self._next >= len(self.members):
+            self._next = 0
+
+    def choose(self, outstanding: Callable[[object], int],
+               available: Optional[Callable[[object], bool]] = None):
+        """Member that gets the next message.
+
+        Members for which available() is False (e.g. out of credit) are only
+        chosen when no member is available."""
+        count = len(self.members)
+        start = self._next
+        if available is None and self.strategy == GroupStrategy.ROUND_ROBIN:
+            self._next = (start + 1) % count
+            return self.members[start]
+        order = [self.members[(start + i) % count] for i in range(count)]
+        candidates = range(count)
+        if available is not None:
+            candidates = [i for i in candidates if available(order[i])] or candidates
+        if self.strategy == GroupStrategy.LEAST_OUTSTANDING:
+            # ties go to the earliest member after the round-robin position
+            best = min(candidates, key=lambda i: (outstanding(order[i]), i))
+        else:
+            best = candidates[0]
+        self._next = (start + best + 1) % count
+        return order[best]
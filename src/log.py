@@ -1,13 +1,189 @@
-"""Common logging configuration."""
+"""Logging of the broker and its clients, with the file I/O off the hot thread.
+
+Importing a module of this package configures nothing; a program calls
+configure() once. It puts a QueueHandler on the root logger, so logging
+from the event loop only enqueues the record, and a QueueListener thread
+formats and writes it. Records below WARNING can be sampled (one of every
+`sample` records of each logging call) and rate limited (at most `rate`
+records a second); warnings and errors always get through. When the queue
+is full records are dropped instead of blocking the caller, and the number
+of dropped records is logged at shutdown."""
+import atexit
 import logging
+import os
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s %(name)-12s %(levelname)-8s %(message)s",
-    datefmt="%m-%d %H:%M:%S",
-)
+FORMAT = "%(asctime)s %(name)-12s %(levelname)-8s %(message)s"
+DATE_FORMAT = "%m-%d %H:%M:%S"
+DEFAULT_QUEUE_SIZE = 10000  # records waiting for the listener before new ones are dropped
+LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
 
 
 def get_logger(module):
     """Get Logger for module."""
     return logging.getLogger(module)
+
+
+class SampleFilter(logging.Filter):
+    """Passes one of every `every` records below WARNING of each logging call."""
+
+    def __init__(self, every: int):
+        """Initialize filter."""
+        super().__init__()
+        self.every = every
+        self.seen = {}  # (file, line) -> records
+        self.dropped = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        site = (record.pathname, record.lineno)
+        count = self.seen.get(site, 0)
+        self.seen[site] = count + 1
+        if count % self.every == 0:
+            return True
+        self.dropped += 1
+        return False
+
+
+class RateLimitFilter(logging.Filter):
+    """Passes at most `rate` records a second below WARNING, in bursts of up to `burst`."""
+
+    def __init__(self, rate: float, burst: float = None):
+        """Initialize filter, burst defaults to one second worth of records."""
+        super().__init__()
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.dropped = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.dropped += 1
+        return False
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that drops the record when the queue is full instead of blocking."""
+
+    def __init__(self, records: queue.Queue):
+        """Initialize handler."""
+        super().__init__(records)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _Setup:
+    """What configure() installed: the root handler, its listener and their options."""
+
+    def __init__(self, target: logging.Handler, filters, queue_size: int):
+        self.target = target
+        self.filters = filters
+        self.queue_size = queue_size
+        self.handler = DroppingQueueHandler(queue.Queue(queue_size))
+        for log_filter in filters:
+            self.handler.addFilter(log_filter)
+        self.listener = QueueListener(self.handler.queue, target, respect_handler_level=True)
+        self.pid = os.getpid()
+
+    def dropped(self) -> dict:
+        counts = {"queue_full": self.handler.dropped}
+        for log_filter in self.filters:
+            name = "sampled" if isinstance(log_filter, SampleFilter) else "rate_limited"
+            counts[name] = log_filter.dropped
+        return counts
+
+
+_setup = None
+
+
+def configure(level: str = "INFO", filename: str = None, sample: int = 1, rate: float = None,
+              queue_size: int = DEFAULT_QUEUE_SIZE) -> None:
+    """Log records of level and above to filename (default stderr) from a listener thread.
+
+    sample > 1 keeps one of every sample records below WARNING of each
+    logging call, rate keeps at most rate records below WARNING a second.
+    Replaces an earlier configure()."""
+    shutdown()
+    target = logging.StreamHandler() if filename is None else logging.FileHandler(filename)
+    target.setFormatter(logging.Formatter(FORMAT, DATE_FORMAT))
+    filters = []
+    if sample > 1:
+        filters.append(SampleFilter(sample))
+    if rate:
+        filters.append(RateLimitFilter(rate))
+    _install(_Setup(target, filters, queue_size))
+    logging.getLogger().setLevel(level)
+
+
+def _install(setup: _Setup):
+    global _setup
+    _setup = setup
+    setup.listener.start()
+    logging.getLogger().addHandler(setup.handler)
+
+
+def dropped() -> dict:
+    """Records dropped so far by sampling, rate limiting and a full queue."""
+    return {} if _setup is None else _setup.dropped()
+
+
+def shutdown():
+    """Write the queued records and stop the listener thread."""
+    global _setup
+    setup, _setup = _setup, None
+    if setup is None:
+        return
+    logging.getLogger().removeHandler(setup.handler)
+    setup.listener.stop()
+    counts = {name: count for name, count in setup.dropped().items() if count}
+    if counts:
+        setup.target.handle(logging.makeLogRecord({
+            "name": __name__, "levelno": logging.INFO, "levelname": "INFO",
+            "msg": "Dropped log records: %s", "args": (counts,),
+        }))
+    setup.target.close()
+
+
+def _after_fork():
+    """Give a forked child (broker workers) its own queue and listener thread."""
+    setup = _setup
+    if setup is None or setup.pid == os.getpid():
+        return
+    logging.getLogger().removeHandler(setup.handler)
+    _install(_Setup(setup.target, setup.filters, setup.queue_size))
+
+
+atexit.register(shutdown)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def add_arguments(parser):
+    """Add the logging options of configure() to an argparse parser."""
+    parser.add_argument("--log-level", help="lowest level logged", choices=LEVELS, default="INFO")
+    parser.add_argument("--log-file", help="file to log to (default stderr)", default=None)
+    parser.add_argument("--log-sample", help="log one of every N records below WARNING of each call",
+                        type=int, default=1)
+    parser.add_argument("--log-rate", help="log at most N records below WARNING a second",
+                        type=float, default=None)
+
+
+def configure_from(args):
+    """configure() with the options added by add_arguments."""
+    configure(args.log_level, args.log_file, args.log_sample, args.log_rate)
@@ -0,0 +1,211 @@
+"""Low overhead broker metrics: counters, gauges and histograms.
+
+Updating a metric is a dictionary lookup and an addition, done by the event
+loop thread; anything that can be read from the broker state (queue depths,
+flow control counters) is a gauge collected only when the metrics are read.
+They are exposed with the `stats` protocol command (Metrics.snapshot) and in
+the Prometheus text format (Metrics.to_prometheus), optionally over HTTP."""
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Sequence, Tuple
+
+# seconds, for encode/decode times and event loop iterations
+TIME_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4,
+                1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0)
+# number of frames, for fan-out sizes
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+Labels = Tuple[str, ...]
+
+
+class Counter:
+    """Monotonic count per combination of label values."""
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        """Initialize counter."""
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, labels: Labels = (), amount: float = 1):
+        """Add amount to the count of labels."""
+        values = self.values
+        values[labels] = values.get(labels, 0) + amount
+
+    def remove(self, labels: Labels):
+        """Drop the count of labels, if any."""
+        self.values.pop(labels, None)
+
+    def samples(self):
+        """(labels, value) of every label combination."""
+        return list(self.values.items())
+
+
+class Gauge:
+    """Value read from the broker state when the metrics are collected.
+
+    collect() returns {labels: value}; kind is "gauge", or "counter" for
+    counts kept by the broker itself."""
+
+    def __init__(self, name: str, help: str, collect: Callable[[], Dict[Labels, float]],
+                 labels: Sequence[str] = (), kind: str = "gauge"):
+        """Initialize gauge."""
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collect = collect
+        self.type = kind
+
+    def samples(self):
+        """(labels, value) of every label combination."""
+        return list(self.collect().items())
+
+
+class Histogram:
+    """Distribution of observed values per combination of label values."""
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = TIME_BUCKETS,
+                 labels: Sequence[str] = ()):
+        """Initialize histogram with the upper bounds of its buckets."""
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values: Dict[Labels, list] = {}  # labels -> [count per bucket (last +Inf), sum]
+
+    def observe(self, value: float, labels: Labels = ()):
+        """Record value."""
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def quantile(self, q: float, labels: Labels = ()) -> float:
+        """Upper bound of the bucket holding the q quantile (inf past the last bound)."""
+        state = self.values.get(labels)
+        if state is None:
+            return 0.0
+        counts = list(state[0])
+        rank = q * sum(counts)
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        """(labels, {"buckets": [[bound, cumulative count]...], "sum", "count"})."""
+        samples = []
+        for labels, (counts, total) in list(self.values.items()):
+            cumulative = 0
+            buckets = []
+            for bound, count in zip(self.buckets + ("+Inf",), list(counts)):
+                cumulative += count
+                buckets.append([bound, cumulative])
+            samples.append((labels, {"buckets": buckets, "sum": total, "count": cumulative}))
+        return samples
+
+
+class Metrics:
+    """Registry of the metrics of a broker."""
+
+    def __init__(self, prefix: str = "broker_"):
+        """Initialize empty registry, prefix is prepended to the exported names."""
+        self.prefix = prefix
+        self.metrics = []
+
+    def add(self, metric):
+        """Register metric, returns it."""
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        """Register a new counter."""
+        return self.add(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float] = TIME_BUCKETS,
+                  labels: Sequence[str] = ()) -> Histogram:
+        """Register a new histogram."""
+        return self.add(Histogram(name, help, buckets, labels))
+
+    def gauge(self, name: str, help: str, collect: Callable[[], Dict[Labels, float]],
+              labels: Sequence[str] = (), kind: str = "gauge") -> Gauge:
+        """Register a new gauge."""
+        return self.add(Gauge(name, help, collect, labels, kind))
+
+    def snapshot(self) -> dict:
+        """Every metric as plain data (what the stats command returns).
+
+        {name: {"type", "help", "samples": [[{label: value}, value], ...]}}"""
+        return {
+            self.prefix + metric.name: {
+                "type": metric.type,
+                "help": metric.help,
+                "samples": [[dict(zip(metric.labels, labels)), value]
+                            for labels, value in metric.samples()],
+            }
+            for metric in self.metrics
+        }
+
+    def to_prometheus(self) -> str:
+        """Every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            name = self.prefix + metric.name
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            for labels, value in metric.samples():
+                pairs = list(zip(metric.labels, labels))
+                if metric.type != "histogram":
+                    lines.append(f"{name}{_labels(pairs)} {value}")
+                    continue
+                for bound, count in value["buckets"]:
+                    lines.append(f"{name}_bucket{_labels(pairs + [('le', bound)])} {count}")
+                lines.append(f"{name}_sum{_labels(pairs)} {value['sum']}")
+                lines.append(f"{name}_count{_labels(pairs)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(pairs) -> str:
+    """Prometheus label set."""
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+def _escape(value) -> str:
+    """Label value with backslashes, quotes and newlines escaped."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def serve_http(metrics: Metrics, host: str = "localhost", port: int = 9100) -> ThreadingHTTPServer:
+    """Serve metrics.to_prometheus() at /metrics from a background thread.
+
+    Returns the server, shutdown() stops it."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.to_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # scrapes are not worth a log line
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -2,11 +2,26 @@
 from collections.abc import Callable
 from enum import Enum
 from queue import LifoQueue, Empty
-from time import sleep
-from typing import Any
+import queue
+from typing import Any, Iterable, List, Optional, Tuple
 import socket
-from .protocol import PubSub
-import selectors
+import threading
+from .protocol import JSON, FrameReader, PubSub
+
+
+DEFAULT_PREFETCH = 1000  # received values buffered ahead of pull()
+_CLOSED = object()  # queued by the reader when the broker closes the connection
+ROUTE_POLL = 0.1  # seconds between checks that a full consumer queue was not closed
+
+
+def broker_stats(host: str = "localhost", port: int = 5000, timeout: float = 5.0) -> dict:
+    """Metrics of the broker at host:port, see Metrics.snapshot."""
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        PubSub.send_msg(sock, PubSub.stats(), JSON)
+        reply = PubSub.recv_msg(sock)
+    if reply is None:
+        raise ConnectionError("broker closed the connection")
+    return reply.stats
 
 
 class MiddlewareType(Enum):
@@ -16,38 +31,251 @@ class MiddlewareType(Enum):
     PRODUCER = 2
 
 
+class Connection:
+    """Socket to the broker, shared by the queues of a process.
+
+    Consumer queues attach to it; a reader thread routes each received value to
+    the queues of the subscription it was sent for: the broker publishes with
+    the subscribed topic, or along with the filter of a wildcard subscription
+    (the topic is then the one the value was published on). A queue whose
+    prefetch buffer is full holds back the other queues of the connection."""
+
+    def __init__(self, host: str = "localhost", port: int = 5000):
+        """Connect to the broker."""
+        self.host = host
+        self.port = port
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.connect((self.host, self.port))
+        # every frame goes out in a single send, do not hold small ones back
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = threading.Lock()  # frames of different queues must not interleave
+        self.routes = {}  # topic -> consumer queues, replaced (not mutated) on change
+        self._routes_lock = threading.Lock()
+        self._reader = None
+        self.closed = False
+
+    def attach(self, consumer: "Queue"):
+        """Route the values received for consumer.topic to consumer."""
+        with self._routes_lock:
+            self.routes[consumer.topic] = self.routes.get(consumer.topic, []) + [consumer]
+            if self.closed:
+                consumer._end()
+            elif self._reader is None:
+                self._reader = threading.Thread(target=self._read, daemon=True)
+                self._reader.start()
+
+    def detach(self, consumer: "Queue") -> bool:
+        """Stop routing to consumer, True if no other queue uses its topic."""
+        with self._routes_lock:
+            consumers = self.routes.get(consumer.topic, [])
+            if consumer not in consumers:
+                return False
+            consumers = [other for other in consumers if other is not consumer]
+            if consumers:
+                self.routes[consumer.topic] = consumers
+                return False
+            self.routes.pop(consumer.topic, None)
+            return True
+
+    def _read(self):
+        """Reader thread: decode messages from the broker into the queues."""
+        reader = FrameReader(self.sock)
+        try:
+            while not reader.closed:
+                for message in reader.read():
+                    if message.command == "publish":
+                        self._route(message.subscription or message.topic, message.topic,
+                                    message.message, message.offset)
+                    elif message.command == "publish_batch":
+                        for topic, value in message.records:
+                            self._route(message.topic or topic, topic, value, None)
+        except OSError:
+            pass  # closed by close() or reset by the broker
+        finally:
+            with self._routes_lock:
+                self.closed = True
+                for consumers in self.routes.values():
+                    for consumer in consumers:
+                        consumer._end()
+
+    def _route(self, subscription: str, topic: str, value: Any, offset: Optional[int]):
+        for consumer in self.routes.get(subscription, ()):
+            consumer._deliver((topic, value, offset))
+
+    def close(self):
+        """Close the socket, the reader thread ends with it."""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
 class Queue:
     """Representation of Queue interface for both Consumers and Producers."""
 
-    def __init__(self, topic, _type=MiddlewareType.CONSUMER):
-        """Create Queue."""
+    def __init__(self, topic, _type=MiddlewareType.CONSUMER, max_batch: int = 1, linger: float = 0.0,
+                 offset: int = None, since: float = None, prefetch: int = DEFAULT_PREFETCH,
+                 connection: Connection = None, group: str = None, at_least_once: bool = False,
+                 conflate: bool = False, host: str = "localhost", port: int = 5000):
+        """Create Queue.
+
+        With max_batch > 1 pushed values are buffered and published in batch
+        frames of up to max_batch values, sent at the latest linger seconds
+        after the first buffered value.
+
+        A consumer with offset (or since, a timestamp) first receives the
+        backlog of its topic from that point on, then the live values.
+        Consumers of the same group share the values of the topic, each value
+        goes to one of them.
+
+        Consumers read from the broker in a background thread that buffers up
+        to prefetch values; the broker is granted prefetch credits and pulled
+        values are acked in batches, giving the credit back. With
+        at_least_once the application calls ack() once it processed the
+        pulled values, the broker sends them again if that takes too long.
+        With conflate the broker only keeps the newest value of each topic
+        for a consumer that falls behind (for last-value topics, e.g. sensor
+        readings).
+
+        Queues given the same connection share its socket, otherwise each
+        queue opens its own to the broker at host:port."""
         self.format = 0
         self.topic = topic
         self._type = _type
-        self.host = 'localhost'
-        self.port = 5000
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((self.host, self.port))
-        self.sel = selectors.DefaultSelector()
-        self.sel.register(self.sock, selectors.EVENT_READ, self.pull)
+        self.offset = offset
+        self.since = since
+        self.group = group
+        self.prefetch = prefetch
+        self.at_least_once = at_least_once
+        self.conflate = conflate
+        self._acked = None  # offset of the last pulled value, acked or not
+        self._unacked = 0  # pulled values not acked yet
+        self.max_batch = max_batch
+        self.linger = linger
+        self._batch = []
+        self._batch_lock = threading.Lock()
+        self._linger_timer = None
+        self.shared = connection is not None
+        if connection is None:
+            connection = Connection(host, port)
+        self.connection = connection
+        self.host = connection.host
+        self.port = connection.port
+        self.sock = connection.sock
+        self._received = queue.Queue(prefetch)  # (topic, value, offset) not pulled yet
+        self._ended = False  # nothing more will be received, see _end()
+        if _type == MiddlewareType.CONSUMER:
+            connection.attach(self)
 
+    def _send(self, msg):
+        """Sends msg, one whole frame at a time on a shared connection."""
+        with self.connection.send_lock:
+            PubSub.send_msg(self.sock, msg, self.format)
 
     def push(self, value):
         """Sends data to broker."""
+        if self.max_batch > 1:
+            with self._batch_lock:
+                self._batch.append(value)
+                if len(self._batch) < self.max_batch:
+                    if self._linger_timer is None:
+                        self._linger_timer = threading.Timer(self.linger, self.flush)
+                        self._linger_timer.daemon = True
+                        self._linger_timer.start()
+                    return
+            self.flush()
+            return
         protocolMessage = PubSub.publish(value, self.topic)
-        PubSub.send_msg(self.sock, protocolMessage, self.format)
+        self._send(protocolMessage)
+
+    def push_many(self, values: Iterable):
+        """Sends many values to the broker in a single batch frame."""
+        records = [(self.topic, value) for value in values]
+        if records:
+            protocolMessage = PubSub.publish_batch(records)
+            self._send(protocolMessage)
+
+    def flush(self):
+        """Sends the values buffered by push."""
+        with self._batch_lock:
+            values, self._batch = self._batch, []
+            if self._linger_timer is not None:
+                self._linger_timer.cancel()
+                self._linger_timer = None
+            self.push_many(values)
+
+    def _deliver(self, item):
+        """Reader thread: buffer a received item, waiting while the buffer is full."""
+        while not self._ended:
+            try:
+                self._received.put(item, timeout=ROUTE_POLL)
+                return
+            except queue.Full:
+                continue
+
+    def _end(self):
+        """Stop receiving and wake up pull(), never blocking.
 
-    def pull(self) -> (str, Any):
+        With a full buffer there is no room for _CLOSED, but pull() does not
+        block before it drained the buffer, and then it sees _ended."""
+        self._ended = True
+        try:
+            self._received.put_nowait(_CLOSED)
+        except queue.Full:
+            pass
+
+    def pull(self, timeout: Optional[float] = None) -> Tuple[str, Any]:
         """Receives (topic, data) from broker.
 
-        Should BLOCK the consumer!"""
-        protocolMessage = PubSub.recv_msg(self.sock)
-        if protocolMessage is None: 
-            sleep(0.1)
-            self.pull()
-        
-        return (protocolMessage.topic, protocolMessage.message)
+        Blocks until a value arrives, or at most timeout seconds (then returns
+        None). Raises ConnectionError once the broker closed the connection."""
+        if self._ended and self._received.empty():
+            raise ConnectionError("connection to the broker closed")
+        if self._unacked and not self.at_least_once and self._received.empty():
+            self.ack()  # about to wait, make sure the broker has credit to send
+        try:
+            item = self._received.get(timeout=timeout)
+        except Empty:
+            return None
+        if item is _CLOSED:
+            raise ConnectionError("connection to the broker closed")
+        return self._take(item)
+
+    def _take(self, item) -> Tuple[str, Any]:
+        """Account for a pulled (topic, value, offset), acking in batches."""
+        topic, value, offset = item
+        if offset is not None:
+            self._acked = offset if self._acked is None else max(self._acked, offset)
+            self._unacked += 1
+            if not self.at_least_once and self._unacked >= max(1, self.prefetch // 2):
+                self.ack()
+        return topic, value
+
+    def ack(self):
+        """Acknowledge every value pulled so far."""
+        if self._unacked:
+            self._unacked = 0
+            self._send(PubSub.ack(self.topic, self._acked))
+
+    def pull_many(self, max_n: int, timeout: Optional[float] = None) -> List[Tuple[str, Any]]:
+        """Receives up to max_n (topic, data) values.
 
+        Blocks like pull() for the first value only, then returns what is
+        already buffered."""
+        first = self.pull(timeout)
+        if first is None:
+            return []
+        items = [first]
+        while len(items) < max_n:
+            try:
+                item = self._received.get_nowait()
+            except Empty:
+                break
+            if item is _CLOSED:
+                break
+            items.append(self._take(item))
+        return items
 
     def list_topics(self, callback: Callable):
         """Lists all topics available in the broker."""
@@ -56,39 +284,65 @@ class Queue:
 
     def cancel(self):
         """Cancel subscription."""
+        if self.shared and not self.connection.detach(self):
+            return  # another queue of the connection still uses the subscription
         protocolMessage = PubSub.cancel(self.topic)
-        PubSub.send_msg(self.sock, protocolMessage, self.format)
+        self._send(protocolMessage)
+
+    def close(self):
+        """Close the connection to the broker, the reader thread ends with it.
+
+        A queue on a shared connection only stops receiving, the connection
+        stays open for the other queues."""
+        if self.shared:
+            if self._type == MiddlewareType.CONSUMER:
+                self.cancel()
+                self._end()
+        else:
+            self.connection.close()
 
 
 class JSONQueue(Queue):
     """Queue implementation with JSON based serialization."""
-    def __init__(self, topic, _type=MiddlewareType.CONSUMER):
-        super().__init__(topic, _type)
+    def __init__(self, topic, _type=MiddlewareType.CONSUMER, **kwargs):
+        super().__init__(topic, _type, **kwargs)
         # print("JSONQueue")
         self.format = 0
         # print("format: ",self.format)
         ## PubSub.send_msg(self.sock, PubSub.serialize(self.format), 0)
         if _type == MiddlewareType.CONSUMER:
-            PubSub.send_msg(self.sock, PubSub.subscribe(topic, self.format), self.format)
+            self._send(PubSub.subscribe(topic, self.format, self.offset, self.since, self.group,
+                                        self.prefetch, self.at_least_once, self.conflate))
 
 class XMLQueue(Queue):
     """Queue implementation with XML based serialization."""
-    def __init__(self, topic, _type=MiddlewareType.CONSUMER):
-        super().__init__(topic, _type)
+    def __init__(self, topic, _type=MiddlewareType.CONSUMER, **kwargs):
+        super().__init__(topic, _type, **kwargs)
         # print("XMLQueue")
         self.format = 1
         # print("format: ",self.format)
         ## PubSub.send_msg(self.sock, PubSub.serialize(self.format), 1)
         if _type == MiddlewareType.CONSUMER:
-            PubSub.send_msg(self.sock, PubSub.subscribe(topic, self.format), self.format)
+            self._send(PubSub.subscribe(topic, self.format, self.offset, self.since, self.group,
+                                        self.prefetch, self.at_least_once, self.conflate))
 
 class PickleQueue(Queue):
     """Queue implementation with Pickle based serialization."""
-    def __init__(self, topic, _type=MiddlewareType.CONSUMER):
-        super().__init__(topic, _type)
+    def __init__(self, topic, _type=MiddlewareType.CONSUMER, **kwargs):
+        super().__init__(topic, _type, **kwargs)
         # print("PickleQueue")
         self.format = 2
         # print("format: ",self.format)
         ## PubSub.send_msg(self.sock, PubSub.serialize(self.format), 2)
         if _type == MiddlewareType.CONSUMER:
-            PubSub.send_msg(self.sock, PubSub.subscribe(topic, self.format), self.format)
+            self._send(PubSub.subscribe(topic, self.format, self.offset, self.since, self.group,
+                                        self.prefetch, self.at_least_once, self.conflate))
+
+class BinaryQueue(Queue):
+    """Queue implementation with compact binary serialization."""
+    def __init__(self, topic, _type=MiddlewareType.CONSUMER, **kwargs):
+        super().__init__(topic, _type, **kwargs)
+        self.format = 3
+        if _type == MiddlewareType.CONSUMER:
+            self._send(PubSub.subscribe(topic, self.format, self.offset, self.since, self.group,
+                                        self.prefetch, self.at_least_once, self.conflate))
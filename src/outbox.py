@@ -0,0 +1,155 @@
+"""Per-connection outbound buffers used by the broker."""
+import enum
+from collections import deque
+from itertools import islice
+
+
+DEFAULT_LIMIT = 1024 * 1024  # bytes waiting to be written to one connection
+MAX_IOV = 1024  # frames gathered by one sendmsg (the usual IOV_MAX)
+
+
+class OverflowPolicy(enum.Enum):
+    """What to do when a subscriber's outbound buffer is full."""
+
+    BLOCK = 0  # keep the frame, stop reading from publishers until it drains
+    DROP_OLDEST = 1
+    DROP_NEWEST = 2
+    DISCONNECT = 3
+
+
+class OutboxOverflow(Exception):
+    """Raised when a full outbox has the DISCONNECT policy."""
+
+
+class Outbox:
+    """Bounded queue of frames waiting to be written to a connection."""
+
+    vectored = True  # write with sendmsg when the connection has it
+
+    def __init__(self, connection, limit: int = DEFAULT_LIMIT,
+                 policy: OverflowPolicy = OverflowPolicy.BLOCK):
+        """Initialize empty outbox."""
+        self.connection = connection
+        self.limit = limit
+        self.policy = policy
+        self.frames = deque()
+        self.nbytes = 0
+        self.dropped = 0
+        self.conflated = 0  # frames replaced by a newer frame with the same key
+        self.writes = 0  # send/sendmsg calls made by flush()
+        self._sent = 0  # bytes of frames[0] already written
+        self._head = 0  # sequence number of frames[0]
+        self._keys = {}  # conflation key -> sequence number of its queued frame
+
+    def __len__(self):
+        return len(self.frames)
+
+    @property
+    def depth(self) -> int:
+        """Number of frames (including a partially written one) queued."""
+        return len(self.frames)
+
+    @property
+    def full(self) -> bool:
+        """True when the queued bytes reached the limit."""
+        return self.nbytes >= self.limit
+
+    def push(self, frame: bytes, key=None):
+        """Queue frame, applying the overflow policy if there is no room.
+
+        If a frame pushed with the same key is still waiting (not even
+        partially written), frame replaces it in place instead."""
+        if key is not None and self.replace(key, frame):
+            return
+        if self.frames and self.nbytes + len(frame) > self.limit:
+            if self.policy == OverflowPolicy.DROP_NEWEST:
+                self.dropped += 1
+                return
+            if self.policy == OverflowPolicy.DISCONNECT:
+                raise OutboxOverflow()
+            if self.policy == OverflowPolicy.DROP_OLDEST:
+                # the head may be half written, it has to go out whole
+                first = 1 if self._sent else 0
+                while len(self.frames) > first and self.nbytes + len(frame) > self.limit:
+                    victim = self.frames[first]
+                    del self.frames[first]
+                    self.nbytes -= len(victim)
+                    self.dropped += 1
+                    self._keys.clear()  # positions behind the victims moved
+            # BLOCK keeps the frame; the broker throttles the publishers
+        if key is not None:
+            self._keys[key] = self._head + len(self.frames)
+        self.frames.append(frame)
+        self.nbytes += len(frame)
+
+    def replace(self, key, frame: bytes) -> bool:
+        """Replace the waiting frame pushed with key, False if there is none."""
+        index = self._keys.get(key, -1) - self._head
+        if index < 0 or (index == 0 and self._sent):
+            return False
+        old = self.frames[index]
+        self.frames[index] = frame
+        self.nbytes += len(frame) - len(old)
+        self.conflated += 1
+        return True
+
+    def _popped(self, frame: bytes):
+        """Account for frames[0] having been written."""
+        self.nbytes -= len(frame)
+        self._sent = 0
+        self._head += 1
+        if not self.frames:
+            self._keys.clear()
+
+    def popleft(self) -> bytes:
+        """Remove and return the oldest frame, for transports that write whole frames."""
+        frame = self.frames.popleft()
+        self._popped(frame)
+        return frame
+
+    def flush(self) -> int:
+        """Write as much as the socket takes without blocking.
+
+        The queued frames are gathered into one sendmsg call (at most MAX_IOV
+        per call), connections without sendmsg get one send per frame.
+        Returns the number of bytes written."""
+        if self.vectored and hasattr(self.connection, "sendmsg"):
+            return self._flush_vectored()
+        written = 0
+        while self.frames:
+            frame = self.frames[0]
+            try:
+                sent = self.connection.send(memoryview(frame)[self._sent:])
+            except (BlockingIOError, InterruptedError):
+                break
+            self.writes += 1
+            written += sent
+            self._sent += sent
+            if self._sent < len(frame):
+                break  # socket buffer is full
+            self.frames.popleft()
+            self._popped(frame)
+        return written
+
+    def _flush_vectored(self) -> int:
+        """flush() with scatter/gather writes."""
+        written = 0
+        while self.frames:
+            buffers = [memoryview(self.frames[0])[self._sent:]]
+            buffers.extend(islice(self.frames, 1, MAX_IOV))
+            try:
+                sent = self.connection.sendmsg(buffers)
+            except (BlockingIOError, InterruptedError):
+                break
+            self.writes += 1
+            written += sent
+            complete = sent == sum(len(buffer) for buffer in buffers)
+            sent += self._sent
+            while self.frames and sent >= len(self.frames[0]):
+                frame = self.frames.popleft()
+                sent -= len(frame)
+                self._popped(frame)
+            self._sent = sent
+            if not complete:
+                break  # socket buffer is full
+        return written
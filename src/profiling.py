@@ -0,0 +1,136 @@
+"""Profiling of a running broker: sampled stacks and per-stage timings.
+
+The sampler is a thread that looks at the stack of the broker thread every
+interval (sys._current_frames), so the broker itself runs unchanged; at the
+default 100 Hz it costs well under 1% of a core. The stage timings are a
+histogram fed by hooks around the broker's hot path (accept, read, decode,
+route, encode and send), which are a None check when profiling is off.
+
+Both are dumped on SIGUSR1 and at exit: stacks in the collapsed format read
+by flamegraph.pl and speedscope, stages as a text table."""
+import atexit
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 0.01  # seconds between stack samples
+STAGES = ("accept", "read", "decode", "route", "encode", "send")  # in hot path order
+
+
+def collapse(frame) -> str:
+    """Stack of frame as "file:function;...", outermost call first."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """Counts the stacks a thread is seen running, every interval seconds."""
+
+    def __init__(self, thread_id: int = None, interval: float = DEFAULT_INTERVAL):
+        """Initialize profiler of thread_id (default the main thread)."""
+        self.thread_id = thread_id or threading.main_thread().ident
+        self.interval = interval
+        self.stacks: Dict[str, int] = {}
+        self.samples = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start sampling in a daemon thread."""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling, the stacks counted so far are kept."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        stacks = self.stacks
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue  # the thread is gone, or not started yet
+            stack = collapse(frame)
+            del frame
+            stacks[stack] = stacks.get(stack, 0) + 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        """The stacks in the collapsed format, one "stack count" per line."""
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(dict(self.stacks).items()))
+
+
+def stage_table(histogram) -> str:
+    """Per-stage timings of a stage_seconds histogram, as a text table.
+
+    p99 is the upper bound of the histogram bucket holding it."""
+    lines = [f"{'stage':<8}{'count':>10}{'total s':>10}{'mean us':>10}{'p99 us':>10}"]
+    samples = dict(histogram.samples())
+    for stage in STAGES:
+        if (stage,) not in samples:
+            continue
+        value = samples[(stage,)]
+        count, total = value["count"], value["sum"]
+        p99 = histogram.quantile(0.99, (stage,))
+        if p99 == float("inf"):
+            p99_text = f">{histogram.buckets[-1] * 1e6:.0f}"
+        else:
+            p99_text = f"{p99 * 1e6:.1f}"
+        lines.append(f"{stage:<8}{count:>10}{total:>10.3f}{total / count * 1e6:>10.1f}{p99_text:>10}")
+    return "\n".join(lines) + "\n"
+
+
+class Profiler:
+    """--profile mode of a broker: sampler plus stage timings, dumped to files."""
+
+    def __init__(self, broker, directory: str = ".", interval: float = DEFAULT_INTERVAL,
+                 thread_id: int = None):
+        """Initialize profiler of the broker running in thread_id (default the main thread)."""
+        self.broker = broker
+        self.directory = directory
+        self.sampler = SamplingProfiler(thread_id, interval)
+        self.prefix = os.path.join(directory, f"broker-{os.getpid()}")
+
+    def start(self, signals: bool = True) -> "Profiler":
+        """Start profiling; with signals dump on SIGUSR1 and at exit.
+
+        Signal handlers can only be installed from the main thread."""
+        self.broker.enable_stage_timing()
+        self.sampler.start()
+        if signals:
+            if hasattr(signal, "SIGUSR1"):
+                signal.signal(signal.SIGUSR1, lambda signum, frame: self.dump())
+            if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+                # exit normally so that the atexit dump runs
+                signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            atexit.register(self.dump)
+        return self
+
+    def stop(self):
+        """Stop sampling."""
+        self.sampler.stop()
+
+    def dump(self) -> str:
+        """Write <prefix>.collapsed and <prefix>-stages.txt, returns the prefix."""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.prefix + ".collapsed", "w") as output:
+            output.write(self.sampler.collapsed())
+        with open(self.prefix + "-stages.txt", "w") as output:
+            output.write(f"# {time.strftime('%Y-%m-%d %H:%M:%S')}, {self.sampler.samples} samples\n")
+            output.write(stage_table(self.broker.stage_seconds))
+        logger.info("Profile written to %s.collapsed and %s-stages.txt", self.prefix, self.prefix)
+        return self.prefix
@@ -1,15 +1,46 @@
 """Protocol for chat server - Computação Distribuida Assignment 3."""
 import json
 import xml.etree.ElementTree as xml
+from xml.sax.saxutils import quoteattr
 import pickle
+import struct
+import time
+import zlib
 from socket import socket
-import logging
-
-logging.basicConfig(filename="realProtocol.log", level=logging.DEBUG)
+from typing import Callable, List
+from . import binary
 
 JSON = 0
 XML = 1
 PICKLE = 2
+BINARY = 3
+FORMAT_NAMES = {JSON: "json", XML: "xml", PICKLE: "pickle", BINARY: "binary"}
+
+RECV_CHUNK = 64 * 1024
+
+# Frame versions. Legacy (v1) frames start with the format byte, v2 frames
+# start with V2_MARKER, which is never a valid format.
+FRAME_V1 = 1  # format (1 byte) + payload size (2 bytes)
+FRAME_V2 = 2  # marker (1 byte) + format (1 byte) + flags (1 byte) + payload size (4 bytes)
+HEADER_SIZE = 3  # v1 header size
+V2_MARKER = 0xF2
+V2_HEADER = struct.Struct("!BBBI")
+V1_MAX_SIZE = 0xFFFF
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# v2 flags
+FLAG_COMPRESSED = 0x01  # payload is zlib compressed
+FLAG_ROUTED = 0x02  # payload is a routing header followed by the message body
+FLAG_OFFSET = 0x04  # the routing header ends with the broker offset of the publish
+FLAG_SUBSCRIPTION = 0x08  # then with the wildcard filter the publish was delivered for
+
+# Routing header of FLAG_ROUTED frames: command code + topic size, then the
+# topic. The body only holds the published value, so a broker can route the
+# frame without parsing the body and forward it to same format subscribers.
+ROUTE = binary.HEAD
+ROUTE_OFFSET = struct.Struct("!Q")
+ROUTE_SUBSCRIPTION = struct.Struct("!H")  # filter size, followed by the filter
+PUBLISH_CODE = binary.COMMAND_CODES["publish"]
 
 """
     root = ET.fromstring(xmlstring)
@@ -26,31 +57,111 @@ class Message:
         self.command = command
     
 class SubscribeMessage(Message):
-    """Message to Subscribe a chat topic."""
-    def __init__(self, topic: str, format: str) -> None:
+    """Message to Subscribe a chat topic.
+
+    With offset (or since, a timestamp) the broker first replays the backlog
+    of the topic from that point on. Subscribers sharing a group split the
+    messages of the topic between them. With credit the broker sends at most
+    that many messages until acks (or credit messages) grant more; with ack
+    it redelivers the messages not acked in time. With conflate a newer
+    value of a topic replaces the one still waiting to be written."""
+    def __init__(self, topic: str, format: str, offset: int = None, since: float = None,
+                 group: str = None, credit: int = None, ack: bool = False,
+                 conflate: bool = False) -> None:
         """Initializes message"""
         super().__init__("subscribe")
         self.topic = topic
         self.format = format
+        self.offset = offset
+        self.since = since
+        self.group = group
+        self.credit = credit
+        self.ack = ack
+        self.conflate = conflate
+
+    def _fields(self):
+        return {"command": "subscribe", "topic": self.topic, "format": self.format,
+                "offset": self.offset, "since": self.since, "group": self.group,
+                "credit": self.credit, "ack": self.ack, "conflate": self.conflate}
 
     def __repr__(self) -> str:
-        data = {"command": "subscribe", "topic": self.topic, "format": self.format}
-        return json.dumps(data)
+        return json.dumps(self._fields())
     
     def toXML(self):
-        return f'<?xml version="1.0"?><data command="{self.command}" topic="{self.topic}" format="{self.format}"></data>'
+        options = ""
+        if self.offset is not None:
+            options += f' offset="{self.offset}"'
+        if self.since is not None:
+            options += f' since="{self.since!r}"'
+        if self.group is not None:
+            options += f' group={quoteattr(self.group)}'
+        if self.credit is not None:
+            options += f' credit="{self.credit}"'
+        if self.ack:
+            options += ' ack="1"'
+        if self.conflate:
+            options += ' conflate="1"'
+        return f'<?xml version="1.0"?><data command="{self.command}" topic="{self.topic}" format="{self.format}"{options}></data>'
     
     def toPickle(self):
-        data = {"command": "subscribe", "topic": self.topic, "format": self.format}
-        return pickle.dumps(data)
+        return pickle.dumps(self._fields())
+
+    def toBinary(self):
+        options = [self.offset, self.since, self.group, self.credit, self.ack, self.conflate]
+        if options == [None, None, None, None, False, False]:
+            return binary.pack(self.command, self.topic, self.format)
+        return binary.pack(self.command, self.topic, [self.format] + options)
     
+class Payload:
+    """Published value still encoded as the body of a routed frame.
+
+    The broker keeps it as is to forward it to subscribers of the same
+    format; the value is decoded (once) only when another format needs it."""
+
+    __slots__ = ("format", "body", "_value")
+    _UNDECODED = object()
+
+    def __init__(self, format: int, body: bytes) -> None:
+        """Initializes payload"""
+        self.format = format
+        self.body = body
+        self._value = self._UNDECODED
+
+    @property
+    def value(self):
+        """The decoded value."""
+        if self._value is self._UNDECODED:
+            self._value = decode_body(self.format, self.body)
+        return self._value
+
+    def __repr__(self) -> str:
+        return repr(self.value)
+
+
+def unwrap(value):
+    """Decoded value of a published value that may still be a Payload."""
+    return value.value if isinstance(value, Payload) else value
+
+
 class PublishMessage(Message):
-    """Message to chat with other clients."""
-    def __init__(self, message: str, topic: str) -> None:
+    """Message to chat with other clients.
+
+    Publishes sent by the broker carry the offset the consumer acks, and
+    the ones sent for a wildcard subscription the filter it subscribed
+    (topic is the topic the value was published on); they only travel in
+    routed frames."""
+    offset = None
+    subscription = None
+
+    def __init__(self, message: str, topic: str, offset: int = None, subscription: str = None) -> None:
         """Initializes message"""
         super().__init__("publish")
         self.message = message
         self.topic = topic
+        if offset is not None:
+            self.offset = offset
+        if subscription is not None:
+            self.subscription = subscription
 
     def __repr__(self) -> str:
         data = {"command": "publish", "message": self.message, "topic": self.topic}
@@ -62,7 +173,45 @@ class PublishMessage(Message):
     def toPickle(self):
         data = {"command": "publish", "message": self.message, "topic": self.topic}
         return pickle.dumps(data)
+
+    def toBinary(self):
+        return binary.pack(self.command, self.topic, self.message)
     
+class PublishBatchMessage(Message):
+    """Message to publish many (topic, message) records at once.
+
+    Batches replayed by the broker carry the subscribed topic the records
+    were sent for."""
+    topic = None
+
+    def __init__(self, records: list, topic: str = None) -> None:
+        """Initializes message"""
+        super().__init__("publish_batch")
+        self.records = [list(record) for record in records]
+        if topic is not None:
+            self.topic = topic
+
+    def __repr__(self) -> str:
+        data = {"command": "publish_batch", "records": self.records}
+        return json.dumps(data)
+
+    def toXML(self):
+        records = "".join(
+            f'<record topic={quoteattr(str(topic))} message={quoteattr(str(message))}/>'
+            for topic, message in self.records
+        )
+        topic = "" if self.topic is None else f" topic={quoteattr(self.topic)}"
+        return f'<?xml version="1.0"?><data command="publish_batch"{topic}>{records}</data>'
+
+    def toPickle(self):
+        data = {"command": "publish_batch", "records": self.records}
+        if self.topic is not None:
+            data["topic"] = self.topic
+        return pickle.dumps(data)
+
+    def toBinary(self):
+        return binary.pack(self.command, self.topic, self.records)
+
 class ListRequestMessage(Message):
     """Message to list all chat topics."""
     def __init__(self) -> None:
@@ -80,6 +229,9 @@ class ListRequestMessage(Message):
         data = {"command": "req_list"}
         return pickle.dumps(data)
 
+    def toBinary(self):
+        return binary.pack("req_list")
+
 class ListMessage(Message):
     """Message to list all chat topics."""
     def __init__(self) -> None:
@@ -97,6 +249,9 @@ class ListMessage(Message):
         data = {"command": "list"}
         return pickle.dumps(data)
 
+    def toBinary(self):
+        return binary.pack(self.command)
+
 class CancelMessage(Message):
     """Message to cancel a chat topic subscription."""
     def __init__(self, topic: str = None) -> None:
@@ -115,59 +270,167 @@ class CancelMessage(Message):
         data = {"command": "cancel", "topic": self.topic}
         return pickle.dumps(data)
 
+    def toBinary(self):
+        return binary.pack(self.command, self.topic)
+
+
+class CreditMessage(Message):
+    """Message granting the broker credit to send more messages of a topic."""
+    def __init__(self, topic: str, credit: int) -> None:
+        """Initializes message"""
+        super().__init__("credit")
+        self.topic = topic
+        self.credit = credit
+
+    def __repr__(self) -> str:
+        data = {"command": "credit", "topic": self.topic, "credit": self.credit}
+        return json.dumps(data)
+
+    def toXML(self):
+        return f'<?xml version="1.0"?><data command="{self.command}" topic="{self.topic}" credit="{self.credit}"></data>'
+
+    def toPickle(self):
+        data = {"command": "credit", "topic": self.topic, "credit": self.credit}
+        return pickle.dumps(data)
+
+    def toBinary(self):
+        return binary.pack(self.command, self.topic, self.credit)
+
+
+class AckMessage(Message):
+    """Message acknowledging every message of a topic up to an offset."""
+    def __init__(self, topic: str, offset: int) -> None:
+        """Initializes message"""
+        super().__init__("ack")
+        self.topic = topic
+        self.offset = offset
+
+    def __repr__(self) -> str:
+        data = {"command": "ack", "topic": self.topic, "offset": self.offset}
+        return json.dumps(data)
+
+    def toXML(self):
+        return f'<?xml version="1.0"?><data command="{self.command}" topic="{self.topic}" offset="{self.offset}"></data>'
+
+    def toPickle(self):
+        data = {"command": "ack", "topic": self.topic, "offset": self.offset}
+        return pickle.dumps(data)
+
+    def toBinary(self):
+        return binary.pack(self.command, self.topic, self.offset)
+
+
+class StatsMessage(Message):
+    """Request for the broker metrics, or the reply of the broker holding them."""
+    def __init__(self, stats: dict = None) -> None:
+        """Initializes message"""
+        super().__init__("stats")
+        self.stats = stats
+
+    def __repr__(self) -> str:
+        data = {"command": "stats", "stats": self.stats}
+        return json.dumps(data)
+
+    def toXML(self):
+        stats = "" if self.stats is None else f" stats={quoteattr(json.dumps(self.stats))}"
+        return f'<?xml version="1.0"?><data command="{self.command}"{stats}></data>'
+
+    def toPickle(self):
+        data = {"command": "stats", "stats": self.stats}
+        return pickle.dumps(data)
+
+    def toBinary(self):
+        return binary.pack(self.command, None, self.stats)
+
 
 class PubSub:
     """Computação Distribuida Protocol."""
     
     @classmethod
-    def subscribe(cls, topic: str, format: str) -> Message:
-        """Subscribe to a chat topic."""
-        return SubscribeMessage(topic, format)
+    def subscribe(cls, topic: str, format: str, offset: int = None, since: float = None,
+                  group: str = None, credit: int = None, ack: bool = False,
+                  conflate: bool = False) -> Message:
+        """Subscribe to a chat topic (see SubscribeMessage for the options)."""
+        return SubscribeMessage(topic, format, offset, since, group, credit, ack, conflate)
     
     @classmethod
-    def publish(cls, message: str, topic: str = None) -> Message:
+    def publish(cls, message: str, topic: str = None, offset: int = None,
+                subscription: str = None) -> Message:
         """Publish a message to a chat topic."""
-        return PublishMessage(message, topic)
+        return PublishMessage(message, topic, offset, subscription)
     
+    @classmethod
+    def publish_batch(cls, records: list, topic: str = None) -> Message:
+        """Publish many (topic, message) records in one message."""
+        return PublishBatchMessage(records, topic)
+
+    @classmethod
+    def credit(cls, topic: str, credit: int) -> Message:
+        """Allow the broker to send credit more messages of topic."""
+        return CreditMessage(topic, credit)
+
+    @classmethod
+    def ack(cls, topic: str, offset: int) -> Message:
+        """Acknowledge the messages of topic up to offset."""
+        return AckMessage(topic, offset)
+
+    @classmethod
+    def stats(cls, stats: dict = None) -> Message:
+        """Ask the broker for its metrics (or, from the broker, reply with them)."""
+        return StatsMessage(stats)
+
     @classmethod
     def list(cls) -> Message:
         """List all chat topics."""
         return ListMessage()
     
     @classmethod
-    def cancel(cls) -> Message:
+    def cancel(cls, topic: str = None) -> Message:
         """Cancel a chat topic subscription."""
-        return CancelMessage()
+        return CancelMessage(topic)
    
     @classmethod
-    def send_msg(cls, connection: socket, msg: Message, format = None):
+    def send_msg(cls, connection: socket, msg: Message, format = None, version: int = FRAME_V2):
         """Sends through a connection a Message object."""
-        completeMessage = None
-        # print(format)
+        completeMessage = cls.encode(msg, format, version)
+        if completeMessage != None:
+            connection.send(completeMessage)
+
+    @classmethod
+    def encode(cls, msg: Message, format = None, version: int = FRAME_V2) -> bytes:
+        """Builds the frame (header + payload) for a Message object.
+
+        v2 publishes are routed frames, reusing the body of a Payload value
+        when it already has the requested format."""
         if format == None:
             format = JSON
-        # print(format)
+        if msg.command == "publish":
+            value = msg.message
+            if version == FRAME_V2 and format in BODY_FORMATS:
+                if isinstance(value, Payload) and value.format == format:
+                    body = value.body
+                else:
+                    body = encode_body(format, unwrap(value))
+                return pack_routed(format, msg.topic, body, msg.offset, msg.subscription)
+            if isinstance(value, Payload) or msg.offset is not None or msg.subscription is not None:
+                msg = PublishMessage(unwrap(value), msg.topic)
+        payload = cls.serialize(msg, format)
+        if payload is None:
+            return None
+        return pack_frame(format, payload, version)
+
+    @classmethod
+    def serialize(cls, msg: Message, format) -> bytes:
+        """Serializes a Message object into a frame payload."""
         if format == JSON:
-            message = json.dumps(msg.__dict__).encode("utf-8")
-            size = len(message)
-            formatBytes = format.to_bytes(1, "big")
-            header = size.to_bytes(2, "big")
-            completeMessage = formatBytes + header + message
+            return json.dumps(msg.__dict__).encode("utf-8")
         elif format == XML:
-            message = msg.toXML().encode("utf-8")
-            size = len(message)
-            formatBytes = format.to_bytes(1, "big")
-            header = size.to_bytes(2, "big")
-            completeMessage = formatBytes + header + message
+            return msg.toXML().encode("utf-8")
         elif format == PICKLE:
-            message = msg.toPickle()
-            size = len(message)
-            formatBytes = format.to_bytes(1, "big")
-            header = size.to_bytes(2, "big")
-            completeMessage = formatBytes + header + message
-        if completeMessage != None:
-            connection.send(completeMessage)
-        
+            return msg.toPickle()
+        elif format == BINARY:
+            return msg.toBinary()
+        return None
 
     def req_list(cls):
         """Request list of chat topics."""
@@ -175,43 +438,324 @@ class PubSub:
 
     @classmethod
     def recv_msg(cls, connection: socket) -> Message:
-        """Receives through a connection a Message object."""
-        format_byted = connection.recv(1)
-        if format_byted == None:
+        """Receives through a (blocking) connection a Message object."""
+        first = _recv_exact(connection, 1)
+        if first is None:
             return None
-        format = int.from_bytes(format_byted, 'big') 
-
-        header = connection.recv(2)
-        size = int.from_bytes(header, 'big')
+        if first[0] == V2_MARKER:
+            rest = _recv_exact(connection, V2_HEADER.size - 1)
+        else:
+            rest = _recv_exact(connection, HEADER_SIZE - 1)
+        if rest is None:
+            return None
+        _, format, flags, size, _ = parse_header(first + rest)
         if size == 0:
             return None
-        if format == JSON:
+        payload = _recv_exact(connection, size)
+        if payload is None:
+            return None
+        payload = unpack_payload(payload, flags)
+        if flags & FLAG_ROUTED:
+            return cls.decode_routed(format, payload, flags=flags)
+        return cls.decode(format, payload)
+
+    @classmethod
+    def decode_routed(cls, format: int, payload, lazy: bool = False, flags: int = FLAG_ROUTED) -> Message:
+        """Builds a Message object from the payload of a routed frame.
+
+        With lazy the value is kept encoded, as a Payload."""
+        try:
+            code, size = ROUTE.unpack_from(payload, 0)
+            start = ROUTE.size + size
+            topic = str(payload[ROUTE.size:start], "utf-8")
+            offset = subscription = None
+            if flags & FLAG_OFFSET:
+                offset = ROUTE_OFFSET.unpack_from(payload, start)[0]
+                start += ROUTE_OFFSET.size
+            if flags & FLAG_SUBSCRIPTION:
+                size = ROUTE_SUBSCRIPTION.unpack_from(payload, start)[0]
+                start += ROUTE_SUBSCRIPTION.size
+                subscription = str(payload[start:start + size], "utf-8")
+                start += size
+        except (struct.error, UnicodeDecodeError):
+            raise PubSubBadFormat(bytes(payload))
+        if code != PUBLISH_CODE or format not in BODY_FORMATS:
+            raise PubSubBadFormat(bytes(payload))
+        body = bytes(payload[start:])
+        if lazy:
+            return PublishMessage(Payload(format, body), topic, offset, subscription)
+        return PublishMessage(decode_body(format, body), topic, offset, subscription)
+
+    @classmethod
+    def decode(cls, format: int, payload: bytes) -> Message:
+        """Builds a Message object from a frame payload.
+
+        Raises PubSubBadFormat if the payload is not a valid message."""
+        try:
+            message = cls._decode(format, payload)
+        except _DECODE_ERRORS:
+            raise PubSubBadFormat(bytes(payload))
+        if isinstance(message, (PublishMessage, SubscribeMessage)) and not isinstance(message.topic, str):
+            raise PubSubBadFormat(bytes(payload))
+        if isinstance(message, PublishBatchMessage) and not all(
+                len(record) == 2 and isinstance(record[0], str) for record in message.records):
+            raise PubSubBadFormat(bytes(payload))
+        return message
+
+    @classmethod
+    def _decode(cls, format: int, payload: bytes) -> Message:
+        if format == BINARY:
+            """ message in binary format, fields are positional """
+            try:
+                command, topic, value = binary.unpack(payload)
+            except binary.BinaryDecodeError:
+                raise PubSubBadFormat(bytes(payload))
+            if command == "publish":
+                return PublishMessage(value, topic)
+            if command == "subscribe" and isinstance(value, list):
+                return SubscribeMessage(topic, *value)
+            # the value holds the field that is specific to each command
+            field = {"subscribe": "format", "publish_batch": "records", "credit": "credit",
+                     "ack": "offset", "stats": "stats"}.get(command, "value")
+            message = {"command": command, "topic": topic, field: value}
+        elif format == JSON:
             """ message in json format """
-            message = json.loads(connection.recv(size).decode("utf-8"))
+            message = json.loads(bytes(payload).decode("utf-8"))
         elif format == XML:
             """ message in xml format """
-            root = xml.fromstring(connection.recv(size).decode("utf-8"))
+            root = xml.fromstring(bytes(payload).decode("utf-8"))
             message = {}
             for node in root.keys():
                 message[node] = root.get(node)
+            if message.get("command") == "publish_batch":
+                message["records"] = [
+                    (record.get("topic"), record.get("message")) for record in root
+                ]
             # print("message from xml: " , message)
         elif format == PICKLE:
             """ message in pickle format """
-            message = pickle.loads(connection.recv(size))   
+            message = pickle.loads(payload)
         else:
-            pass
-        
+            raise PubSubBadFormat(bytes(payload))
 
-        if message["command"] == "subscribe":    
-            return PubSub.subscribe(message["topic"], message["format"])
+        if message["command"] == "subscribe":
+            offset, since = message.get("offset"), message.get("since")
+            credit = message.get("credit")
+            return PubSub.subscribe(
+                message["topic"], message["format"],
+                None if offset is None else int(offset),
+                None if since is None else float(since),
+                message.get("group"),
+                None if credit is None else int(credit),
+                message.get("ack") in (True, "1"),
+                message.get("conflate") in (True, "1"),
+            )
         elif message["command"] == "publish":
             return PubSub.publish(message["message"], message["topic"])
+        elif message["command"] == "publish_batch":
+            return PubSub.publish_batch(message["records"], message.get("topic"))
         elif message["command"] == "req_list":
             return PubSub.list()
         elif message["command"] == "cancel":
             return PubSub.cancel(message["topic"])
-        
- 
+        elif message["command"] == "credit":
+            return PubSub.credit(message["topic"], int(message["credit"]))
+        elif message["command"] == "ack":
+            return PubSub.ack(message["topic"], int(message["offset"]))
+        elif message["command"] == "stats":
+            stats = message.get("stats")
+            if isinstance(stats, str):
+                stats = json.loads(stats)  # XML carries them as a JSON attribute
+            return PubSub.stats(stats)
+
+
+def _recv_exact(connection: socket, size: int):
+    """Reads exactly size bytes, None if the connection closed before."""
+    data = bytearray()
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def encode_body(format: int, value) -> bytes:
+    """Body of a routed publish: the value in the given format."""
+    if format == BINARY:
+        return binary.dumps(value)
+    if format == JSON:
+        return json.dumps({"message": value}).encode("utf-8")
+    if format == XML:
+        return f'<?xml version="1.0"?><data message={quoteattr(str(value))}></data>'.encode("utf-8")
+    return pickle.dumps({"message": value})
+
+
+# what a payload that is not a valid message raises while decoding: bad JSON
+# or UTF-8 (ValueError), missing fields (KeyError), fields of the wrong type
+# (TypeError, AttributeError, IndexError) and broken pickles
+_DECODE_ERRORS = (ValueError, KeyError, TypeError, AttributeError, IndexError, xml.ParseError,
+                  pickle.UnpicklingError, EOFError, ImportError)
+
+
+def decode_body(format: int, body):
+    """Value held by the body of a routed publish."""
+    try:
+        if format == BINARY:
+            return binary.loads(body)
+        if format == JSON:
+            return json.loads(bytes(body).decode("utf-8"))["message"]
+        if format == XML:
+            return xml.fromstring(bytes(body).decode("utf-8")).get("message")
+        return pickle.loads(body)["message"]
+    except _DECODE_ERRORS:
+        raise PubSubBadFormat(bytes(body))
+
+
+BODY_FORMATS = (JSON, XML, PICKLE, BINARY)
+
+
+def pack_routed(format: int, topic: str, body, offset: int = None, subscription: str = None) -> bytes:
+    """Builds a routed v2 publish frame."""
+    route = topic.encode("utf-8")
+    flags = FLAG_ROUTED
+    trailer = b""
+    if offset is not None:
+        flags |= FLAG_OFFSET
+        trailer = ROUTE_OFFSET.pack(offset)
+    if subscription is not None:
+        flags |= FLAG_SUBSCRIPTION
+        subscribed = subscription.encode("utf-8")
+        trailer += ROUTE_SUBSCRIPTION.pack(len(subscribed)) + subscribed
+    size = ROUTE.size + len(route) + len(trailer) + len(body)
+    if size > MAX_FRAME_SIZE:
+        raise FrameTooLarge(size)
+    return b"".join((
+        V2_HEADER.pack(V2_MARKER, format, flags, size),
+        ROUTE.pack(PUBLISH_CODE, len(route)), route, trailer, body,
+    ))
+
+
+def pack_frame(format: int, payload: bytes, version: int = FRAME_V2, compress: bool = False) -> bytes:
+    """Prepends the header of the given frame version to payload."""
+    if version == FRAME_V1:
+        if len(payload) > V1_MAX_SIZE:
+            raise FrameTooLarge(len(payload))
+        return format.to_bytes(1, "big") + len(payload).to_bytes(2, "big") + payload
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload)
+        flags |= FLAG_COMPRESSED
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameTooLarge(len(payload))
+    return V2_HEADER.pack(V2_MARKER, format, flags, len(payload)) + payload
+
+
+def frame_format(frame: bytes) -> int:
+    """Format of an encoded frame of either version."""
+    return frame[1] if frame[0] == V2_MARKER else frame[0]
+
+
+def parse_header(buffer, offset: int = 0):
+    """Parses the frame header at offset.
+
+    Returns (version, format, flags, payload size, header size) or None when
+    the buffer does not hold the whole header yet."""
+    available = len(buffer) - offset
+    if available < 1:
+        return None
+    if buffer[offset] == V2_MARKER:
+        if available < V2_HEADER.size:
+            return None
+        _, format, flags, size = V2_HEADER.unpack_from(buffer, offset)
+        if size > MAX_FRAME_SIZE:
+            raise PubSubBadFormat()
+        return FRAME_V2, format, flags, size, V2_HEADER.size
+    if available < HEADER_SIZE:
+        return None
+    size = int.from_bytes(buffer[offset + 1:offset + HEADER_SIZE], "big")
+    return FRAME_V1, buffer[offset], 0, size, HEADER_SIZE
+
+
+def unpack_payload(payload, flags: int):
+    """Undoes the transformations announced by the frame flags."""
+    if flags & FLAG_COMPRESSED:
+        return zlib.decompress(payload)
+    return payload
+
+
+class FrameReader:
+    """Framing state machine for a non-blocking connection.
+
+    Every readiness event reads one large chunk into a reusable buffer and
+    returns all the complete frames it holds; a trailing partial frame is
+    kept until the next event."""
+
+    def __init__(self, connection: socket, chunk_size: int = RECV_CHUNK, lazy: bool = False,
+                 observe: Callable[[int, int, float], None] = None) -> None:
+        """Initializes reader.
+
+        A lazy reader (the broker's) keeps the values of routed publishes
+        encoded, see Payload. observe(format, frame size, seconds) is called
+        for every frame decoded."""
+        self.connection = connection
+        self.lazy = lazy
+        self.observe = observe
+        self.closed = False
+        self.version = None  # frame version of the peer, set by its first frame
+        self._chunk = memoryview(bytearray(chunk_size))
+        self._pending = bytearray()
+
+    def read(self) -> List[Message]:
+        """Reads available data, returns the complete messages received."""
+        try:
+            received = self.connection.recv_into(self._chunk)
+        except (BlockingIOError, InterruptedError):
+            return []
+        if received == 0:
+            self.closed = True
+            return []
+        return self.feed(self._chunk[:received])
+
+    def feed(self, data) -> List[Message]:
+        """Appends received data, returns the complete messages it finishes."""
+        self._pending += data
+        return self.frames()
+
+    def frames(self) -> List[Message]:
+        """Extracts every complete frame held in the pending buffer."""
+        messages = []
+        pending = self._pending
+        observe = self.observe
+        offset = 0
+        with memoryview(pending) as view:
+            while True:
+                header = parse_header(pending, offset)
+                if header is None:
+                    break
+                version, format, flags, size, header_size = header
+                end = offset + header_size + size
+                if end > len(pending):
+                    break
+                if self.version is None:
+                    self.version = version
+                if observe is not None:
+                    started = time.perf_counter()
+                if size > 0 and flags & FLAG_ROUTED:
+                    message = PubSub.decode_routed(
+                        format, unpack_payload(view[offset + header_size:end], flags), self.lazy, flags)
+                    messages.append(message)
+                elif size > 0:
+                    message = PubSub.decode(
+                        format, unpack_payload(view[offset + header_size:end], flags))
+                    if message is not None:
+                        messages.append(message)
+                if observe is not None:
+                    observe(format, end - offset, time.perf_counter() - started)
+                offset = end
+        del pending[:offset]
+        return messages
+
 
 class PubSubBadFormat(Exception):
     """Exception when source message is not PubSub."""
@@ -224,3 +768,12 @@ class PubSubBadFormat(Exception):
     def original_msg(self) -> str:
         """Retrieve original message as a string."""
         return self._original.decode("utf-8")
+
+
+class FrameTooLarge(Exception):
+    """Exception when a payload does not fit in the requested frame version."""
+
+    def __init__(self, size: int) -> None:
+        """Store the size of the payload."""
+        super().__init__(f"payload of {size} bytes does not fit in the frame")
+        self.size = size
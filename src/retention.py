@@ -0,0 +1,152 @@
+"""Retention limits of the last values the broker keeps for new subscribers."""
+import sys
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .protocol import Payload
+
+EXPIRY_INTERVAL = 1.0  # seconds between sweeps of the values past their TTL
+
+
+class Retention:
+    """How long and how many retained values are kept.
+
+    ttl maps topic prefixes to the seconds a value is kept after it was
+    published; a prefix covers its whole subtree ("/" every topic) and the
+    longest matching prefix applies. max_entries and max_bytes cap the
+    values kept, the least recently used are evicted first. None is
+    unlimited."""
+
+    def __init__(self, ttl: Dict[str, float] = None, max_entries: int = None,
+                 max_bytes: int = None):
+        """Initialize policy, unlimited by default."""
+        self.ttl = dict(ttl or {})
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._prefixes = sorted(self.ttl, key=len, reverse=True)  # most specific first
+
+    def ttl_of(self, topic: str) -> Optional[float]:
+        """Seconds the value of topic is kept, None without a TTL."""
+        for prefix in self._prefixes:
+            base = prefix.rstrip("/")
+            if topic == base or topic.startswith(base + "/"):
+                return self.ttl[prefix]
+        return None
+
+
+def value_size(topic: str, value: Any) -> int:
+    """Approximate bytes taken by the retained value of topic."""
+    if isinstance(value, Payload):
+        size = len(value.body)
+    elif isinstance(value, (bytes, str)):
+        size = len(value)
+    else:
+        size = sys.getsizeof(value)  # shallow, containers are undercounted
+    return len(topic) + size
+
+
+class RetainedValues:
+    """Last value published on each topic, within the limits of a Retention.
+
+    Publishing a topic and reading its value make it the most recently
+    used. Times are time.monotonic() values. on_evict(topic) is called
+    when the value of topic is evicted."""
+
+    def __init__(self, retention: Retention = None, on_evict: Callable[[str], None] = None):
+        """Initialize empty."""
+        self.retention = retention or Retention()
+        self.on_evict = on_evict
+        self.values = OrderedDict()  # topic -> value, least recently used first
+        self.sizes = {}  # topic -> value_size
+        self.nbytes = 0
+        self.ttls = {}  # topic -> TTL, of the topics that expire
+        self.deadlines = {}  # TTL -> OrderedDict topic -> deadline, earliest first
+        self.evicted = {"ttl": 0, "entries": 0, "bytes": 0}  # values dropped, per reason
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __contains__(self, topic: str) -> bool:
+        return topic in self.values
+
+    def __repr__(self) -> str:
+        return repr(dict(self.values))
+
+    @property
+    def expiring(self) -> bool:
+        """True if some value has a TTL."""
+        return bool(self.ttls)
+
+    def put(self, topic: str, value: Any, now: float, age: float = 0.0) -> bool:
+        """Retain value as the last one of topic, evicting others over the caps.
+
+        age is how many seconds ago value was published (when restoring it
+        from the log); a value already past its TTL is not retained and
+        False is returned."""
+        ttl = self.retention.ttl_of(topic) if self.retention.ttl else None
+        if ttl is not None and age >= ttl:
+            return False
+        values = self.values
+        if topic in values:
+            self.nbytes -= self.sizes[topic]
+            values.move_to_end(topic)
+        values[topic] = value
+        size = self.sizes[topic] = value_size(topic, value)
+        self.nbytes += size
+        if ttl is not None:
+            # one TTL per group, so every group expires in insertion order
+            deadlines = self.deadlines.setdefault(ttl, OrderedDict())
+            deadlines.pop(topic, None)
+            deadlines[topic] = now + ttl - age
+            self.ttls[topic] = ttl
+        self._trim()
+        return True
+
+    def get(self, topic: str, now: float) -> Any:
+        """Retained value of topic, None if there is none or it expired."""
+        if topic not in self.values:
+            return None
+        ttl = self.ttls.get(topic)
+        if ttl is not None and self.deadlines[ttl][topic] <= now:
+            self.remove(topic, "ttl")
+            return None
+        self.values.move_to_end(topic)
+        return self.values[topic]
+
+    def items(self, now: float) -> List[Tuple[str, Any]]:
+        """(topic, value) of every value that did not expire."""
+        self.expire(now)
+        return list(self.values.items())
+
+    def remove(self, topic: str, reason: str = None):
+        """Drop the value of topic, counted as evicted for reason."""
+        del self.values[topic]
+        self.nbytes -= self.sizes.pop(topic)
+        ttl = self.ttls.pop(topic, None)
+        if ttl is not None:
+            del self.deadlines[ttl][topic]
+        if reason is not None:
+            self.evicted[reason] += 1
+            if self.on_evict is not None:
+                self.on_evict(topic)
+
+    def expire(self, now: float) -> int:
+        """Drop the values past their TTL, returns how many."""
+        expired = 0
+        for deadlines in self.deadlines.values():
+            while deadlines:
+                topic, deadline = next(iter(deadlines.items()))
+                if deadline > now:
+                    break
+                self.remove(topic, "ttl")
+                expired += 1
+        return expired
+
+    def _trim(self):
+        retention = self.retention
+        if retention.max_entries is not None:
+            while len(self.values) > retention.max_entries:
+                self.remove(next(iter(self.values)), "entries")
+        if retention.max_bytes is not None:
+            while self.nbytes > retention.max_bytes:
+                self.remove(next(iter(self.values)), "bytes")
@@ -0,0 +1,283 @@
+"""Durable, segmented append-only log of publishes."""
+import bisect
+import mmap
+import os
+import pickle
+import struct
+import time
+import zlib
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from . import binary
+
+
+# size (of the whole record), crc32 (of everything after it), offset,
+# timestamp, value encoding, topic size; followed by topic and value
+RECORD = struct.Struct("!IIQdBH")
+_PREFIX = struct.Struct("!II")  # size + crc32
+_REST = struct.Struct("!QdBH")
+BINARY_VALUE = ord("b")
+PICKLED_VALUE = ord("p")  # values the binary format can not represent
+
+SEGMENT_SUFFIX = ".log"
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+DEFAULT_FSYNC_INTERVAL = 1.0
+AGE_CHECK_INTERVAL = 1.0  # seconds between checks of the segment ages, see age_out()
+
+
+class Segment:
+    """One log file, named after the offset of its first record."""
+
+    def __init__(self, directory: str, base: int):
+        """Initialize segment metadata."""
+        self.base = base
+        self.path = os.path.join(directory, f"{base:020d}{SEGMENT_SUFFIX}")
+        self.offsets: List[int] = []  # sorted offsets of the records in this file
+        self.positions: List[int] = []  # file position of each record
+        self.size = 0
+        self.created = time.time()
+
+    def add(self, offset: int, position: int, size: int):
+        """Index a record."""
+        self.offsets.append(offset)
+        self.positions.append(position)
+        self.size = position + size
+
+
+class TopicLog:
+    """Append-only log of (offset, timestamp, topic, value) records.
+
+    Records are appended to the active segment and fsynced in batches (at
+    most every fsync_interval seconds). Once the log is larger than max_bytes,
+    or a segment is older than max_age seconds, old segments are compacted:
+    only the records still holding the last value of their topic are kept.
+
+    Opening the log indexes every record, but only the records of the last
+    segment (the one a crash can leave torn) are checked against their CRC."""
+
+    def __init__(self, directory: str, segment_bytes: int = DEFAULT_SEGMENT_BYTES,
+                 fsync_interval: float = DEFAULT_FSYNC_INTERVAL,
+                 max_bytes: Optional[int] = None, max_age: Optional[float] = None):
+        """Open (or create) the log in directory."""
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.segments: List[Segment] = []
+        self.latest: Dict[str, Tuple[int, Segment, int]] = {}  # topic -> (offset, segment, position)
+        self.next_offset = 0
+        self.dirty = False
+        self._last_fsync = time.monotonic()
+        self._next_age_check = 0.0
+        self._file = None
+
+        os.makedirs(directory, exist_ok=True)
+        names = sorted(name for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX))
+        for index, name in enumerate(names):
+            # sealed segments were fsynced before the next one was started
+            self._load(Segment(directory, int(name[:-len(SEGMENT_SUFFIX)])), index == len(names) - 1)
+        if not self.segments:
+            self.segments.append(Segment(directory, 0))
+        self._file = open(self.segments[-1].path, "ab")
+
+    def _load(self, segment: Segment, verify: bool):
+        """Index the records of an existing segment through a memory map.
+
+        With verify records are checked against their CRC."""
+        segment.created = os.path.getmtime(segment.path)
+        with open(segment.path, "r+b") as file:
+            length = os.fstat(file.fileno()).st_size
+            if length:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    position = self._scan(segment, data, length, verify)
+            else:
+                position = 0
+            if position < length:
+                # torn write at the tail of the log, drop it
+                file.truncate(position)
+        segment.size = position
+        self.segments.append(segment)
+
+    def _scan(self, segment: Segment, data, length: int, verify: bool) -> int:
+        position = 0
+        while position + RECORD.size <= length:
+            size, crc, offset, _, _, topic_size = RECORD.unpack_from(data, position)
+            end = position + size
+            if size < RECORD.size + topic_size or end > length:
+                break
+            if verify and zlib.crc32(data[position + _PREFIX.size:end]) != crc:
+                break
+            topic = str(data[position + RECORD.size:position + RECORD.size + topic_size], "utf-8")
+            segment.add(offset, position, size)
+            self.latest[topic] = (offset, segment, position)
+            self.next_offset = offset + 1
+            position = end
+        return position
+
+    def append(self, topic: str, value: Any, timestamp: float = None) -> int:
+        """Append a record, returns its offset."""
+        if timestamp is None:
+            timestamp = time.time()
+        try:
+            encoding, encoded = BINARY_VALUE, binary.dumps(value)
+        except binary.BinaryEncodeError:
+            encoding, encoded = PICKLED_VALUE, pickle.dumps(value)
+        topic_bytes = topic.encode("utf-8")
+        offset = self.next_offset
+        rest = _REST.pack(offset, timestamp, encoding, len(topic_bytes)) + topic_bytes + encoded
+        size = _PREFIX.size + len(rest)
+        record = _PREFIX.pack(size, zlib.crc32(rest)) + rest
+
+        segment = self.segments[-1]
+        if segment.size and segment.size + size > self.segment_bytes:
+            segment = self._roll(offset)
+        position = segment.size
+        self._file.write(record)
+        segment.add(offset, position, size)
+        self.latest[topic] = (offset, segment, position)
+        self.next_offset = offset + 1
+        self.dirty = True
+        return offset
+
+    def _roll(self, base: int) -> Segment:
+        """Start a new active segment."""
+        self.sync(force=True)
+        self._file.close()
+        segment = Segment(self.directory, base)
+        self.segments.append(segment)
+        self._file = open(segment.path, "ab")
+        self.compact()
+        return segment
+
+    def sync(self, force: bool = False):
+        """Hand buffered records to the OS, fsync them if the interval elapsed."""
+        if not self.dirty:
+            return
+        self._file.flush()
+        now = time.monotonic()
+        if force or now - self._last_fsync >= self.fsync_interval:
+            os.fsync(self._file.fileno())
+            self._last_fsync = now
+            self.dirty = False
+
+    @staticmethod
+    def _decode(data, encoding: int, topic_size: int) -> Tuple[str, Any]:
+        topic = str(data[:topic_size], "utf-8")
+        if encoding == BINARY_VALUE:
+            return topic, binary.loads(data[topic_size:])
+        return topic, pickle.loads(data[topic_size:])
+
+    def replay(self) -> Dict[str, Any]:
+        """Last value of every topic in the log."""
+        return {topic: value for _, topic, value in self.last_records()}
+
+    def last_records(self) -> List[Tuple[float, str, Any]]:
+        """(timestamp, topic, value) of the last record of every topic, in offset order."""
+        self.sync()
+        records = []
+        by_segment = {}
+        for topic, (offset, segment, position) in self.latest.items():
+            by_segment.setdefault(segment, []).append((position, offset, topic))
+        for segment, positions in by_segment.items():
+            with open(segment.path, "rb") as file:
+                if not os.fstat(file.fileno()).st_size:
+                    continue
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    for position, offset, topic in positions:
+                        size, _, _, timestamp, encoding, topic_size = RECORD.unpack_from(data, position)
+                        body = data[position + RECORD.size:position + size]
+                        records.append((offset, timestamp, topic, self._decode(body, encoding, topic_size)[1]))
+        records.sort(key=lambda record: record[0])
+        return [record[1:] for record in records]
+
+    def forget(self, topic: str):
+        """Stop keeping the last value of topic: replay() leaves it out and compaction drops it."""
+        self.latest.pop(topic, None)
+
+    def records(self, start: int = 0) -> Iterator[Tuple[int, float, str, Any]]:
+        """Yield the records from offset start on, in offset order."""
+        self.sync()
+        for segment in list(self.segments):
+            if not segment.offsets or segment.offsets[-1] < start:
+                continue
+            first = bisect.bisect_left(segment.offsets, start)
+            with open(segment.path, "rb") as file:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    for position in segment.positions[first:]:
+                        size, _, offset, timestamp, encoding, topic_size = RECORD.unpack_from(data, position)
+                        body = data[position + RECORD.size:position + size]
+                        yield (offset, timestamp, *self._decode(body, encoding, topic_size))
+
+    @property
+    def size(self) -> int:
+        """Bytes used by all the segments."""
+        return sum(segment.size for segment in self.segments)
+
+    def compact(self):
+        """Rewrite old segments keeping only the last value of each topic."""
+        now = time.time()
+        for segment in list(self.segments[:-1]):
+            too_big = self.max_bytes is not None and self.size > self.max_bytes
+            too_old = self.max_age is not None and now - segment.created > self.max_age
+            if not (too_big or too_old):
+                break
+            self._compact(segment)
+
+    def age_out(self):
+        """Compact the segments older than max_age, the active one included.
+
+        Called on every event loop iteration, checks at most every
+        AGE_CHECK_INTERVAL: without it a quiet log, which never rolls,
+        would never be compacted."""
+        if self.max_age is None:
+            return
+        now = time.monotonic()
+        if now < self._next_age_check:
+            return
+        self._next_age_check = now + AGE_CHECK_INTERVAL
+        active = self.segments[-1]
+        if active.offsets and time.time() - active.created > self.max_age:
+            self._roll(self.next_offset)  # compacts the segments before the new one
+        else:
+            self.compact()
+
+    def _compact(self, segment: Segment):
+        live = {
+            position for offset, owner, position in self.latest.values() if owner is segment
+        }
+        if not live:
+            os.remove(segment.path)
+            self.segments.remove(segment)
+            return
+        if len(live) == len(segment.offsets):
+            segment.created = time.time()  # nothing to drop, not old again before max_age
+            return
+
+        compacted = Segment(self.directory, segment.base)
+        temporary = compacted.path + ".compact"
+        with open(segment.path, "rb") as source, open(temporary, "wb") as target:
+            for offset, position in zip(segment.offsets, segment.positions):
+                if position not in live:
+                    continue
+                source.seek(position)
+                size = RECORD.unpack(source.read(RECORD.size))[0]
+                source.seek(position)
+                record = source.read(size)
+                topic_size = RECORD.unpack_from(record)[5]
+                topic = str(record[RECORD.size:RECORD.size + topic_size], "utf-8")
+                self.latest[topic] = (offset, compacted, compacted.size)
+                compacted.add(offset, compacted.size, size)
+                target.write(record)
+            target.flush()
+            os.fsync(target.fileno())
+        os.replace(temporary, compacted.path)
+        compacted.created = time.time()
+        self.segments[self.segments.index(segment)] = compacted
+
+    def close(self):
+        """Flush, fsync and close the active segment."""
+        if self._file is not None:
+            self.sync(force=True)
+            self._file.close()
+            self._file = None
@@ -0,0 +1,177 @@
+"""Hierarchical topic index used by the broker to route publishes."""
+from typing import Any, Callable, Dict, Iterator, Tuple
+
+
+SEPARATOR = "/"
+SINGLE_LEVEL = "+"  # filter segment matching any one segment
+MULTI_LEVEL = "#"  # last filter segment, matching any number of segments
+WILDCARDS = (SINGLE_LEVEL, MULTI_LEVEL)
+
+
+def split_topic(topic: str):
+    """Split a topic into its '/' separated segments."""
+    return topic.split(SEPARATOR)
+
+
+def is_pattern(topic: str) -> bool:
+    """True if topic is a filter with wildcard segments."""
+    return any(segment in WILDCARDS for segment in split_topic(topic))
+
+
+def compile_filter(topic_filter: str) -> Callable[[str], bool]:
+    """Predicate telling whether a topic matches topic_filter.
+
+    Same semantics as TopicTrie.match: a filter matches a topic and all of
+    its subtopics."""
+    if not is_pattern(topic_filter):
+        prefix = topic_filter + SEPARATOR
+        return lambda topic: topic == topic_filter or topic.startswith(prefix)
+
+    segments = split_topic(topic_filter)
+
+    def matches(topic: str) -> bool:
+        topic_segments = split_topic(topic)
+        for index, segment in enumerate(segments):
+            if segment == MULTI_LEVEL:
+                return True
+            if index >= len(topic_segments):
+                return False
+            if segment != SINGLE_LEVEL and segment != topic_segments[index]:
+                return False
+        return True
+
+    return matches
+
+
+class _Node:
+    """Trie node: one topic segment."""
+
+    __slots__ = ("children", "topic", "value")
+
+    def __init__(self):
+        """Initialize empty node."""
+        self.children: Dict[str, "_Node"] = {}
+        self.topic = None
+        self.value = None
+
+
+class TopicTrie:
+    """Trie keyed on topic segments.
+
+    Every stored topic owns a value (the broker stores its subscribers there).
+    A publish to "/a/b/c" is matched against "/a/b/c" and all of its ancestors
+    ("/a/b", "/a", ...) by walking down the trie, so the cost of a lookup is
+    the depth of the topic and not the number of stored topics.
+
+    Stored topics may be MQTT style filters: "+" segments are children like
+    any other, followed alongside the literal segment during match(), so
+    wildcard filters sharing a prefix share their nodes too."""
+
+    def __init__(self):
+        """Initialize empty trie."""
+        self.root = _Node()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, topic: str):
+        node = self._find(topic)
+        return node is not None and node.topic is not None
+
+    def _find(self, topic: str):
+        node = self.root
+        for segment in split_topic(topic):
+            node = node.children.get(segment)
+            if node is None:
+                return None
+        return node
+
+    def get(self, topic: str, default: Any = None) -> Any:
+        """Return the value stored for topic."""
+        node = self._find(topic)
+        if node is None or node.topic is None:
+            return default
+        return node.value
+
+    def setdefault(self, topic: str, default: Any) -> Any:
+        """Return the value stored for topic, inserting default if missing."""
+        node = self.root
+        for segment in split_topic(topic):
+            child = node.children.get(segment)
+            if child is None:
+                child = node.children[segment] = _Node()
+            node = child
+        if node.topic is None:
+            node.topic = topic
+            node.value = default
+            self._size += 1
+        return node.value
+
+    def pop(self, topic: str, default: Any = None) -> Any:
+        """Remove topic from the trie, pruning branches left empty."""
+        path = [self.root]
+        segments = split_topic(topic)
+        for segment in segments:
+            child = path[-1].children.get(segment)
+            if child is None:
+                return default
+            path.append(child)
+
+        node = path[-1]
+        if node.topic is None:
+            return default
+        value = node.value
+        node.topic = None
+        node.value = None
+        self._size -= 1
+
+        for segment, parent in zip(reversed(segments), reversed(path[:-1])):
+            child = parent.children[segment]
+            if child.topic is not None or child.children:
+                break
+            del parent.children[segment]
+        return value
+
+    def prefixes(self, topic: str) -> Iterator[Tuple[str, Any]]:
+        """Yield (stored_topic, value) for topic and every stored ancestor."""
+        node = self.root
+        for segment in split_topic(topic):
+            node = node.children.get(segment)
+            if node is None:
+                return
+            if node.topic is not None:
+                yield node.topic, node.value
+
+    def match(self, topic: str) -> Iterator[Tuple[str, Any]]:
+        """Yield (stored_topic, value) for every stored filter matching topic.
+
+        A filter matches a topic and its subtopics, "+" matches any single
+        segment and a trailing "#" any number of segments (including none)."""
+        nodes = [self.root]
+        for segment in split_topic(topic):
+            matched = []
+            for node in nodes:
+                children = node.children
+                if not children:
+                    continue
+                rest = children.get(MULTI_LEVEL)
+                if rest is not None and rest.topic is not None:
+                    yield rest.topic, rest.value
+                if segment not in WILDCARDS:
+                    child = children.get(segment)
+                    if child is not None:
+                        matched.append(child)
+                child = children.get(SINGLE_LEVEL)
+                if child is not None:
+                    matched.append(child)
+            for node in matched:
+                if node.topic is not None:
+                    yield node.topic, node.value
+            if not matched:
+                return
+            nodes = matched
+        for node in nodes:
+            rest = node.children.get(MULTI_LEVEL)
+            if rest is not None and rest.topic is not None:
+                yield rest.topic, rest.value
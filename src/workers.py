@@ -0,0 +1,82 @@
+"""Multi-process broker: workers sharing one port through SO_REUSEPORT."""
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+from typing import List
+
+from .broker import Broker
+from .metrics import serve_http
+from .profiling import Profiler
+from .storage import TopicLog
+
+
+def channels(workers: int) -> List[List[socket.socket]]:
+    """Full mesh of local channels, channels()[i] are the ends owned by worker i."""
+    ends = [[] for _ in range(workers)]
+    for i in range(workers):
+        for j in range(i + 1, workers):
+            a, b = socket.socketpair()
+            ends[i].append(a)
+            ends[j].append(b)
+    return ends
+
+
+def _worker(index: int, ends: List[List[socket.socket]], host: str, port: int,
+            log_dir: str, log_options: dict, metrics_port: int, profile: dict, options: dict):
+    for owner, sockets in enumerate(ends):
+        if owner != index:
+            for sock in sockets:
+                sock.close()
+    log = None
+    if log_dir is not None:
+        log = TopicLog(os.path.join(log_dir, f"worker-{index}"), **log_options)
+    broker = Broker(host, port, reuse_port=True, peers=ends[index], log=log, **options)
+    if metrics_port is not None:
+        serve_http(broker.metrics, host, metrics_port + index)
+    if profile is not None:
+        Profiler(broker, **profile).start()
+    broker.run()
+
+
+def run_workers(workers: int, host: str = "localhost", port: int = 5000,
+                log_dir: str = None, log_options: dict = None, metrics_port: int = None,
+                profile: dict = None, **options):
+    """Run workers broker processes until interrupted.
+
+    Each worker accepts its share of the client connections and forwards the
+    publishes it receives to the other workers, so every subscriber gets every
+    message whatever worker it is connected to. Consumer groups are refused
+    (see Broker.dispatch). With log_dir every worker keeps
+    its own (complete) log in a subdirectory, opened with log_options (the
+    TopicLog options). With metrics_port worker i
+    serves its metrics over HTTP on metrics_port + i, and with profile (the
+    Profiler options) every worker dumps its own profile."""
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise RuntimeError("SO_REUSEPORT is not supported on this platform")
+
+    ends = channels(workers)
+    context = multiprocessing.get_context("fork")  # the workers inherit the channels
+    processes = [
+        context.Process(target=_worker, daemon=True,
+                        args=(index, ends, host, port, log_dir, log_options or {}, metrics_port,
+                              profile, options))
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for sockets in ends:
+        for sock in sockets:
+            sock.close()
+
+    # make SIGTERM run the cleanup below instead of orphaning the workers
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
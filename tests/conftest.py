@@ -3,7 +3,8 @@ import time
 
 import pytest
 
-from src.broker import Broker
+from src.broker import Broker, BrokerCore
+from src.protocol import FRAME_V2, FrameReader
 
 
 @pytest.fixture(scope="session")
@@ -16,3 +17,49 @@ def broker():
     yield broker
     broker.canceled = True
     thread.join(timeout=5)
+
+
+class Recorder(BrokerCore):
+    """Routing core that keeps the decoded messages sent to each connection."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.sent = {}
+
+    def version_of(self, conn):
+        return FRAME_V2
+
+    def deliver(self, conn, frame, key=None):
+        self.sent.setdefault(conn, []).extend(FrameReader(None).feed(frame))
+
+    def records(self, conn):
+        received = []
+        for message in self.sent.get(conn, []):
+            if message.command == "publish_batch":
+                received.extend(tuple(record) for record in message.records)
+            else:
+                received.append((message.topic, message.message))
+        return received
+
+    def drain(self):
+        while self.replays:
+            self.catch_up()
+
+
+class SlowSocket:
+    """Accepts at most `room` bytes per send."""
+
+    def __init__(self, room):
+        self.room = room
+        self.data = b""
+
+    def send(self, data):
+        if not self.room:
+            raise BlockingIOError
+        sent = bytes(data[: self.room])
+        self.data += sent
+        return len(sent)
+
+
+def samples(stats, name):
+    return {tuple(sorted(labels.items())): value for labels, value in stats[name]["samples"]}
@@ -0,0 +1,84 @@
+"""Test the asyncio broker engine."""
+import socket
+import threading
+import time
+
+import pytest
+
+from src.async_broker import AsyncBroker
+from src.middleware import MiddlewareType, PickleQueue
+from src.outbox import OverflowPolicy
+from src.protocol import FRAME_V1, JSON, PICKLE, PubSub
+
+PORT = 5123
+
+
+@pytest.fixture(scope="module")
+def async_broker():
+    broker = AsyncBroker(port=PORT, outbox_limit=4096, overflow_policy=OverflowPolicy.DROP_OLDEST)
+    thread = threading.Thread(target=broker.run, daemon=True)
+    thread.start()
+    time.sleep(0.5)
+    yield broker
+    broker.canceled = True
+    thread.join(timeout=5)
+
+
+def connect():
+    sock = socket.create_connection(("localhost", PORT))
+    sock.settimeout(5)
+    return sock
+
+
+def test_publish_subscribe(async_broker):
+    publisher = connect()
+    PubSub.send_msg(publisher, PubSub.publish(1, "/async/a"), JSON)
+    time.sleep(0.1)
+
+    consumer = connect()
+    PubSub.send_msg(consumer, PubSub.subscribe("/async", PICKLE), PICKLE)
+    legacy = connect()
+    PubSub.send_msg(legacy, PubSub.subscribe("/async/a", JSON), JSON, FRAME_V1)
+    time.sleep(0.1)
+    assert PubSub.recv_msg(legacy).message == 1  # retained value
+
+    PubSub.send_msg(publisher, PubSub.publish_batch([("/async/a", 2), ("/async/b", 3)]), JSON)
+    assert [PubSub.recv_msg(consumer).message for _ in range(2)] == [2, 3]
+    assert PubSub.recv_msg(legacy).message == 2
+    assert async_broker.get_topic("/async/b") == 3
+
+    for sock in (publisher, consumer, legacy):
+        sock.close()
+    time.sleep(0.1)
+    assert async_broker.list_subscriptions("/async") == []
+
+
+def test_slow_consumer_does_not_stall(async_broker):
+    slow = connect()
+    slow.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    PubSub.send_msg(slow, PubSub.subscribe("/async/slow", PICKLE), PICKLE)
+    fast = connect()
+    PubSub.send_msg(fast, PubSub.subscribe("/async/slow", PICKLE), PICKLE)
+    time.sleep(0.1)
+
+    publisher = connect()
+    payload = "x" * 1000
+    for i in range(2000):
+        PubSub.send_msg(publisher, PubSub.publish([i, payload], "/async/slow"), PICKLE)
+
+    received = [PubSub.recv_msg(fast).message[0] for _ in range(2000)]
+    assert received == list(range(2000))
+    # whatever the slow consumer did not read yet stays bounded
+    assert all(conn.outbox.nbytes <= 4096 for conn in async_broker.connections)
+    for sock in (slow, fast, publisher):
+        sock.close()
+
+
+def test_queues_on_another_port(async_broker):
+    consumer = PickleQueue("/async/port", port=PORT)
+    producer = PickleQueue("/async/port", _type=MiddlewareType.PRODUCER, port=PORT)
+    time.sleep(0.1)
+    producer.push(7)
+    assert consumer.pull(timeout=5) == ("/async/port", 7)
+    consumer.close()
+    producer.close()
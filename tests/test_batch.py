@@ -0,0 +1,79 @@
+"""Test batch publishing."""
+import random
+import string
+import threading
+import time
+
+import pytest
+
+from src.clients import Consumer, Producer
+from src.middleware import BinaryQueue, JSONQueue, MiddlewareType, PickleQueue, XMLQueue
+from src.protocol import JSON, XML, PubSub
+
+ROOT = "/" + "".join(random.sample(string.ascii_lowercase, 6))
+
+
+def gen():
+    while True:
+        yield random.randint(0, 100)
+
+
+class SendCounter:
+    """Wraps a socket counting the send calls."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.sends = 0
+
+    def send(self, data):
+        self.sends += 1
+        return self.sock.send(data)
+
+
+@pytest.fixture
+def consumer():
+    consumer = Consumer(ROOT, PickleQueue)
+    threading.Thread(target=consumer.run, args=(1000,), daemon=True).start()
+    time.sleep(0.1)
+    return consumer
+
+
+@pytest.mark.parametrize("_format", [JSON, XML])
+def test_batch_message(_format):
+    msg = PubSub.publish_batch([("/a", "1"), ("/b", "x\"<y")])
+    decoded = PubSub.decode(_format, PubSub.serialize(msg, _format))
+    assert decoded.command == "publish_batch"
+    assert [tuple(r) for r in decoded.records] == [("/a", "1"), ("/b", "x\"<y")]
+
+
+@pytest.mark.parametrize("queue_type", [JSONQueue, PickleQueue, BinaryQueue])
+def test_push_many(consumer, broker, queue_type):
+    topic = f"{ROOT}/{queue_type.__name__}"
+    queue = queue_type(topic, _type=MiddlewareType.PRODUCER)
+    queue.sock = SendCounter(queue.sock)
+    values = list(range(20))
+    queue.push_many(values)
+    time.sleep(0.1)
+
+    assert queue.sock.sends == 1
+    assert consumer.received[-20:] == values
+    assert broker.get_topic(topic) == 19
+
+
+def test_auto_batching(consumer, broker):
+    producer = Producer(f"{ROOT}/auto", gen, JSONQueue, max_batch=4, linger=10)
+    producer.queue[0].sock = SendCounter(producer.queue[0].sock)
+    producer.run(10)
+    time.sleep(0.1)
+
+    assert producer.queue[0].sock.sends == 3  # 4 + 4 + 2 flushed at the end
+    assert consumer.received[-10:] == producer.produced
+
+
+def test_linger(consumer, broker):
+    queue = XMLQueue(f"{ROOT}/linger", _type=MiddlewareType.PRODUCER, max_batch=100, linger=0.05)
+    for value in ["a", "b", "c"]:
+        queue.push(value)
+    time.sleep(0.3)
+
+    assert consumer.received[-3:] == ["a", "b", "c"]
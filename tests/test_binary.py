@@ -0,0 +1,134 @@
+"""Test the compact binary serialization."""
+import datetime
+import random
+import socket
+import string
+import struct
+import threading
+import time
+
+import pytest
+
+from src import binary
+from src.clients import Consumer, Producer
+from src.middleware import BinaryQueue, JSONQueue, MiddlewareType, PickleQueue
+from src.protocol import BINARY, PICKLE, PubSub, PubSubBadFormat, pack_frame
+from tests.conftest import Recorder
+
+TOPIC = "/" + "".join(random.sample(string.ascii_lowercase, 6))
+
+VALUES = [
+    None,
+    True,
+    False,
+    0,
+    -128,
+    127,
+    40000,
+    -(2**40),
+    2**70,
+    3.25,
+    "",
+    "São lágrimas de Portugal!",
+    b"\x00\xff",
+    [1, "a", [2.5, None]],
+    {"a": 1, 2: [3]},
+]
+
+
+@pytest.mark.parametrize("value", VALUES)
+def test_roundtrip(value):
+    assert binary.loads(binary.dumps(value)) == value
+    assert binary.unpack(binary.pack("publish", "/t", value)) == ("publish", "/t", value)
+
+
+def test_messages():
+    for msg in [
+        PubSub.subscribe("/a", BINARY),
+        PubSub.publish({"x": 1.5}, "/a/b"),
+        PubSub.cancel("/a"),
+    ]:
+        decoded = PubSub.decode(BINARY, PubSub.serialize(msg, BINARY))
+        assert decoded.__dict__ == msg.__dict__
+
+
+def test_compact():
+    assert len(binary.pack("publish", "/temp", 21)) == 10
+
+
+def test_malformed():
+    with pytest.raises(binary.BinaryDecodeError):
+        binary.unpack(binary.pack("publish", "/temp", "abc")[:-1])
+    bad_digits = struct.pack("!BI", binary.BIGINT, 3) + b"1x2"
+    list_key = struct.pack("!BI", binary.MAP, 1) + binary.dumps([1]) + binary.dumps(2)
+    too_deep = struct.pack("!BI", binary.LIST, 1) * 100000 + binary.dumps(None)
+    for payload in (bad_digits, list_key, too_deep):
+        with pytest.raises(binary.BinaryDecodeError):
+            binary.loads(payload)
+
+
+def test_fuzz_raises_decode_errors_only():
+    rng = random.Random(7)
+    valid = [binary.pack("publish_batch", None, [["/t", value] for value in VALUES])]
+    valid += [binary.pack("publish", "/t", value) for value in VALUES]
+    for _ in range(5000):
+        payload = bytearray(rng.choice(valid))
+        for _ in range(rng.randint(1, 4)):
+            payload[rng.randrange(len(payload))] = rng.randrange(256)
+        try:
+            binary.unpack(payload)
+        except binary.BinaryDecodeError:
+            pass
+        try:
+            PubSub.decode(BINARY, bytes(payload))
+        except PubSubBadFormat:
+            pass
+
+
+def test_unrepresentable_value_is_dropped():
+    core = Recorder()
+    core.subscribe("/temp", "binary", BINARY)
+    core.subscribe("/temp", "pickle", PICKLE)
+    core.put_topic("/temp", datetime.date(2024, 1, 1))
+    assert core.records("binary") == []
+    assert core.records("pickle") == [("/temp", datetime.date(2024, 1, 1))]
+    with pytest.raises(binary.BinaryEncodeError):
+        binary.dumps(datetime.date(2024, 1, 1))
+
+
+def test_broker_survives_malformed_binary(broker):
+    topic = TOPIC + "/survive"
+    binary_consumer = BinaryQueue(topic)
+    consumer = PickleQueue(topic)
+    producer = PickleQueue(topic, _type=MiddlewareType.PRODUCER)
+    time.sleep(0.1)
+    producer.push(datetime.date(2024, 1, 1))  # BINARY can not represent it
+    bad_digits = struct.pack("!BI", binary.BIGINT, 3) + b"1x2"
+    with socket.create_connection(("localhost", 5000)) as sender:
+        sender.sendall(pack_frame(BINARY, binary.pack("publish_batch")[:-1] + bad_digits))
+        time.sleep(0.1)
+    producer.push(1)
+    assert consumer.pull(timeout=5) == (topic, datetime.date(2024, 1, 1))
+    assert consumer.pull(timeout=5) == (topic, 1)
+    assert binary_consumer.pull(timeout=5) == (topic, 1)
+    for queue in (binary_consumer, consumer, producer):
+        queue.close()
+
+
+def gen():
+    while True:
+        yield random.random()
+
+
+def test_binary_consumer(broker):
+    consumer = Consumer(TOPIC, BinaryQueue)
+    threading.Thread(target=consumer.run, daemon=True).start()
+    time.sleep(0.1)
+
+    Producer(TOPIC, gen, JSONQueue).run(2)
+    producer = Producer(TOPIC, gen, BinaryQueue)
+    producer.run(3)
+    time.sleep(0.1)
+
+    assert consumer.received[-3:] == producer.produced
+    assert broker.get_topic(TOPIC) == producer.produced[-1]
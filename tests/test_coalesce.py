@@ -0,0 +1,24 @@
+"""Test coalesced writes of the selector broker."""
+import socket
+import time
+
+from src.protocol import PICKLE, PubSub
+
+
+def test_fanout_frames_share_a_write(broker):
+    consumer = socket.create_connection(("localhost", 5000))
+    consumer.settimeout(5)
+    PubSub.send_msg(consumer, PubSub.subscribe("/coalesce", PICKLE), PICKLE)
+    publisher = socket.create_connection(("localhost", 5000))
+    time.sleep(0.1)
+
+    records = [("/coalesce/a", i) for i in range(50)]
+    PubSub.send_msg(publisher, PubSub.publish_batch(records), PICKLE)
+    assert [PubSub.recv_msg(consumer).message for _ in range(50)] == list(range(50))
+
+    time.sleep(0.1)  # the broker counts the write after sendmsg returned
+    conn = next(iter(broker.subscriptions["/coalesce"]))
+    assert broker.outboxes[conn].writes == 1
+    assert conn.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+    consumer.close()
+    publisher.close()
@@ -0,0 +1,78 @@
+"""Test conflating subscriptions."""
+import time
+
+from src.broker import BrokerCore
+from src.flow import Flow
+from src.middleware import MiddlewareType, PickleQueue
+from src.outbox import Outbox
+from src.protocol import FRAME_V2, PICKLE, FrameReader
+from tests.conftest import SlowSocket
+
+
+class Stalled(BrokerCore):
+    """Routing core whose connections do not take anything yet."""
+
+    def __init__(self):
+        super().__init__()
+        self.outboxes = {}
+
+    def version_of(self, conn):
+        return FRAME_V2
+
+    def deliver(self, conn, frame, key=None):
+        if conn not in self.outboxes:
+            self.outboxes[conn] = Outbox(SlowSocket(0))
+        self.outboxes[conn].push(frame, key)
+
+    def values(self, conn):
+        return [(m.topic, m.message) for frame in self.outboxes[conn].frames
+                for m in FrameReader(None).feed(frame)]
+
+
+def test_slow_subscriber_gets_the_latest_value():
+    core = Stalled()
+    core.subscribe("/sensors", "slow", PICKLE, conflate=True)
+    core.subscribe("/sensors", "all", PICKLE)
+    for i in range(100):
+        core.put_topic("/sensors/temp", i)
+        core.put_topic("/sensors/weather", -i)
+
+    # one value per published topic, both carry the subscribed topic
+    assert core.values("slow") == [("/sensors", 99), ("/sensors", -99)]
+    assert len(core.outboxes["all"]) == 200
+
+    core.subscribe("/sensors", "slow", PICKLE)
+    core.put_topic("/sensors/temp", 100)
+    assert len(core.outboxes["slow"]) == 3
+
+
+def test_held_messages_conflate():
+    flow = Flow("/sensors", PICKLE, 0)
+    for offset in range(5):
+        flow.hold(offset, offset, key="temp")
+    flow.hold(5, "other")
+    flow.hold(6, 6, key="temp")
+    assert list(flow.pending) == [(6, 6), (5, "other")]
+    assert flow.conflated == 5
+
+
+def test_at_least_once_does_not_conflate():
+    core = Stalled()
+    core.subscribe("/sensors", "conn", PICKLE, ack=True, conflate=True)
+    for i in range(3):
+        core.put_topic("/sensors/temp", i)
+    assert len(core.outboxes["conn"]) == 3
+
+
+def test_conflating_queue(broker):
+    consumer = PickleQueue("/conflate/temp", prefetch=1, conflate=True)
+    producer = PickleQueue("/conflate/temp", _type=MiddlewareType.PRODUCER)
+    time.sleep(0.1)
+    for i in range(100):
+        producer.push(i)
+    time.sleep(0.2)
+
+    assert consumer.pull(timeout=5) == ("/conflate/temp", 0)
+    assert consumer.pull(timeout=5) == ("/conflate/temp", 99)
+    assert consumer.pull(timeout=0.3) is None
+    consumer.close()
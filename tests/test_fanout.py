@@ -0,0 +1,39 @@
+"""Test publish fan-out to many subscribers."""
+import json
+import socket
+from unittest.mock import MagicMock, patch
+
+from src.broker import Broker
+from src.protocol import JSON, PICKLE
+
+
+def test_encode_once_per_format():
+    broker = Broker(port=5130)
+    json_subscribers = [socket.socketpair() for _ in range(5)]
+    pickle_subscribers = [socket.socketpair() for _ in range(3)]
+    for conn, _ in json_subscribers:
+        broker.add_connection(conn)
+        broker.subscribe("/fanout", conn, JSON)
+    for conn, _ in pickle_subscribers:
+        broker.add_connection(conn)
+        broker.subscribe("/fanout", conn, PICKLE)
+
+    with patch("json.dumps", MagicMock(side_effect=json.dumps)) as json_dump:
+        broker.put_topic("/fanout/value", 1234)
+    assert json_dump.call_count == 1
+
+    assert broker.encode_misses == 2
+    assert broker.encode_hits == 6
+    assert 0 < broker.encode_hit_ratio() <= 1
+
+    broker.flush_writes()
+    frames = {peer.recv(65536) for _, peer in json_subscribers}
+    assert len(frames) == 1
+    frames = {peer.recv(65536) for _, peer in pickle_subscribers}
+    assert len(frames) == 1
+
+    for conn, peer in json_subscribers + pickle_subscribers:
+        broker.disconnect(conn)
+        peer.close()
+    assert broker.list_subscriptions("/fanout") == []
+    broker.sock.close()
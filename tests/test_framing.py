@@ -0,0 +1,208 @@
+"""Test the non-blocking frame reader."""
+import json
+import pickle
+import socket
+import time
+
+import pytest
+
+from src.metrics import Metrics
+from src.protocol import (
+    BINARY,
+    FLAG_ROUTED,
+    FRAME_V1,
+    FRAME_V2,
+    JSON,
+    PICKLE,
+    XML,
+    FrameReader,
+    FrameTooLarge,
+    Payload,
+    PubSub,
+    PubSubBadFormat,
+    pack_frame,
+    parse_header,
+)
+from src.middleware import MiddlewareType, PickleQueue
+
+
+class FakeSocket:
+    """Hands out the stream in the given chunks, one per recv_into."""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, buffer):
+        if not self.chunks:
+            raise BlockingIOError
+        chunk = self.chunks.pop(0)
+        buffer[: len(chunk)] = chunk
+        return len(chunk)
+
+    def send(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+
+def encode(messages, version=FRAME_V2):
+    sock = FakeSocket([])
+    for message, _format in messages:
+        PubSub.send_msg(sock, message, _format, version)
+    return b"".join(sock.chunks)
+
+
+MESSAGES = [
+    (PubSub.subscribe("/a", PICKLE), PICKLE),
+    (PubSub.publish(42, "/a/b"), JSON),
+    (PubSub.publish("xml value", "/a"), XML),
+    (PubSub.cancel("/a"), PICKLE),
+]
+
+
+def check(received):
+    assert [m.command for m in received] == ["subscribe", "publish", "publish", "cancel"]
+    assert received[1].message == 42
+    assert received[2].message == "xml value"
+    assert received[3].topic == "/a"
+
+
+def test_many_frames_per_read():
+    reader = FrameReader(FakeSocket([encode(MESSAGES)]))
+    check(reader.read())
+    assert reader.read() == []
+    assert not reader.closed
+
+
+@pytest.mark.parametrize("version", [FRAME_V1, FRAME_V2])
+@pytest.mark.parametrize("step", [1, 2, 3, 7])
+def test_partial_frames(step, version):
+    stream = encode(MESSAGES, version)
+    reader = FrameReader(
+        FakeSocket([stream[i : i + step] for i in range(0, len(stream), step)])
+    )
+    received = []
+    for _ in range(len(stream)):
+        received += reader.read()
+    check(received)
+
+
+def test_closed_connection():
+    a, b = socket.socketpair()
+    b.setblocking(False)
+    reader = FrameReader(b)
+    a.close()
+    assert reader.read() == []
+    assert reader.closed
+    b.close()
+
+
+@pytest.mark.parametrize("version", [FRAME_V1, FRAME_V2])
+def test_version_detection(version):
+    reader = FrameReader(FakeSocket([encode(MESSAGES[:1], version)]))
+    assert reader.version is None
+    reader.read()
+    assert reader.version == version
+
+
+def test_large_payload():
+    value = "x" * 200_000
+    stream = encode([(PubSub.publish(value, "/big"), JSON)])
+    reader = FrameReader(
+        FakeSocket([stream[i : i + 65536] for i in range(0, len(stream), 65536)])
+    )
+    received = []
+    while not received:
+        received += reader.read()
+    assert received[0].message == value
+
+    with pytest.raises(FrameTooLarge):
+        encode([(PubSub.publish(value, "/big"), JSON)], FRAME_V1)
+
+
+def test_compressed_payload():
+    payload = PubSub.serialize(PubSub.publish("a" * 1000, "/z"), PICKLE)
+    frame = pack_frame(PICKLE, payload, compress=True)
+    assert len(frame) < len(payload)
+    (message,) = FrameReader(FakeSocket([frame])).read()
+    assert message.message == "a" * 1000
+
+
+def test_blocking_recv():
+    a, b = socket.socketpair()
+    a.sendall(encode(MESSAGES[1:2], FRAME_V1) + encode(MESSAGES[2:3], FRAME_V2))
+    assert PubSub.recv_msg(b).message == 42
+    assert PubSub.recv_msg(b).message == "xml value"
+    a.close()
+    assert PubSub.recv_msg(b) is None
+    b.close()
+
+
+def roundtrip_messages(fmt):
+    """(message, fields it must carry unchanged) for every command."""
+    stats = Metrics().snapshot() | {"x": {"type": "gauge", "help": "", "samples": [[{"a": "b"}, 1.5]]}}
+    subscribe = ("topic", "offset", "since", "group", "credit", "ack", "conflate")
+    return [
+        (PubSub.subscribe("/a", fmt), subscribe),
+        (PubSub.subscribe("/a", fmt, 42, 1700000000.5, "workers", 10, True, True), subscribe),
+        (PubSub.publish("value", "/a/b"), ("topic", "message", "offset", "subscription")),
+        (PubSub.publish("v", "/a/b", 1 << 40, "/a/+"), ("topic", "message", "offset", "subscription")),
+        (PubSub.publish_batch([("/a/b", "1")], "/a/#"), ("topic", "records")),
+        (PubSub.credit("/a", 5), ("topic", "credit")),
+        (PubSub.ack("/a", 1 << 40), ("topic", "offset")),
+        (PubSub.cancel("/a"), ("topic",)),
+        (PubSub.stats(), ("stats",)),
+        (PubSub.stats(stats), ("stats",)),
+    ]
+
+
+def plain(value):
+    return tuple(plain(item) for item in value) if isinstance(value, (list, tuple)) else value
+
+
+@pytest.mark.parametrize("fmt", [JSON, XML, PICKLE, BINARY])
+def test_messages_roundtrip(fmt):
+    for message, fields in roundtrip_messages(fmt):
+        frame = PubSub.encode(message, fmt)
+        decoded = FrameReader(None).feed(frame)[0]
+        assert decoded.command == message.command
+        assert [plain(getattr(decoded, f)) for f in fields] == [plain(getattr(message, f)) for f in fields]
+        if message.command == "subscribe":
+            assert int(decoded.format) == fmt
+        if message.command == "publish":
+            assert parse_header(frame)[2] & FLAG_ROUTED
+            lazy = FrameReader(None, lazy=True).feed(frame)[0]
+            assert isinstance(lazy.message, Payload)
+            assert (lazy.message.format, lazy.message.value) == (fmt, message.message)
+
+
+@pytest.mark.parametrize("fmt, payload", [
+    (JSON, b"{not json"),
+    (JSON, b"\xff"),
+    (JSON, b"5"),
+    (JSON, json.dumps({"topic": "/a"}).encode()),
+    (JSON, json.dumps({"command": "publish", "message": 1}).encode()),
+    (JSON, json.dumps({"command": "publish", "topic": 5, "message": 1}).encode()),
+    (JSON, json.dumps({"command": "publish_batch", "records": [["/a", 1, 2]]}).encode()),
+    (JSON, json.dumps({"command": "credit", "topic": "/a", "credit": "many"}).encode()),
+    (XML, b"<data command="),
+    (XML, b'<data command="publish_batch"><record message="1"/></data>'),
+    (PICKLE, b"not a pickle"),
+    (PICKLE, pickle.dumps([1, 2])),
+])
+def test_malformed_payloads(fmt, payload):
+    with pytest.raises(PubSubBadFormat):
+        FrameReader(None).feed(pack_frame(fmt, payload, FRAME_V1))
+
+
+def test_broker_drops_the_bad_frame_sender(broker):
+    consumer = PickleQueue("/framing/survive")
+    time.sleep(0.1)
+    with socket.create_connection(("localhost", 5000)) as sender:
+        sender.sendall(pack_frame(JSON, b"{not json", FRAME_V1))
+        sender.settimeout(5)
+        assert sender.recv(1) == b""  # dropped by the broker
+    producer = PickleQueue("/framing/survive", _type=MiddlewareType.PRODUCER)
+    producer.push(1)
+    assert consumer.pull(timeout=5) == ("/framing/survive", 1)
+    consumer.close()
+    producer.close()
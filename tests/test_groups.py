@@ -0,0 +1,82 @@
+"""Test consumer groups."""
+import threading
+import time
+
+from src.clients import Consumer
+from src.groups import ConsumerGroup, GroupStrategy
+from src.middleware import MiddlewareType, PickleQueue
+from src.protocol import PICKLE
+from tests.conftest import Recorder
+
+
+def test_round_robin_rebalances():
+    group = ConsumerGroup("g")
+    for member in "abc":
+        group.add(member)
+    assert [group.choose(None) for _ in range(4)] == ["a", "b", "c", "a"]
+    group.remove("a")
+    assert [group.choose(None) for _ in range(3)] == ["b", "c", "b"]
+    group.remove("c")
+    assert [group.choose(None) for _ in range(2)] == ["b", "b"]
+
+
+def test_least_outstanding():
+    group = ConsumerGroup("g", GroupStrategy.LEAST_OUTSTANDING)
+    for member in "abc":
+        group.add(member)
+    outstanding = {"a": 10, "b": 0, "c": 5}
+    assert group.choose(outstanding.get) == "b"
+    outstanding["b"] = 20
+    assert group.choose(outstanding.get) == "c"
+    outstanding.update(a=0, c=0)
+    assert [group.choose(outstanding.get) for _ in range(2)] == ["a", "c"]
+
+
+def test_least_outstanding_counts_unacked_messages():
+    core = Recorder(group_strategy=GroupStrategy.LEAST_OUTSTANDING)
+    for member in ("slow", "fast"):
+        core.subscribe("/groups/jobs", member, PICKLE, group="workers", credit=10)
+    for i in range(5):
+        core.put_topic("/groups/jobs", i)
+        if core.sent.get("fast"):
+            core.ack("fast", "/groups/jobs", core.sent["fast"][-1].offset)
+    assert [v for _, v in core.records("slow")] == [0]
+    assert [v for _, v in core.records("fast")] == [1, 2, 3, 4]
+
+
+def test_each_publish_goes_to_one_member():
+    core = Recorder()
+    members = ["w1", "w2", "w3"]
+    for member in members:
+        core.subscribe("/groups/jobs", member, PICKLE, group="workers")
+    core.subscribe("/groups", "monitor", PICKLE)
+
+    for i in range(9):
+        core.put_topic("/groups/jobs", i)
+    assert [len(core.records(member)) for member in members] == [3, 3, 3]
+    assert len(core.records("monitor")) == 9
+
+    core.forget("w2")
+    for i in range(9, 13):
+        core.put_topic("/groups/jobs", i)
+    assert len(core.records("w2")) == 3
+    received = sorted(v for member in members for _, v in core.records(member))
+    assert received == list(range(13))
+
+    core.forget("w1")
+    core.forget("w3")
+    assert not core.groups and not core.member_groups
+
+
+def test_consumers_share_a_topic(broker):
+    consumers = [Consumer("/groups/live", PickleQueue, group="workers") for _ in range(2)]
+    for consumer in consumers:
+        threading.Thread(target=consumer.run, args=(1000,), daemon=True).start()
+    producer = PickleQueue("/groups/live", _type=MiddlewareType.PRODUCER)
+    time.sleep(0.1)
+
+    for i in range(10):
+        producer.push(i)
+    time.sleep(0.3)
+    assert [len(consumer.received) for consumer in consumers] == [5, 5]
+    assert sorted(consumers[0].received + consumers[1].received) == list(range(10))
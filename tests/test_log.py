@@ -0,0 +1,74 @@
+"""Test the logging subsystem."""
+import logging
+import queue
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from src import log
+
+
+def record(level=logging.INFO, line=1):
+    return logging.LogRecord("test", level, "test.py", line, "value %s", (1,), None)
+
+
+def test_importing_configures_nothing():
+    code = ("import logging, src.broker, src.async_broker, src.protocol, src.clients, src.log;"
+            "print(len(logging.getLogger().handlers), logging.getLogger().level)")
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    assert output.stdout.split() == ["0", str(logging.WARNING)]
+
+
+def test_sampling_per_call_site():
+    sample = log.SampleFilter(3)
+    kept = [sample.filter(record(line=line)) for _ in range(6) for line in (1, 2)]
+    assert kept.count(True) == 4
+    assert sample.dropped == 8
+    assert all(sample.filter(record(logging.WARNING)) for _ in range(5))
+
+
+def test_rate_limit():
+    limit = log.RateLimitFilter(rate=5)
+    kept = [limit.filter(record()) for _ in range(20)]
+    assert kept.count(True) == 5
+    assert limit.dropped == 15
+    assert limit.filter(record(logging.ERROR))
+
+
+def test_full_queue_drops():
+    handler = log.DroppingQueueHandler(queue.Queue(1))
+    handler.handle(record())
+    handler.handle(record())
+    assert handler.dropped == 1
+
+
+@pytest.fixture
+def root_level():
+    level = logging.getLogger().level
+    yield
+    log.shutdown()
+    logging.getLogger().setLevel(level)
+
+
+def test_listener_writes_the_file(tmp_path, root_level, monkeypatch):
+    writers = []
+    emit = logging.FileHandler.emit
+    monkeypatch.setattr(logging.FileHandler, "emit",
+                        lambda self, rec: writers.append((self.baseFilename, threading.current_thread()))
+                        or emit(self, rec))
+    path = tmp_path / "test.log"
+    log.configure("DEBUG", str(path), sample=2)
+    logger = log.get_logger("test.listener")
+    for i in range(10):
+        logger.debug("message %d", i)
+    logger.warning("always")
+    log.shutdown()
+
+    lines = path.read_text().splitlines()
+    assert [line.split()[-1] for line in lines[:-1]] == ["0", "2", "4", "6", "8", "always"]
+    assert lines[-1].endswith("Dropped log records: {'sampled': 5}")
+    # the records are written by the listener, only the summary at shutdown is not
+    threads = [thread for filename, thread in writers if filename == str(path)]
+    assert len(threads) == 7 and threading.current_thread() not in threads[:-1]
@@ -0,0 +1,72 @@
+"""Test the broker metrics."""
+import time
+import urllib.request
+
+from src.metrics import Metrics, serve_http
+from src.middleware import MiddlewareType, PickleQueue, broker_stats
+from src.protocol import JSON, PICKLE
+from tests.conftest import Recorder, samples
+
+
+def test_prometheus_text():
+    metrics = Metrics("test_")
+    counter = metrics.counter("events_total", "Events", ["kind"])
+    counter.inc(("a",))
+    counter.inc(('say "hi"',), 2)
+    histogram = metrics.histogram("wait_seconds", "Waits", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value)
+    metrics.gauge("depth", "Depth", lambda: {(): 3})
+
+    text = metrics.to_prometheus()
+    assert "# TYPE test_events_total counter" in text
+    assert 'test_events_total{kind="a"} 1' in text
+    assert 'test_events_total{kind="say \\"hi\\""} 2' in text
+    assert 'test_wait_seconds_bucket{le="0.1"} 1' in text
+    assert 'test_wait_seconds_bucket{le="1.0"} 2' in text
+    assert 'test_wait_seconds_bucket{le="+Inf"} 3' in text
+    assert "test_wait_seconds_count 3" in text
+    assert "test_depth 3" in text
+
+
+def test_fanout_is_counted():
+    core = Recorder()
+    for conn in ("c1", "c2"):
+        core.subscribe("/metrics", conn, PICKLE)
+    core.subscribe("/metrics/a", "c3", JSON)
+    core.put_topic("/metrics/a", 1)
+    core.put_topic("/metrics/b", 2)
+
+    stats = core.stats()
+    assert samples(stats, "broker_published_total") == {
+        (("topic", "/metrics/a"),): 1, (("topic", "/metrics/b"),): 1}
+    assert samples(stats, "broker_delivered_total") == {
+        (("topic", "/metrics"),): 4, (("topic", "/metrics/a"),): 1}
+    fanout = samples(stats, "broker_fanout_subscribers")[()]
+    assert (fanout["count"], fanout["sum"]) == (2, 5)
+    assert set(samples(stats, "broker_encode_seconds")) == {
+        (("format", "pickle"),), (("format", "json"),)}
+
+
+def test_broker_stats(broker):
+    consumer = PickleQueue("/metrics/live")
+    producer = PickleQueue("/metrics/live", _type=MiddlewareType.PRODUCER)
+    time.sleep(0.1)
+    producer.push(1)
+    consumer.pull(timeout=5)
+
+    stats = broker_stats()
+    assert samples(stats, "broker_published_total")[(("topic", "/metrics/live"),)] == 1
+    assert samples(stats, "broker_received_bytes_total")[(("format", "pickle"),)] > 0
+    assert samples(stats, "broker_loop_seconds")[()]["count"] > 0
+
+    server = serve_http(broker.metrics, port=0)
+    try:
+        url = f"http://localhost:{server.server_address[1]}/metrics"
+        text = urllib.request.urlopen(url, timeout=5).read().decode()
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert 'broker_published_total{topic="/metrics/live"} 1' in text
+    assert "broker_outbox_bytes{connection=" in text
+    consumer.close()
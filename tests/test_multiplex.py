@@ -0,0 +1,100 @@
+"""Test queues multiplexed over a shared connection."""
+import time
+
+import pytest
+
+from src.clients import Producer
+from src.middleware import BinaryQueue, Connection, JSONQueue, MiddlewareType, PickleQueue
+
+ROOT = "/mux"
+
+
+def gen():
+    return iter(range(1000))
+
+
+def test_consumers_share_one_socket(broker):
+    connection = Connection()
+    consumers = [PickleQueue(f"{ROOT}/{i}", connection=connection) for i in range(50)]
+    parent = JSONQueue(ROOT, connection=connection)
+    time.sleep(0.2)
+
+    producer = Producer([f"{ROOT}/{i}" for i in range(50)], gen, BinaryQueue, multiplex=True)
+    assert len({queue.sock for queue in producer.queue}) == 1
+    producer.run(2)
+
+    for i, consumer in enumerate(consumers):
+        assert [consumer.pull(timeout=5) for _ in range(2)] == [(f"{ROOT}/{i}", i)] * 2
+    received = []
+    while len(received) < 100:
+        received += parent.pull_many(100, timeout=5)
+    assert {value for _, value in received} == set(range(50))
+    assert {topic for topic, _ in received} == {ROOT}
+
+    assert len([conn for conn, topics in broker.conn_topics.items() if ROOT in topics]) == 1
+    connection.close()
+
+
+def test_cancel_keeps_shared_subscription(broker):
+    topic = f"{ROOT}/shared"
+    connection = Connection()
+    first = PickleQueue(topic, connection=connection)
+    second = PickleQueue(topic, connection=connection)
+    producer = PickleQueue(topic, _type=MiddlewareType.PRODUCER)
+    time.sleep(0.1)
+
+    producer.push("both")
+    assert first.pull(timeout=5) == (topic, "both")
+    assert second.pull(timeout=5) == (topic, "both")
+
+    first.cancel()
+    producer.push("second only")
+    assert second.pull(timeout=5) == (topic, "second only")
+    assert first.pull(timeout=0.2) is None
+
+    second.cancel()
+    time.sleep(0.1)
+    assert broker.list_subscriptions(topic) == []
+    connection.close()
+
+
+def test_close_with_a_full_buffer(broker):
+    topic = f"{ROOT}/full"
+    connection = Connection()
+    full = PickleQueue(topic, connection=connection, prefetch=2)
+    other = PickleQueue(f"{ROOT}/other", connection=connection)
+    producer = PickleQueue(topic, _type=MiddlewareType.PRODUCER)
+    time.sleep(0.1)
+    for i in range(3):
+        producer.push(i)
+    time.sleep(0.2)  # 2 buffered, the reader waits with the third
+
+    started = time.monotonic()
+    full.close()
+    assert time.monotonic() - started < 1
+    assert [full.pull(timeout=1) for _ in range(2)] == [(topic, 0), (topic, 1)]
+    with pytest.raises(ConnectionError):
+        full.pull(timeout=1)
+
+    # the reader went on with the other queues of the connection
+    producer2 = PickleQueue(f"{ROOT}/other", _type=MiddlewareType.PRODUCER)
+    producer2.push("still routed")
+    assert other.pull(timeout=5) == (f"{ROOT}/other", "still routed")
+    connection.close()
+
+
+def test_broker_closing_a_full_buffer(broker):
+    connection = Connection()
+    full = PickleQueue(f"{ROOT}/closing", connection=connection, prefetch=1)
+    late = PickleQueue(f"{ROOT}/late", connection=connection)
+    connection.detach(late)
+    full._received.put(("/x", 0, None))
+    connection.close()  # the reader ends as when the broker drops the connection
+    connection._reader.join(timeout=5)
+    assert not connection._reader.is_alive()
+
+    connection.attach(late)  # does not deadlock on the routes lock
+    assert full.pull(timeout=1) == ("/x", 0)
+    for queue in (full, late):
+        with pytest.raises(ConnectionError):
+            queue.pull(timeout=1)
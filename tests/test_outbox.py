@@ -0,0 +1,110 @@
+"""Test per-connection outbound buffers."""
+import pytest
+
+from src.outbox import OverflowPolicy, Outbox, OutboxOverflow
+from tests.conftest import SlowSocket
+
+
+def test_partial_writes_keep_order():
+    sock = SlowSocket(3)
+    outbox = Outbox(sock)
+    for frame in [b"abcd", b"efgh", b"ij"]:
+        outbox.push(frame)
+    while outbox:
+        outbox.flush()
+    assert sock.data == b"abcdefghij"
+    assert outbox.nbytes == 0
+
+
+def fill(policy):
+    outbox = Outbox(SlowSocket(0), limit=8, policy=policy)
+    for frame in [b"1111", b"2222", b"3333"]:
+        outbox.push(frame)
+    return outbox
+
+
+def test_drop_newest():
+    outbox = fill(OverflowPolicy.DROP_NEWEST)
+    assert list(outbox.frames) == [b"1111", b"2222"]
+    assert outbox.dropped == 1
+
+
+def test_drop_oldest():
+    outbox = fill(OverflowPolicy.DROP_OLDEST)
+    assert list(outbox.frames) == [b"2222", b"3333"]
+    assert outbox.dropped == 1
+
+
+def test_drop_oldest_keeps_partially_written_head():
+    sock = SlowSocket(2)
+    outbox = Outbox(sock, limit=8, policy=OverflowPolicy.DROP_OLDEST)
+    outbox.push(b"1111")
+    outbox.push(b"2222")
+    sock.room = 2
+    outbox.flush()  # "11" written, then the socket is full
+    sock.room = 0
+    outbox.push(b"3333")
+    assert list(outbox.frames) == [b"1111", b"3333"]
+
+
+def test_block_keeps_everything():
+    outbox = fill(OverflowPolicy.BLOCK)
+    assert outbox.depth == 3
+    assert outbox.full
+
+
+def test_disconnect():
+    with pytest.raises(OutboxOverflow):
+        fill(OverflowPolicy.DISCONNECT)
+
+
+def test_conflation_replaces_waiting_frame():
+    sock = SlowSocket(0)
+    outbox = Outbox(sock)
+    outbox.push(b"a1", key="a")
+    outbox.push(b"b1", key="b")
+    outbox.push(b"a22", key="a")
+    outbox.push(b"x")
+    assert list(outbox.frames) == [b"a22", b"b1", b"x"]
+    assert (outbox.nbytes, outbox.conflated) == (6, 1)
+
+    sock.room = 1
+    outbox.flush()  # "a" of the head written
+    sock.room = 0
+    outbox.push(b"a3", key="a")  # the head has to go out whole
+    outbox.push(b"b2", key="b")
+    assert list(outbox.frames) == [b"a22", b"b2", b"x", b"a3"]
+
+    sock.room = 100
+    outbox.flush()
+    outbox.push(b"a4", key="a")
+    assert list(outbox.frames) == [b"a4"]
+
+
+class GatherSocket(SlowSocket):
+    """SlowSocket with scatter/gather writes."""
+
+    def sendmsg(self, buffers):
+        return self.send(b"".join(buffers))
+
+
+def test_vectored_flush_gathers_frames():
+    sock = GatherSocket(100)
+    outbox = Outbox(sock)
+    for frame in [b"abcd", b"efgh", b"ij"]:
+        outbox.push(frame)
+    assert outbox.flush() == 10
+    assert (sock.data, outbox.writes, outbox.nbytes) == (b"abcdefghij", 1, 0)
+
+
+def test_vectored_partial_writes_keep_order():
+    sock = GatherSocket(5)
+    outbox = Outbox(sock)
+    for frame in [b"abcd", b"efgh", b"ij"]:
+        outbox.push(frame)
+    outbox.flush()
+    assert list(outbox.frames) == [b"efgh", b"ij"]
+    assert outbox.nbytes == 6
+    while outbox:
+        outbox.flush()
+    assert sock.data == b"abcdefghij"
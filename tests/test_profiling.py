@@ -0,0 +1,49 @@
+"""Test the profiling hooks."""
+import os
+import threading
+import time
+
+from src.profiling import Profiler, SamplingProfiler
+from src.protocol import PICKLE
+from tests.conftest import Recorder
+
+
+def spin(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_sampler_sees_the_thread_stack():
+    stop = threading.Event()
+    worker = threading.Thread(target=spin, args=(stop,))
+    worker.start()
+    sampler = SamplingProfiler(worker.ident, interval=0.001)
+    sampler.start()
+    time.sleep(0.2)
+    sampler.stop()
+    stop.set()
+    worker.join()
+
+    assert sampler.samples > 0
+    lines = sampler.collapsed().splitlines()
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    assert any("test_profiling.py:spin" in line for line in lines)
+
+
+def test_stage_timings_are_dumped(tmp_path):
+    core = Recorder()
+    assert core.stage_seconds is None
+    profiler = Profiler(core, str(tmp_path), thread_id=threading.get_ident()).start(signals=False)
+    core.subscribe("/profile", "conn", PICKLE)
+    for i in range(10):
+        core.put_topic("/profile/a", i)
+    profiler.stop()
+
+    prefix = profiler.dump()
+    stages = open(prefix + "-stages.txt").read()
+    rows = {line.split()[0]: line.split() for line in stages.splitlines()[2:]}
+    assert rows["route"][1] == "10"
+    assert rows["encode"][1] == "10"
+    name = os.path.basename(prefix)
+    assert sorted(path.name for path in tmp_path.iterdir()) == [name + "-stages.txt", name + ".collapsed"]
+    assert "broker_stage_seconds" in core.stats()
@@ -0,0 +1,54 @@
+"""Test the prefetching consumer receive path."""
+import time
+
+import pytest
+
+from src.middleware import MiddlewareType, PickleQueue
+
+
+def test_pull_returns_as_soon_as_a_value_arrives(broker):
+    consumer = PickleQueue("/pull/latency")
+    producer = PickleQueue("/pull/latency", _type=MiddlewareType.PRODUCER)
+    time.sleep(0.1)
+
+    for i in range(20):
+        start = time.monotonic()
+        producer.push(i)
+        assert consumer.pull(timeout=5) == ("/pull/latency", i)
+        assert time.monotonic() - start < 0.1
+    consumer.close()
+
+
+def test_pull_timeout(broker):
+    consumer = PickleQueue("/pull/idle")
+    start = time.monotonic()
+    assert consumer.pull(timeout=0.2) is None
+    assert consumer.pull_many(10, timeout=0.2) == []
+    assert 0.4 <= time.monotonic() - start < 2
+    consumer.close()
+
+
+def test_pull_many_and_bounded_prefetch(broker):
+    consumer = PickleQueue("/pull/many", prefetch=3)
+    producer = PickleQueue("/pull/many", _type=MiddlewareType.PRODUCER)
+    time.sleep(0.1)
+    producer.push_many(range(10))
+    time.sleep(0.2)
+    assert consumer._received.qsize() <= 3
+
+    received = []
+    while len(received) < 10:
+        batch = consumer.pull_many(4, timeout=5)
+        assert 1 <= len(batch) <= 4
+        received += batch
+    assert received == [("/pull/many", i) for i in range(10)]
+    consumer.close()
+
+
+def test_pull_after_close(broker):
+    consumer = PickleQueue("/pull/closed")
+    consumer.close()
+    with pytest.raises(ConnectionError):
+        consumer.pull(timeout=5)
+    with pytest.raises(ConnectionError):
+        consumer.pull(timeout=5)
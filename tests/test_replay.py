@@ -0,0 +1,114 @@
+"""Test offset and timestamp replay subscriptions."""
+import time
+
+from src.broker import REPLAY_BATCH, Broker
+from src.middleware import MiddlewareType, PickleQueue
+from src.protocol import JSON, PICKLE
+from src.storage import TopicLog
+from tests.conftest import Recorder
+
+
+def test_replay_subtree_from_offset():
+    core = Recorder()
+    core.put_topic("/replay/a", 0)
+    for i in range(1, 4):
+        core.put_topic("/replay/a" if i % 2 else "/replay/b", i)
+        core.put_topic("/other", -i)
+    core.put_topic("/replayed", "not in the subtree")
+
+    core.subscribe("/replay", "conn", PICKLE, offset=1)
+    assert core.records("conn") == []  # no retained value, the replay sends the backlog
+    core.catch_up()
+    assert core.records("conn") == [("/replay", 1), ("/replay", 2), ("/replay", 3)]
+    assert not core.replays
+
+    core.put_topic("/replay/b", 4)
+    assert core.records("conn")[-1] == ("/replay", 4)
+
+
+def test_live_publishes_wait_for_the_replay():
+    core = Recorder()
+    for i in range(REPLAY_BATCH * 2 + 50):
+        core.put_topic("/replay/a", i)
+
+    core.subscribe("/replay/a", "conn", JSON, offset=0)
+    core.catch_up()
+    assert len(core.sent["conn"]) == 1  # one batch frame per iteration
+    core.put_topic("/replay/a", "live")
+    core.drain()
+
+    values = [value for _, value in core.records("conn")]
+    assert values == list(range(REPLAY_BATCH * 2 + 50)) + ["live"]
+
+
+def test_replay_since_timestamp():
+    core = Recorder()
+    core.put_topic("/replay/a", "old")
+    time.sleep(0.01)
+    since = time.time()
+    core.put_topic("/replay/a", "new")
+
+    core.subscribe("/replay/a", "conn", PICKLE, since=since)
+    core.drain()
+    assert core.records("conn") == [("/replay/a", "new")]
+
+
+def test_replay_older_than_history_reads_the_log(tmp_path):
+    core = Recorder(log=TopicLog(str(tmp_path)), history_size=5)
+    for i in range(20):
+        core.put_topic("/replay/a", i)
+
+    core.subscribe("/replay/a", "conn", PICKLE, offset=3)
+    core.drain()
+    assert [value for _, value in core.records("conn")] == list(range(3, 20))
+    core.log.close()
+
+
+def test_replay_without_log_skips_lost_records():
+    core = Recorder(history_size=5)
+    for i in range(20):
+        core.put_topic("/replay/a", i)
+
+    core.subscribe("/replay/a", "conn", PICKLE, offset=0)
+    core.drain()
+    assert [value for _, value in core.records("conn")] == list(range(15, 20))
+
+
+def test_cancel_stops_the_replay():
+    core = Recorder()
+    core.put_topic("/replay/a", 1)
+    core.subscribe("/replay/a", "conn", PICKLE, offset=0)
+    core.unsubscribe("/replay/a", "conn")
+    assert not core.replays
+
+
+def test_backlogged_replays_do_not_poll(monkeypatch):
+    broker = Broker(port=5129)
+    broker.put_topic("/replay/a", 1)
+    broker.replays[("conn", "/replay/a")] = None  # never read while conn is backlogged
+    monkeypatch.setattr(broker, "backlogged", lambda conn: True)
+    assert not broker.replaying()
+    timeouts = []
+
+    def select(timeout=None):
+        timeouts.append(timeout)
+        broker.canceled = len(timeouts) == 3
+        return []
+
+    monkeypatch.setattr(broker.sel, "select", select)
+    broker.run()
+    broker.sock.close()
+    assert timeouts == [None] * 3  # waits for EVENT_WRITE instead of spinning
+
+
+def test_consumer_replays_from_offset(broker):
+    producer = PickleQueue("/replay_it/a", _type=MiddlewareType.PRODUCER)
+    for i in range(5):
+        producer.push(i)
+    time.sleep(0.2)
+    start = broker.next_offset - 5
+
+    consumer = PickleQueue("/replay_it", offset=start)
+    assert [consumer.pull(timeout=5) for _ in range(5)] == [("/replay_it", i) for i in range(5)]
+    producer.push("live")
+    assert consumer.pull(timeout=5) == ("/replay_it", "live")
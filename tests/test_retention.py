@@ -0,0 +1,113 @@
+"""Test the retention limits of the retained values."""
+import time
+
+from src.protocol import PICKLE
+from src.retention import Retention, RetainedValues, value_size
+from src.storage import TopicLog
+from tests.conftest import Recorder, samples
+
+
+def test_ttl_longest_prefix():
+    retention = Retention({"/": 60, "/devices": 5, "/devices/hot/": 1})
+    assert retention.ttl_of("/msg") == 60
+    assert retention.ttl_of("/devices") == 5
+    assert retention.ttl_of("/devices/a") == 5
+    assert retention.ttl_of("/devices/hot/a") == 1
+    assert retention.ttl_of("/devicesx") == 60
+    assert Retention({"/devices": 5}).ttl_of("/msg") is None
+
+
+def test_values_expire():
+    values = RetainedValues(Retention({"/short": 1, "/long": 10}))
+    values.put("/short/a", 1, now=0)
+    values.put("/long/a", 2, now=0)
+    values.put("/short/b", 3, now=0.5)
+    values.put("/forever", 4, now=0.5)
+    values.put("/short/a", 5, now=0.8)  # publishing again extends its TTL
+
+    assert values.get("/short/b", now=1.6) is None
+    assert values.expire(now=1.6) == 0  # /short/b was dropped by get
+    assert values.expire(now=1.8) == 1
+    assert [topic for topic, _ in values.items(now=20)] == ["/forever"]
+    assert values.evicted == {"ttl": 3, "entries": 0, "bytes": 0}
+    assert not values.expiring
+
+
+def test_least_recently_used_are_evicted():
+    values = RetainedValues(Retention(max_entries=3))
+    for topic in ("/a", "/b", "/c"):
+        values.put(topic, 1, now=0)
+    values.get("/a", now=0)
+    values.put("/b", 2, now=0)
+    values.put("/d", 1, now=0)
+    assert [topic for topic, _ in values.items(now=0)] == ["/a", "/b", "/d"]
+
+    limit = 2 * value_size("/x", "x" * 10)
+    values = RetainedValues(Retention(max_bytes=limit))
+    for topic in ("/x", "/y", "/z"):
+        values.put(topic, "x" * 10, now=0)
+    assert values.nbytes == limit
+    assert "/x" not in values
+    values.put("/z", "x" * 100, now=0)  # alone over the cap
+    assert len(values) == 0 and values.nbytes == 0
+    assert values.evicted == {"ttl": 0, "entries": 0, "bytes": 3}
+
+
+def test_subscribe_keeps_no_placeholder():
+    core = Recorder()
+    core.subscribe("/never/published", "conn", PICKLE)
+    assert "/never/published" not in core.topics
+    assert core.get_topic("/never/published") is None
+    assert core.list_topics() == []
+
+
+def test_broker_evicts_retained_values():
+    core = Recorder(retention=Retention({"/devices": 0.05}, max_entries=2))
+    core.put_topic("/devices/1", 1)
+    core.put_topic("/devices/2", 2)
+    core.put_topic("/msg", "hi")
+    assert sorted(core.list_topics()) == ["/devices/2", "/msg"]
+    core.subscribe("/devices/2", "fresh", PICKLE)
+    assert core.records("fresh") == [("/devices/2", 2)]
+
+    time.sleep(0.1)
+    core.expire_retained()
+    core.subscribe("/devices/2", "late", PICKLE)
+    assert core.records("late") == []
+    assert core.list_topics() == ["/msg"]
+    evicted = samples(core.stats(), "broker_retained_evicted_total")
+    assert evicted[(("reason", "ttl"),)] == 1
+    assert evicted[(("reason", "entries"),)] == 1
+
+
+def test_restored_values_keep_their_age(tmp_path):
+    log = TopicLog(str(tmp_path))
+    log.append("/devices/old", 1, timestamp=time.time() - 10)
+    log.append("/devices/aging", 2, timestamp=time.time() - 4.7)
+    log.append("/msg", 3, timestamp=time.time() - 100)
+    core = Recorder(log=log, retention=Retention({"/devices": 5}))
+    assert core.list_topics() == ["/devices/aging", "/msg"]
+    assert "/devices/old" not in log.replay()
+
+    time.sleep(0.4)
+    core._next_expiry = 0
+    core.expire_retained()
+    assert core.list_topics() == ["/msg"]
+    assert list(log.replay()) == ["/msg"]
+    log.close()
+
+
+def test_eviction_drops_the_topic_series():
+    core = Recorder(retention=Retention(max_entries=1))
+    core.subscribe("/a", "conn", PICKLE)
+    core.subscribe("/b", "conn", PICKLE)
+    core.put_topic("/a", 1)
+    core.put_topic("/b", 2)
+    core.put_topic("/c", 3)
+    stats = core.stats()
+    assert list(samples(stats, "broker_published_total")) == [(("topic", "/c"),)]
+    # still subscribed, the deliveries keep being counted
+    assert sorted(samples(stats, "broker_delivered_total")) == [(("topic", "/a"),), (("topic", "/b"),)]
+
+    core.unsubscribe("/a", "conn")
+    assert list(samples(core.stats(), "broker_delivered_total")) == [(("topic", "/b"),)]
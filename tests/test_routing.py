@@ -0,0 +1,81 @@
+"""Test routed publish frames and same format forwarding."""
+import json
+import socket
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from src.protocol import (FRAME_V1, JSON, PICKLE, FrameReader, Payload, PubSub, PubSubBadFormat,
+                          pack_routed)
+from src.middleware import MiddlewareType, PickleQueue
+from src.storage import TopicLog
+from tests.conftest import Recorder
+
+
+def test_legacy_frames_are_not_routed():
+    frame = PubSub.encode(PubSub.publish(1, "/routed/a"), JSON, FRAME_V1)
+    assert json.loads(frame[3:]) == {"command": "publish", "message": 1, "topic": "/routed/a"}
+
+
+def test_same_format_subscribers_get_the_original_body():
+    publisher = FrameReader(None, lazy=True)
+    value = publisher.feed(PubSub.encode(PubSub.publish({"t": 21.5}, "/routed/a"), JSON))[0].message
+
+    core = Recorder()
+    frames = {}
+    core.deliver = lambda conn, frame, key=None: frames.setdefault(conn, frame)
+    for fmt in (JSON, PICKLE):
+        core.subscribe("/routed", f"conn-{fmt}", fmt)
+
+    with patch("json.loads", MagicMock(side_effect=json.loads)) as loads, \
+            patch("json.dumps", MagicMock(side_effect=json.dumps)) as dumps:
+        core.put_topic("/routed/a", value)
+        assert frames[f"conn-{JSON}"].endswith(value.body)
+        assert dumps.call_count == 0
+        assert loads.call_count == 1  # decoded once, for the pickle subscriber
+
+        core.put_topic("/routed/b", value)
+        assert loads.call_count == 1
+    assert FrameReader(None).feed(frames[f"conn-{PICKLE}"])[0].message == {"t": 21.5}
+    assert core.get_topic("/routed/a") == {"t": 21.5}
+
+
+def test_bad_routing_header():
+    frame = bytearray(PubSub.encode(PubSub.publish(1, "/routed/a"), PICKLE))
+    frame[7] = 0  # subscribe command code
+    with pytest.raises(PubSubBadFormat):
+        FrameReader(None, lazy=True).feed(bytes(frame))
+
+
+def test_undecodable_body_is_dropped():
+    core = Recorder()
+    core.subscribe("/routed", "pickle", PICKLE)
+    core.put_topic("/routed/bad", Payload(JSON, b"not json"))
+    core.put_topic("/routed/good", 1)
+    assert core.records("pickle") == [("/routed", 1)]
+
+    core.subscribe("/routed", "replayer", PICKLE, offset=0)
+    core.drain()
+    assert core.records("replayer") == [("/routed", 1)]
+
+
+def test_undecodable_body_is_not_logged(tmp_path):
+    core = Recorder(log=TopicLog(str(tmp_path)))
+    with pytest.raises(PubSubBadFormat):
+        core.put_topic("/routed/bad", Payload(JSON, b"not json"))
+    assert "/routed/bad" not in core.topics
+    assert core.next_offset == 0
+    core.log.close()
+
+
+def test_broker_survives_undecodable_body(broker):
+    consumer = PickleQueue("/routed/survive")
+    time.sleep(0.1)
+    with socket.create_connection(("localhost", 5000)) as sender:
+        sender.sendall(pack_routed(JSON, "/routed/survive", b"not json"))
+        time.sleep(0.1)
+    producer = PickleQueue("/routed/survive", _type=MiddlewareType.PRODUCER)
+    producer.push(1)
+    assert consumer.pull(timeout=5) == ("/routed/survive", 1)
+    consumer.close()
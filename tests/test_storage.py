@@ -0,0 +1,103 @@
+"""Test the durable publish log."""
+import os
+import time
+import zlib
+
+from src import storage
+from src.broker import Broker
+from src.storage import TopicLog
+
+
+def fill(log, count=100):
+    for i in range(count):
+        log.append(f"/log/{i % 5}", [i, "x" * 10] if i % 3 else i)
+
+
+def test_replay_after_reopen(tmp_path):
+    log = TopicLog(str(tmp_path), segment_bytes=500)
+    fill(log)
+    log.append("/log/set", {1, 2})  # not representable in binary, pickled
+    values = log.replay()
+    log.close()
+    assert len(log.segments) > 1
+    assert values["/log/4"] == 99
+    assert values["/log/set"] == {1, 2}
+
+    reopened = TopicLog(str(tmp_path), segment_bytes=500)
+    assert reopened.replay() == values
+    assert reopened.append("/log/0", "next") == 101
+    assert [record[0] for record in reopened.records(98)] == [98, 99, 100, 101]
+    reopened.close()
+
+
+def test_torn_tail_is_dropped(tmp_path):
+    log = TopicLog(str(tmp_path))
+    fill(log, 10)
+    log.close()
+    path = log.segments[-1].path
+    with open(path, "ab") as file:
+        file.write(b"\x00\x00\x00\xff partial record")
+
+    reopened = TopicLog(str(tmp_path))
+    assert reopened.next_offset == 10
+    assert os.path.getsize(path) == reopened.segments[-1].size
+    assert reopened.replay()["/log/4"] == 9
+    reopened.close()
+
+
+def test_compaction_keeps_last_values(tmp_path):
+    log = TopicLog(str(tmp_path), segment_bytes=400, max_bytes=1200)
+    fill(log, 500)
+    values = log.replay()
+    assert log.size < 2000
+    assert values == {f"/log/{i}": v for i, v in [(0, 495), (1, [496, "x" * 10]), (2, [497, "x" * 10]), (3, 498), (4, [499, "x" * 10])]}
+    log.close()
+    assert TopicLog(str(tmp_path)).replay() == values
+
+
+def test_compaction_by_age(tmp_path):
+    log = TopicLog(str(tmp_path), segment_bytes=400, max_age=0)
+    fill(log, 50)
+    old = log.segments[:-1]
+    assert all(len(segment.offsets) <= 5 for segment in old)
+    log.close()
+
+
+def test_quiet_log_ages_out(tmp_path):
+    log = TopicLog(str(tmp_path), max_age=0.05)
+    fill(log, 20)
+    log.age_out()
+    assert len(log.segments) == 1  # not old yet
+    time.sleep(0.1)
+    log._next_age_check = 0
+    log.age_out()
+    assert [record[0] for record in log.records()] == [15, 16, 17, 18, 19]
+    log.close()
+
+
+def test_only_the_tail_is_verified(tmp_path, monkeypatch):
+    log = TopicLog(str(tmp_path), segment_bytes=500)
+    fill(log)
+    log.close()
+    checked = []
+    crc32 = zlib.crc32
+    monkeypatch.setattr(storage.zlib, "crc32", lambda data: checked.append(data) or crc32(data))
+    reopened = TopicLog(str(tmp_path), segment_bytes=500)
+    assert len(checked) == len(reopened.segments[-1].offsets) < 100
+    assert reopened.next_offset == 100
+    reopened.close()
+
+
+def test_broker_restart(tmp_path):
+    broker = Broker(port=5128, log=TopicLog(str(tmp_path)))
+    broker.put_topic("/durable/a", 1)
+    broker.put_topic("/durable/a", 2)
+    broker.put_topic("/durable/b", "x")
+    broker.log.close()
+    broker.sock.close()
+
+    restarted = Broker(port=5128, log=TopicLog(str(tmp_path)))
+    assert restarted.get_topic("/durable/a") == 2
+    assert sorted(restarted.list_topics()) == ["/durable/a", "/durable/b"]
+    restarted.log.close()
+    restarted.sock.close()
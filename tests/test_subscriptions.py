@@ -0,0 +1,33 @@
+"""Test subscription bookkeeping."""
+from unittest.mock import MagicMock
+
+from src.broker import Serializer
+
+
+def test_resubscribe_changes_format(broker):
+    subscriber = MagicMock()
+    broker.subscribe("/subs/a", subscriber, Serializer.JSON)
+    broker.subscribe("/subs/a", subscriber, Serializer.PICKLE)
+    assert broker.list_subscriptions("/subs/a") == [(subscriber, Serializer.PICKLE)]
+    broker.unsubscribe("/subs/a", subscriber)
+    broker.unsubscribe("/subs/a", subscriber)  # not subscribed anymore, no-op
+    assert broker.list_subscriptions("/subs/a") == []
+    assert subscriber not in broker.conn_topics
+
+
+def test_disconnect_cleans_only_own_subscriptions(broker):
+    leaving, staying = MagicMock(), MagicMock()
+    topics = ["/subs/b", "/subs/b/c", "/subs/d"]
+    for topic in topics:
+        broker.subscribe(topic, leaving, Serializer.JSON)
+    broker.subscribe("/subs/b", staying, Serializer.JSON)
+    assert broker.conn_topics[leaving] == set(topics)
+
+    broker.disconnect(leaving)
+
+    leaving.close.assert_called_once()
+    assert leaving not in broker.conn_topics
+    assert broker.list_subscriptions("/subs/b") == [(staying, Serializer.JSON)]
+    assert "/subs/b/c" not in broker.subscriptions
+    assert "/subs/b/c" not in broker.index
+    broker.unsubscribe("/subs/b", staying)
@@ -0,0 +1,125 @@
+"""Test the hierarchical topic index."""
+import time
+
+import pytest
+
+from src.middleware import Connection, MiddlewareType, PickleQueue
+from src.protocol import FRAME_V1, JSON, PICKLE, FrameReader, PubSub
+from src.topics import TopicTrie, compile_filter, is_pattern
+from tests.conftest import Recorder
+
+
+@pytest.fixture
+def trie():
+    trie = TopicTrie()
+    for topic in ["/weather", "/weather/humidity", "/msg", "temp"]:
+        trie.setdefault(topic, []).append(topic)
+    return trie
+
+
+def test_prefixes(trie):
+    assert [t for t, _ in trie.prefixes("/weather/humidity")] == [
+        "/weather",
+        "/weather/humidity",
+    ]
+    assert [t for t, _ in trie.prefixes("/weather/pressure")] == ["/weather"]
+    assert [t for t, _ in trie.prefixes("/weathers")] == []
+    assert [t for t, _ in trie.prefixes("temp")] == ["temp"]
+    assert [t for t, _ in trie.prefixes("/temp")] == []
+
+
+def test_same_semantics_as_startswith(trie):
+    topics = ["/weather", "/weather/humidity", "/msg", "temp"]
+    for published in ["/weather/humidity/x", "/msg", "/msgs", "temp/a", "/"]:
+        expected = [
+            t for t in topics if published.startswith(t + "/") or published == t
+        ]
+        assert sorted(t for t, _ in trie.prefixes(published)) == sorted(expected)
+
+
+def test_pop_prunes(trie):
+    assert "/weather/humidity" in trie
+    assert trie.pop("/weather/humidity") == ["/weather/humidity"]
+    assert "/weather/humidity" not in trie
+    assert "/weather" in trie
+    assert trie.pop("/weather") == ["/weather"]
+    assert list(trie.root.children[""].children) == ["msg"]
+    assert trie.pop("/nothing") is None
+    assert len(trie) == 2
+
+
+FILTERS = ["/weather2/+/celsius", "/weather2/#", "/weather2/lisbon", "/+", "/+/+/kelvin", "#", "/a/#"]
+PUBLISHED = ["/weather2/porto/celsius", "/weather2/porto/celsius/max", "/weather2/lisbon",
+             "/weather2", "/weather1/x/kelvin", "/a", "/ab", "/a/b/c", "/"]
+
+
+def test_wildcards():
+    trie = TopicTrie()
+    for topic_filter in FILTERS:
+        trie.setdefault(topic_filter, topic_filter)
+    assert is_pattern("/weather2/+/celsius") and not is_pattern("/weather2")
+
+    assert sorted(t for t, _ in trie.match("/weather2/porto/celsius")) == sorted(
+        ["/weather2/+/celsius", "/weather2/#", "/+", "#"])
+    assert sorted(t for t, _ in trie.match("/a")) == ["#", "/+", "/a/#"]
+    for published in PUBLISHED:
+        expected = [f for f in FILTERS if compile_filter(f)(published)]
+        matched = [t for t, _ in trie.match(published)]
+        assert sorted(matched) == sorted(expected), published
+
+
+def test_broker_wildcard_subscription():
+    core = Recorder()
+    core.put_topic("/weather2/porto/celsius", 20)
+    core.subscribe("/weather2/+/celsius", "conn", PICKLE)
+    assert core.records("conn") == [("/weather2/porto/celsius", 20)]  # retained
+    assert "/weather2/+/celsius" not in core.topics
+
+    core.put_topic("/weather2/lisbon/celsius", 25)
+    core.put_topic("/weather2/lisbon/kelvin", 298)
+    assert core.records("conn")[-1] == ("/weather2/lisbon/celsius", 25)
+    assert len(core.records("conn")) == 2
+    assert {message.subscription for message in core.sent["conn"]} == {"/weather2/+/celsius"}
+
+    core.subscribe("/weather2/#", "replayer", PICKLE, offset=0)
+    core.drain()
+    assert core.records("replayer") == [
+        ("/weather2/porto/celsius", 20), ("/weather2/lisbon/celsius", 25), ("/weather2/lisbon/kelvin", 298)]
+    assert core.sent["replayer"][0].topic == "/weather2/#"
+
+
+def test_wildcard_messages_held_for_credit():
+    core = Recorder()
+    core.subscribe("/weather2/+", "conn", PICKLE, credit=0, ack=True)
+    core.put_topic("/weather2/porto", 20)
+    core.put_topic("/weather2/lisbon", 25)
+    core.grant("conn", "/weather2/+", 2)
+    assert core.records("conn") == [("/weather2/porto", 20), ("/weather2/lisbon", 25)]
+
+    core.ack_timeout = 0
+    core.flows[("conn", "/weather2/+")].inflight[0][0] = 0  # ack timed out
+    core.redeliver()
+    assert core.records("conn")[-1] == ("/weather2/porto", 20)
+    core.ack("conn", "/weather2/+", 1)
+    assert not core.flows[("conn", "/weather2/+")].published
+
+
+def test_legacy_frames_carry_the_published_topic():
+    legacy = PubSub.encode(PubSub.publish(1, "/a/b", 7, "/a/+"), JSON, FRAME_V1)
+    assert FrameReader(None).feed(legacy)[0].topic == "/a/b"
+
+
+def test_client_routes_by_subscription(broker):
+    connection = Connection()
+    wildcard = PickleQueue("/wild/+/t", connection=connection)
+    exact = PickleQueue("/wild/a/t", connection=connection)
+    producer = PickleQueue("/wild/a/t", _type=MiddlewareType.PRODUCER)
+    other = PickleQueue("/wild/b/t", _type=MiddlewareType.PRODUCER)
+    time.sleep(0.1)
+    producer.push(1)
+    other.push(2)
+
+    assert [wildcard.pull(timeout=5) for _ in range(2)] == [("/wild/a/t", 1), ("/wild/b/t", 2)]
+    assert exact.pull(timeout=5) == ("/wild/a/t", 1)
+    assert exact.pull(timeout=0.2) is None and wildcard.pull(timeout=0.2) is None
+    connection.close()
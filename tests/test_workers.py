@@ -0,0 +1,75 @@
+"""Test brokers that forward publishes to each other."""
+import multiprocessing
+import socket
+import threading
+import time
+
+import pytest
+
+from src.broker import Broker
+from src.protocol import JSON, PICKLE, PubSub
+from src.workers import channels, run_workers
+
+
+def connect(port):
+    sock = socket.create_connection(("localhost", port))
+    sock.settimeout(5)
+    return sock
+
+
+@pytest.fixture(scope="module")
+def peered_brokers():
+    (a,), (b,) = channels(2)
+    brokers = [Broker(port=5125, peers=[a]), Broker(port=5126, peers=[b])]
+    for broker in brokers:
+        threading.Thread(target=broker.run, daemon=True).start()
+    yield brokers
+    for broker in brokers:
+        broker.canceled = True
+
+
+def test_forward_between_peers(peered_brokers):
+    first, second = peered_brokers
+    consumer = connect(5125)
+    PubSub.send_msg(consumer, PubSub.subscribe("/peers", JSON), JSON)
+    time.sleep(0.1)
+
+    producer = connect(5126)
+    PubSub.send_msg(producer, PubSub.publish(1.5, "/peers/a"), PICKLE)
+    PubSub.send_msg(producer, PubSub.publish_batch([("/peers/b", 2), ("/peers/a", 3)]), JSON)
+
+    assert [PubSub.recv_msg(consumer).message for _ in range(3)] == [1.5, 2, 3]
+    for broker in peered_brokers:
+        assert broker.get_topic("/peers/a") == 3
+        assert broker.get_topic("/peers/b") == 2
+    consumer.close()
+    producer.close()
+
+
+def test_workers_refuse_groups(peered_brokers):
+    consumer = connect(5125)
+    PubSub.send_msg(consumer, PubSub.subscribe("/peers/jobs", JSON, group="workers"), JSON)
+    assert consumer.recv(1) == b""  # closed by the broker
+    consumer.close()
+    assert not any("/peers/jobs" in broker.groups for broker in peered_brokers)
+
+
+def test_run_workers():
+    master = multiprocessing.get_context("fork").Process(
+        target=run_workers, args=(2, "localhost", 5127)
+    )
+    master.start()
+    try:
+        time.sleep(0.5)
+        consumers = [connect(5127) for _ in range(6)]
+        for consumer in consumers:
+            PubSub.send_msg(consumer, PubSub.subscribe("/workers", PICKLE), PICKLE)
+        time.sleep(0.2)
+        producer = connect(5127)
+        PubSub.send_msg(producer, PubSub.publish("hello", "/workers"), PICKLE)
+        for consumer in consumers:
+            assert PubSub.recv_msg(consumer).message == "hello"
+    finally:
+        master.terminate()
+        master.join(timeout=5)
+    assert master.exitcode == 0